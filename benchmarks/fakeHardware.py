@@ -0,0 +1,327 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+# Fake Pi Power Hat hardware so the real PiPowerHat code can be
+# benchmarked on any Linux box.
+#
+# - A fake sysfs 1-Wire tree (/sys/bus/w1/devices) of DS18B20 sensors.
+# - Fake ina219, tsl2561 and RPi.GPIO modules installed into sys.modules.
+
+import os
+import sys
+import types
+import random
+import shutil
+import tempfile
+
+# ===========================================
+# 1-Wire temperature sensors
+# ===========================================
+W1_SLAVE_TEMPLATE = "72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n72 01 4b 46 7f ff 0e 10 57 t={0}\n"
+
+
+# A temporary directory laid out like /sys/bus/w1/devices
+class FakeW1Tree(object):
+	def __init__(self, sensor_count):
+		self.path = tempfile.mkdtemp(prefix="pipower-w1-")
+		self.sensorIds = []
+
+		os.mkdir(os.path.join(self.path, "w1_bus_master1"))
+
+		for index in range(sensor_count):
+			sensor_id = "28-{0:012x}".format(0x7538f5b + index)
+			os.mkdir(os.path.join(self.path, sensor_id))
+			self.sensorIds.append(sensor_id)
+			self.set_temperature(sensor_id, 21.5 + index)
+
+	def set_temperature(self, sensor_id, temperature):
+		with open(os.path.join(self.path, sensor_id, "w1_slave"), "w") as f:
+			f.write(W1_SLAVE_TEMPLATE.format(int(temperature * 1000)))
+
+	def remove(self):
+		shutil.rmtree(self.path, ignore_errors=True)
+
+
+# ===========================================
+# INA219 (pi-ina219)
+# ===========================================
+class DeviceRangeError(Exception):
+	pass
+
+
+class FakeINA219(object):
+	RANGE_16V = 0
+	RANGE_32V = 1
+
+	GAIN_1_40MV = 0
+	GAIN_2_80MV = 1
+	GAIN_4_160MV = 2
+	GAIN_8_320MV = 3
+	GAIN_AUTO = -1
+
+	ADC_9BIT = 0
+	ADC_10BIT = 1
+	ADC_11BIT = 2
+	ADC_12BIT = 3
+	ADC_2SAMP = 9
+	ADC_4SAMP = 10
+	ADC_8SAMP = 11
+	ADC_16SAMP = 12
+	ADC_32SAMP = 13
+	ADC_64SAMP = 14
+	ADC_128SAMP = 15
+
+	def __init__(self, shunt_ohms, max_expected_amps=None, busnum=None, address=0x40, log_level=None):
+		self.shunt_ohms = shunt_ohms
+		self.max_expected_amps = max_expected_amps
+
+	def configure(self, voltage_range=RANGE_32V, gain=GAIN_AUTO, bus_adc=ADC_12BIT, shunt_adc=ADC_12BIT):
+		self.voltage_range = voltage_range
+		self.gain = gain
+		self.bus_adc = bus_adc
+		self.shunt_adc = shunt_adc
+
+	def wake(self):
+		pass
+
+	def sleep(self):
+		pass
+
+	def voltage(self):
+		return random.uniform(11.8, 12.2)
+
+	def current(self):
+		return random.uniform(900, 1200)
+
+	def power(self):
+		return self.voltage() * self.current()
+
+	def shunt_voltage(self):
+		return self.current() * self.shunt_ohms
+
+
+# ===========================================
+# TSL2561 (tsl2561)
+# ===========================================
+class FakeTSL2561I2C(object):
+	def readU16(self, register):
+		return random.randint(1000, 3000)
+
+
+class FakeTSL2561(object):
+	def __init__(self, address=None, busnum=None, integration_time=2, gain=0, autogain=False, debug=False):
+		self.address = address
+		self.integration_time = integration_time
+		self.gain = gain
+		self.i2c = FakeTSL2561I2C()
+
+	def enable(self):
+		pass
+
+	def disable(self):
+		pass
+
+	def set_integration_time(self, integration_time):
+		self.integration_time = integration_time
+
+	def set_gain(self, gain):
+		self.gain = gain
+
+	def _calculate_lux(self, broadband, ir):
+		return (broadband - ir) // 10
+
+	def lux(self):
+		return random.uniform(50, 200)
+
+
+# ===========================================
+# RPi.GPIO
+# ===========================================
+class FakePWM(object):
+	def __init__(self, pin, frequency):
+		self.pin = pin
+		self.frequency = frequency
+		self.dutyCycle = 0
+
+	def start(self, duty_cycle):
+		self.dutyCycle = duty_cycle
+
+	def ChangeDutyCycle(self, duty_cycle):
+		self.dutyCycle = duty_cycle
+
+	def ChangeFrequency(self, frequency):
+		self.frequency = frequency
+
+	def stop(self):
+		self.dutyCycle = 0
+
+
+def create_gpio_module():
+	gpio = types.ModuleType("RPi.GPIO")
+	gpio.VERSION = "0.6.5"
+	gpio.BCM = 11
+	gpio.BOARD = 10
+	gpio.IN = 1
+	gpio.OUT = 0
+	gpio.PUD_OFF = 20
+	gpio.PUD_DOWN = 21
+	gpio.PUD_UP = 22
+	gpio.LOW = 0
+	gpio.HIGH = 1
+
+	levels = dict()
+
+	gpio.setmode = lambda mode: None
+	gpio.setwarnings = lambda state: None
+	gpio.setup = lambda pin, direction, pull_up_down=None, initial=None: levels.setdefault(pin, 0)
+	gpio.input = lambda pin: levels.get(pin, 0)
+	gpio.output = lambda pin, value: levels.__setitem__(pin, value)
+	gpio.cleanup = lambda *args: levels.clear()
+	gpio.PWM = FakePWM
+	return gpio
+
+
+# Install the fake device modules so "import RPi.GPIO", "from ina219 import INA219"
+# and "from tsl2561 import TSL2561" pick them up.
+def install_fake_modules():
+	gpio = create_gpio_module()
+	rpi = types.ModuleType("RPi")
+	rpi.GPIO = gpio
+	sys.modules["RPi"] = rpi
+	sys.modules["RPi.GPIO"] = gpio
+
+	ina219 = types.ModuleType("ina219")
+	ina219.INA219 = FakeINA219
+	ina219.DeviceRangeError = DeviceRangeError
+	sys.modules["ina219"] = ina219
+
+	tsl2561 = types.ModuleType("tsl2561")
+	tsl2561.TSL2561 = FakeTSL2561
+	constants = types.ModuleType("tsl2561.constants")
+	constants.TSL2561_ADDR_LOW = 0x29
+	constants.TSL2561_ADDR_FLOAT = 0x39
+	constants.TSL2561_ADDR_HIGH = 0x49
+	constants.TSL2561_INTEGRATIONTIME_13MS = 0x00
+	constants.TSL2561_INTEGRATIONTIME_101MS = 0x01
+	constants.TSL2561_INTEGRATIONTIME_402MS = 0x02
+	constants.TSL2561_GAIN_1X = 0x00
+	constants.TSL2561_GAIN_16X = 0x10
+	constants.TSL2561_COMMAND_BIT = 0x80
+	constants.TSL2561_WORD_BIT = 0x20
+	constants.TSL2561_REGISTER_CHAN0_LOW = 0x0C
+	constants.TSL2561_REGISTER_CHAN1_LOW = 0x0E
+	constants.TSL2561_AGC_THI_13MS = 4850
+	constants.TSL2561_AGC_TLO_13MS = 100
+	constants.TSL2561_AGC_THI_101MS = 36000
+	constants.TSL2561_AGC_TLO_101MS = 200
+	constants.TSL2561_AGC_THI_402MS = 63000
+	constants.TSL2561_AGC_TLO_402MS = 500
+	tsl2561.constants = constants
+	sys.modules["tsl2561"] = tsl2561
+	sys.modules["tsl2561.constants"] = constants
+
+
+# Minimal stand in for OctoPrint's PluginSettings backed by the plugin defaults.
+class FakeSettings(object):
+	def __init__(self, defaults):
+		self._values = defaults
+
+	def get(self, path):
+		value = self._values
+		for key in path:
+			value = value[key]
+		return value
+
+	def get_int(self, path):
+		return int(self.get(path))
+
+	def get_float(self, path):
+		return float(self.get(path))
+
+	def get_boolean(self, path):
+		return bool(self.get(path))
+
+	def set(self, path, value):
+		target = self._values
+		for key in path[:-1]:
+			target = target[key]
+		target[path[-1]] = value
+
+
+# Records plugin messages rather than pushing them to websockets.
+class FakePluginManager(object):
+	def __init__(self):
+		self.messages = 0
+		self.lastMessage = None
+
+	def send_plugin_message(self, identifier, data):
+		self.messages += 1
+		self.lastMessage = data
+
+
+# Counts events rather than keeping them, so it doesn't show up as memory growth.
+class FakeEventBus(object):
+	def __init__(self):
+		self.events = 0
+		self.lastEvent = None
+
+	def fire(self, event, payload=None):
+		self.events += 1
+		self.lastEvent = (event, payload)
+
+
+# ===========================================
+# Simulated time
+# ===========================================
+
+# Modules using the monotonic clock() (imported from sweepMonitor) and time.time().
+CLOCK_MODULES = ["octoprint_PiPower", "octoprint_PiPower.piPowerHat", "octoprint_PiPower.lightSensor",
+				 "octoprint_PiPower.deviceSupervisor", "octoprint_PiPower.eventPublisher"]
+TIME_MODULES = ["octoprint_PiPower.sampleRecorder", "octoprint_PiPower.deviceSupervisor"]
+
+
+# Replaces the plugin's clocks so a run of sweeps covers simulated days,
+# e.g. the statistics windows fill and expire and the recorder changes files.
+# Time only moves on when advance() is called.
+class SimulatedClock(object):
+	def __init__(self, monotonic, wall):
+		self._monotonic = monotonic
+		self._wall = wall
+		self._elapsed = 0.0
+		self._patched = []
+
+	@property
+	def elapsed(self):
+		return self._elapsed
+
+	def advance(self, seconds):
+		self._elapsed += seconds
+
+	def clock(self):
+		return self._monotonic + self._elapsed
+
+	def time(self):
+		return self._wall + self._elapsed
+
+	def install(self):
+		for name in CLOCK_MODULES:
+			module = sys.modules[name]
+			self._patched.append((module, "clock", module.clock))
+			module.clock = self.clock
+
+		# Stands in for the time module, only time() is used.
+		wall_time = types.ModuleType("time")
+		wall_time.time = self.time
+		for name in TIME_MODULES:
+			module = sys.modules[name]
+			self._patched.append((module, "time", module.time))
+			module.time = wall_time
+
+	def remove(self):
+		for module, name, value in reversed(self._patched):
+			setattr(module, name, value)
+		self._patched = []
@@ -0,0 +1,429 @@
+# coding=utf-8
+from __future__ import absolute_import, print_function
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+# Benchmarks for the Pi Power plugin's acquisition and publish paths.
+#
+# Runs the real PiPowerHat and plugin code against fake hardware (see fakeHardware.py)
+# so it can be run on any Linux box with OctoPrint installed:
+#
+#   python -m benchmarks.runBenchmarks --output results.json
+#   python -m benchmarks.runBenchmarks --compare baseline.json --output results.json
+#
+# Results are written as JSON so runs of different versions can be compared.
+
+import argparse
+import gc
+import json
+import logging
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from . import fakeHardware
+
+fakeHardware.install_fake_modules()
+
+import flask
+
+from octoprint_PiPower import PipowerPlugin
+from octoprint_PiPower.piPowerHat import PiPowerHat
+from octoprint_PiPower.sweepMonitor import SweepMonitor, clock
+from octoprint_PiPower.acquisitionPlan import build_acquisition_plan
+from octoprint_PiPower.metricStatistics import StatisticsEngine
+from octoprint_PiPower.sampleRecorder import SampleRecorder
+
+try:
+	import tracemalloc
+except ImportError:
+	# Python 2
+	tracemalloc = None
+
+RESULTS_SCHEMA_VERSION = 1
+
+# Metrics where a smaller value is better, used when comparing results.
+LOWER_IS_BETTER = ("Ms", "Bytes", "BytesPerDay")
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Simulated time before measuring memory, the longest statistics window (1 hour).
+MEMORY_WARM_UP_SECONDS = 60 * 60
+
+# Memory is measured this many times over the simulated days.
+MEMORY_CHECKPOINTS = 10
+
+
+# ===========================================
+# Helpers
+# ===========================================
+def summarize(durations):
+	ordered = sorted(durations)
+	count = len(ordered)
+
+	def percentile(percent):
+		return round(ordered[int(round(percent / 100.0 * (count - 1)))] * 1000, 3)
+
+	return dict(
+		count=count,
+		meanMs=round(sum(ordered) / count * 1000, 3),
+		p50Ms=percentile(50),
+		p95Ms=percentile(95),
+		p99Ms=percentile(99),
+		maxMs=round(ordered[-1] * 1000, 3),
+	)
+
+
+def create_plugin(tree):
+	plugin = PipowerPlugin()
+	plugin._logger = logging.getLogger("benchmark.plugin")
+	plugin._identifier = "pipower"
+	plugin._plugin_version = "benchmark"
+	plugin._plugin_manager = fakeHardware.FakePluginManager()
+	plugin._event_bus = fakeHardware.FakeEventBus()
+
+	settings = fakeHardware.FakeSettings(plugin.get_settings_defaults())
+	settings.set(["temperatureSensors"], [dict(sensorId=sensor_id, caption=sensor_id) for sensor_id in tree.sensorIds])
+	plugin._settings = settings
+	plugin._acquisitionPlan = build_acquisition_plan(settings)
+
+	plugin._powerHat = PiPowerHat(w1_devices_dir=tree.path)
+	plugin._powerHat.initialize(settings, plugin._acquisitionPlan)
+	plugin._sweepMonitor = SweepMonitor(settings.get_float(["timerInterval"]), settings.get_float(["slowSweepThreshold"]))
+	plugin._eventPublisher = plugin.create_event_publisher()
+	plugin._statistics = StatisticsEngine(settings.get_float(["statisticsEwmaTimeConstant"]))
+	return plugin
+
+
+def time_calls(function, iterations):
+	durations = []
+	for i in range(iterations):
+		started = clock()
+		function()
+		durations.append(clock() - started)
+	return durations
+
+
+# ===========================================
+# Benchmarks
+# ===========================================
+
+# Time a full hat sweep for different numbers of temperature sensors.
+def benchmark_sweep_latency(sensor_counts, iterations):
+	results = []
+	for sensor_count in sensor_counts:
+		tree = fakeHardware.FakeW1Tree(sensor_count)
+		try:
+			plugin = create_plugin(tree)
+			hat = plugin._powerHat
+			plan = plugin._acquisitionPlan
+
+			stage_durations = dict()
+
+			def sweep():
+				hat.getPiPowerValues(plan)
+				for stage, duration in hat.get_stage_timings().items():
+					stage_durations.setdefault(stage, []).append(duration)
+
+			# Warm up
+			time_calls(sweep, 3)
+			stage_durations.clear()
+
+			result = summarize(time_calls(sweep, iterations))
+			result["sensors"] = sensor_count
+			result["stages"] = dict((stage, summarize(durations)) for stage, durations in stage_durations.items())
+			results.append(result)
+		finally:
+			tree.remove()
+
+	return results
+
+
+# Time API GET and command requests with a number of concurrent clients.
+#
+# A GET while another sweep is running returns that sweep's last values without
+# reading the sensors, so GETs are reported as fresh (swept) and cached as well
+# as overall.
+def benchmark_api_latency(client_counts, requests_per_client, sensor_count):
+	tree = fakeHardware.FakeW1Tree(sensor_count)
+	app = flask.Flask("pipower-benchmark")
+
+	try:
+		plugin = create_plugin(tree)
+		results = []
+
+		# Note the sweeps run by each thread.
+		swept = threading.local()
+		read_values = plugin._powerHat.getPiPowerValues
+
+		def counted_read(plan):
+			swept.value = True
+			return read_values(plan)
+
+		plugin._powerHat.getPiPowerValues = counted_read
+
+		for client_count in client_counts:
+			get_durations = []
+			fresh_durations = []
+			cached_durations = []
+			command_durations = []
+			lock = threading.Lock()
+
+			def client():
+				fresh = []
+				cached = []
+				commands = []
+				with app.test_request_context("/api/plugin/pipower"):
+					for i in range(requests_per_client):
+						swept.value = False
+						started = clock()
+						plugin.on_api_get(flask.request)
+						duration = clock() - started
+						if swept.value:
+							fresh.append(duration)
+						else:
+							cached.append(duration)
+
+						started = clock()
+						plugin.on_api_command("setGPIO", dict(pin=11, value=i % 2))
+						commands.append(clock() - started)
+
+				with lock:
+					get_durations.extend(fresh + cached)
+					fresh_durations.extend(fresh)
+					cached_durations.extend(cached)
+					command_durations.extend(commands)
+
+			threads = [threading.Thread(target=client) for i in range(client_count)]
+			started = clock()
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			elapsed = clock() - started
+
+			results.append(dict(
+				clients=client_count,
+				requestsPerSecond=round(len(get_durations + command_durations) / elapsed, 1),
+				get=summarize(get_durations),
+				getFresh=summarize(fresh_durations) if fresh_durations else None,
+				getCached=summarize(cached_durations) if cached_durations else None,
+				cachedGets=len(cached_durations),
+				command=summarize(command_durations),
+			))
+
+		return results
+	finally:
+		tree.remove()
+
+
+# Size of the plugin message (websocket payload) for different numbers of sensors.
+def benchmark_payload_size(sensor_counts):
+	results = []
+	for sensor_count in sensor_counts:
+		tree = fakeHardware.FakeW1Tree(sensor_count)
+		try:
+			plugin = create_plugin(tree)
+			plugin.getPiPowerValues()
+			payload = json.dumps(plugin._plugin_manager.lastMessage, separators=(",", ":"))
+			results.append(dict(sensors=sensor_count, payloadBytes=len(payload.encode("utf-8"))))
+		finally:
+			tree.remove()
+
+	return results
+
+
+# Run sweeps through the plugin (statistics, derived channels, events and the sample
+# recorder) for a number of simulated days at timerInterval and measure how much memory
+# is retained.
+#
+# The plugin's clocks are simulated so the sweeps cover the days and the statistics
+# windows fill and expire as they would. The growth is the slope of a line fitted to
+# the memory at each checkpoint after the warm up, so a one off allocation doesn't
+# count as growth per day.
+def benchmark_memory_growth(days, sensor_count):
+	tree = fakeHardware.FakeW1Tree(sensor_count)
+	samples_folder = tempfile.mkdtemp(prefix="pipower-samples-")
+	simulated = fakeHardware.SimulatedClock(clock(), time.time())
+	plugin = None
+	try:
+		plugin = create_plugin(tree)
+		settings = plugin._settings
+		plugin._sampleRecorder = SampleRecorder(
+			samples_folder,
+			True,
+			settings.get_float(["sampleRecorder", "interval"]),
+			settings.get_int(["sampleRecorder", "retentionDays"]))
+
+		interval = settings.get_float(["timerInterval"])
+		warm_up_sweeps = int(MEMORY_WARM_UP_SECONDS / interval)
+		sweeps = max(MEMORY_CHECKPOINTS, int(days * SECONDS_PER_DAY / interval))
+
+		simulated.install()
+
+		def sweep():
+			simulated.advance(interval)
+			plugin.getPiPowerValues()
+
+		# Warm up until the statistics windows are full.
+		for i in range(warm_up_sweeps):
+			sweep()
+
+		gc.collect()
+		started_memory = current_memory()
+		started_days = simulated.elapsed / SECONDS_PER_DAY
+		checkpoint_days = []
+		samples = []
+
+		for checkpoint in range(MEMORY_CHECKPOINTS):
+			for i in range(sweeps // MEMORY_CHECKPOINTS):
+				sweep()
+			gc.collect()
+			checkpoint_days.append(simulated.elapsed / SECONDS_PER_DAY - started_days)
+			samples.append(current_memory() - started_memory)
+
+		return dict(
+			sensors=sensor_count,
+			simulatedDays=round(checkpoint_days[-1], 4),
+			warmUpSweeps=warm_up_sweeps,
+			sweeps=sweeps,
+			recordedRows=plugin._sampleRecorder.rows,
+			method="tracemalloc" if tracemalloc else "maxrss",
+			growthBytes=samples[-1],
+			growthBytesPerDay=int(slope(checkpoint_days, samples)),
+			checkpointBytes=samples,
+		)
+	finally:
+		simulated.remove()
+		if plugin is not None and plugin._sampleRecorder:
+			plugin._sampleRecorder.close()
+		tree.remove()
+		shutil.rmtree(samples_folder, ignore_errors=True)
+
+
+# Least squares slope of y against x.
+def slope(x, y):
+	count = float(len(x))
+	mean_x = sum(x) / count
+	mean_y = sum(y) / count
+	variance = sum((value - mean_x) ** 2 for value in x)
+	if not variance:
+		return 0.0
+	return sum((x[i] - mean_x) * (y[i] - mean_y) for i in range(len(x))) / variance
+
+
+def current_memory():
+	if tracemalloc:
+		return tracemalloc.get_traced_memory()[0]
+
+	import resource
+	# kB on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# ===========================================
+# Comparison
+# ===========================================
+def flatten(value, prefix=""):
+	values = dict()
+	if isinstance(value, dict):
+		for key, item in value.items():
+			values.update(flatten(item, prefix + "." + key if prefix else key))
+	elif isinstance(value, list):
+		for index, item in enumerate(value):
+			# Identify list entries by their parameter where there is one.
+			label = index
+			for key in ("sensors", "clients"):
+				if isinstance(item, dict) and key in item:
+					label = "{0}={1}".format(key, item[key])
+			values.update(flatten(item, "{0}[{1}]".format(prefix, label)))
+	elif isinstance(value, (int, float)) and not isinstance(value, bool):
+		values[prefix] = value
+	return values
+
+
+# Print the change of each metric from a previous run and
+# return the metrics that got worse by more than the threshold (%).
+def compare(baseline, results, threshold):
+	old_values = flatten(baseline["results"])
+	new_values = flatten(results["results"])
+	regressions = []
+
+	for key in sorted(new_values):
+		if key not in old_values or not key.endswith(LOWER_IS_BETTER):
+			continue
+
+		old_value = old_values[key]
+		new_value = new_values[key]
+		if old_value == 0:
+			continue
+
+		change = (new_value - old_value) * 100.0 / old_value
+		flag = ""
+		if change > threshold:
+			flag = "  REGRESSION"
+			regressions.append(key)
+		print("{0:<60} {1:>12} -> {2:>12} ({3:+.1f}%){4}".format(key, old_value, new_value, change, flag), file=sys.stderr)
+
+	return regressions
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark the Pi Power plugin against fake hardware.")
+	parser.add_argument("--sensors", default="1,2,4,8,16", help="Comma separated temperature sensor counts for the sweep benchmarks.")
+	parser.add_argument("--iterations", type=int, default=50, help="Sweeps per sensor count.")
+	parser.add_argument("--clients", default="1,4,16", help="Comma separated concurrent API client counts.")
+	parser.add_argument("--requests", type=int, default=20, help="Requests per API client.")
+	parser.add_argument("--days", type=float, default=0.05, help="Simulated days of sweeps for the memory benchmark (after an hour's warm up).")
+	parser.add_argument("--output", help="Write the JSON results to this file (default: stdout).")
+	parser.add_argument("--compare", help="Previous JSON results to compare against.")
+	parser.add_argument("--threshold", type=float, default=10.0, help="Percentage increase reported as a regression.")
+	args = parser.parse_args(argv)
+
+	logging.basicConfig(level=logging.WARNING)
+	# The hat logs every read at INFO.
+	logging.disable(logging.INFO)
+	if tracemalloc:
+		tracemalloc.start()
+
+	sensor_counts = [int(count) for count in args.sensors.split(",")]
+	client_counts = [int(count) for count in args.clients.split(",")]
+
+	results = dict(
+		schemaVersion=RESULTS_SCHEMA_VERSION,
+		createdAt=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+		python=platform.python_version(),
+		platform=platform.platform(),
+		machine=platform.machine(),
+		arguments=vars(args),
+		results=dict(
+			sweepLatency=benchmark_sweep_latency(sensor_counts, args.iterations),
+			apiLatency=benchmark_api_latency(client_counts, args.requests, sensor_counts[-1]),
+			payloadSize=benchmark_payload_size(sensor_counts),
+			memoryGrowth=benchmark_memory_growth(args.days, sensor_counts[-1]),
+		),
+	)
+
+	output = json.dumps(results, indent=2, sort_keys=True)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(output)
+	else:
+		print(output)
+
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		if compare(baseline, results, args.threshold):
+			return 1
+
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,38 +1,214 @@
+# coding=utf-8
+from __future__ import absolute_import, print_function
 
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+# Command line logger for the Pi Power Hat, for commissioning without OctoPrint.
+#
+# Installed as the "pipower-logger" console script:
+#
+#   pipower-logger                                  # All 1-Wire sensors to stdout as CSV every second.
+#   pipower-logger --power --light --interval 0.5   # Include INA219 power and TSL2561 lux.
+#   pipower-logger --format jsonl --output enclosure.jsonl --max-bytes 1048576 --backup-count 5
+
+import argparse
+import json
 import os
+import sys
 import time
+from multiprocessing.pool import ThreadPool
+
+from .ina219Profiles import SHUNT_OHMS
+from .sweepMonitor import clock
+from .w1Sensors import W1_DEVICES_DIR, discover_sensors, read_temperature, sensor_path
+
+POWER_COLUMNS = ["voltage", "currentMilliAmps", "powerWatts"]
+
+
+# ===========================================
+# Power and light
+# ===========================================
+def open_power_monitor():
+	from ina219 import INA219
+	ina = INA219(SHUNT_OHMS)
+	ina.configure()
+	return ina
+
+
+def read_power(ina):
+	try:
+		voltage = ina.voltage()
+		current = ina.current()
+		# Power is in mW, convert it to Watts
+		power = ina.power() / 1000
+		return [round(voltage, 2), round(current, 2), round(power, 2)]
+	except Exception:
+		return [None, None, None]
+
+
+def open_light_sensor():
+	from tsl2561 import TSL2561
+	from tsl2561.constants import TSL2561_ADDR_LOW
+	return TSL2561(address=TSL2561_ADDR_LOW)
+
+
+def read_light_level(tsl2561):
+	try:
+		return tsl2561.lux()
+	except Exception:
+		return None
+
+
+# ===========================================
+# Output
+# ===========================================
+
+# Writes lines to stdout or to a file that is rotated when it gets
+# too big (file, file.1, file.2...). The header (CSV) is written
+# at the start of each file.
+class RotatingWriter(object):
+	def __init__(self, path, max_bytes, backup_count, header):
+		self._path = path
+		self._maxBytes = max_bytes
+		self._backupCount = backup_count
+		self._header = header
+		self._file = None
+		self._open()
+
+	def _open(self):
+		if not self._path:
+			self._file = sys.stdout
+		else:
+			self._file = open(self._path, "a")
+
+		# Only write the header at the start of a new file.
+		if self._header and (self._file is sys.stdout or self._file.tell() == 0):
+			self._file.write(self._header + "\n")
+
+	def _rotate(self):
+		self._file.close()
+		for index in range(self._backupCount - 1, 0, -1):
+			source = "{0}.{1}".format(self._path, index)
+			if os.path.exists(source):
+				os.rename(source, "{0}.{1}".format(self._path, index + 1))
+
+		if self._backupCount > 0:
+			os.rename(self._path, self._path + ".1")
+		else:
+			os.remove(self._path)
+		self._open()
+
+	def write(self, line):
+		self._file.write(line + "\n")
+		self._file.flush()
+
+		if self._path and self._maxBytes and self._file.tell() >= self._maxBytes:
+			self._rotate()
+
+	def close(self):
+		if self._file is not sys.stdout:
+			self._file.close()
+
+
+def format_csv(values):
+	cells = []
+	for value in values:
+		if value is None:
+			cells.append("")
+		else:
+			cells.append(str(value))
+	return ",".join(cells)
+
+
+# ===========================================
+# Logger
+# ===========================================
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Log Pi Power Hat temperatures, power and light levels.")
+	parser.add_argument("--interval", type=float, default=1.0, help="Seconds between sweeps (default: 1).")
+	parser.add_argument("--count", type=int, default=0, help="Number of sweeps to log (default: run until stopped).")
+	parser.add_argument("--sensors", help="Comma separated 1-Wire sensor ids (default: all found).")
+	parser.add_argument("--devices-dir", default=W1_DEVICES_DIR, help="1-Wire devices directory.")
+	parser.add_argument("--power", action="store_true", help="Include INA219 voltage, current and power.")
+	parser.add_argument("--light", action="store_true", help="Include TSL2561 light level (lux).")
+	parser.add_argument("--format", choices=["csv", "jsonl"], default="csv", help="Output format.")
+	parser.add_argument("--output", help="File to write to (default: stdout).")
+	parser.add_argument("--max-bytes", type=int, default=0, help="Rotate the output file at this size (default: never).")
+	parser.add_argument("--backup-count", type=int, default=5, help="Number of rotated files to keep.")
+	args = parser.parse_args(argv)
+
+	if args.sensors:
+		sensors = [sensor.strip() for sensor in args.sensors.split(",") if sensor.strip()]
+	else:
+		sensors = discover_sensors(args.devices_dir)
+
+	if not sensors and not args.power and not args.light:
+		print("No temperature sensors found in {0}.".format(args.devices_dir), file=sys.stderr)
+		return 1
+
+	print("Sensors: {0}".format(", ".join(sensors) or "none"), file=sys.stderr)
+
+	ina = open_power_monitor() if args.power else None
+	tsl2561 = open_light_sensor() if args.light else None
+
+	columns = ["timestamp"] + sensors
+	if ina:
+		columns += POWER_COLUMNS
+	if tsl2561:
+		columns.append("lightLevel")
+	columns.append("sweepMs")
+
+	header = ",".join(columns) if args.format == "csv" else None
+	writer = RotatingWriter(args.output, args.max_bytes, args.backup_count, header)
+
+	# Read all the sensors at once rather than one after the other.
+	paths = [sensor_path(args.devices_dir, sensor_id) for sensor_id in sensors]
+	pool = ThreadPool(max(1, len(sensors)))
 
-os.system('modprobe w1-gpio')
-os.system('modprobe w1-therm')
+	sweeps = 0
+	next_sweep = clock()
 
-temp_sensors = [('air','28-0000070e4078'), ('pcb','28-000007538f5b')]
+	try:
+		while not args.count or sweeps < args.count:
+			timestamp = time.time()
+			started = clock()
 
-def temp_raw(sensor):
+			temperatures = pool.map(read_temperature, paths)
+			power = read_power(ina) if ina else []
+			light = [read_light_level(tsl2561)] if tsl2561 else []
 
-    sensorPath = "/sys/bus/w1/devices/{}/w1_slave".format(sensor[1])
-    f = open(sensorPath, 'r')
-    lines = f.readlines()
-    f.close()
-    return lines
+			sweepMs = round((clock() - started) * 1000, 1)
 
-def read_temp(sensor):
+			if args.format == "csv":
+				timestampText = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(timestamp)) + ".{0:03d}".format(int(timestamp * 1000) % 1000)
+				writer.write(format_csv([timestampText] + temperatures + power + light + [sweepMs]))
+			else:
+				record = dict(timestamp=round(timestamp, 3), temperatures=dict(zip(sensors, temperatures)), sweepMs=sweepMs)
+				if ina:
+					record.update(zip(POWER_COLUMNS, power))
+				if tsl2561:
+					record["lightLevel"] = light[0]
+				writer.write(json.dumps(record, sort_keys=True))
 
-    lines = temp_raw(sensor)
-    while lines[0].strip()[-3:] != 'YES':
-        time.sleep(0.2)
-        lines = temp_raw(sensor)
+			sweeps += 1
 
-    temp_output = lines[1].find('t=')
+			# Keep to a fixed rate, skipping sweeps if reading took too long.
+			next_sweep += args.interval
+			now = clock()
+			if next_sweep < now:
+				next_sweep = now
+			elif not args.count or sweeps < args.count:
+				time.sleep(next_sweep - now)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		pool.close()
+		writer.close()
 
-    if temp_output != -1:
-        temp_string = lines[1].strip()[temp_output+2:]
-        temp_c = float(temp_string) / 1000.0
-        return round(temp_c,1)
+	return 0
 
-while True:
-        message = ""
-        for sensor in temp_sensors:
-                message += "{}={},  ".format(sensor[0], read_temp(sensor))
 
-        print (message)
-        time.sleep(1)
+if __name__ == "__main__":
+	sys.exit(main())
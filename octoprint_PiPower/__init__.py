@@ -7,18 +7,32 @@ __copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of th
 
 import octoprint.plugin
 from octoprint.util import RepeatedTimer
+from octoprint.events import Events
 
 import flask
 
 import sys
 import os
 import time
+import threading
 
 import logging
 import logging.handlers
 
 from .mockPiPowerHat import MockPiPowerHat
 from .piPowerHat import PiPowerHat
+from .sweepMonitor import SweepMonitor, clock
+from .eventPublisher import EventPublisher
+from .acquisitionPlan import build_acquisition_plan, FAN_PWM_PINS, GPIO_PINS, GPIO_MODE_DISABLED, GPIO_MODE_OUTPUT
+from .safetyWatchdog import SafetyWatchdog, SafetyActions, create_rules, run_self_test
+from .undervoltageMonitor import UndervoltageMonitor, EVENT_UNDERVOLTAGE, AUTOMATION_EVENT_UNDERVOLTAGE
+from .metricStatistics import StatisticsEngine
+from .derivedChannels import EnergyMeter
+from .powerStream import PowerStream
+from .sampleRecorder import SampleRecorder
+
+# Measured values (from the payload) to keep statistics for, as well as each temperature sensor.
+STATISTICS_METRICS = ["voltage", "currentMilliAmps", "powerWatts", "lightLevel"]
 
 # TODO: Include events so that the fans can be switched on
 # when a print is finished.
@@ -26,12 +40,28 @@ class PipowerPlugin(octoprint.plugin.StartupPlugin,
 					octoprint.plugin.SettingsPlugin,
                     octoprint.plugin.AssetPlugin,
                     octoprint.plugin.TemplatePlugin,
-                    octoprint.plugin.SimpleApiPlugin):
+                    octoprint.plugin.SimpleApiPlugin,
+                    octoprint.plugin.ShutdownPlugin,
+                    octoprint.plugin.EventHandlerPlugin):
 
 	def __init__(self):
-		# TODO: Dispose of these when we exit.
+		# TODO: Dispose of this when we exit.
 		self._readPiPowerValuesTimer = None
-		self._publishPiPowerValuesTimer = None
+		self._sweepMonitor = None
+		self._eventPublisher = None
+		# What to read each sweep, rebuilt when the settings are saved.
+		self._acquisitionPlan = None
+		self._safetyWatchdog = None
+		self._undervoltageMonitor = None
+		self._statistics = None
+		self._powerStream = None
+		self._sampleRecorder = None
+		# Energy used since startup, available to derived channels.
+		self._energyMeter = EnergyMeter()
+
+		# Only allow one sweep of the hat at a time (timer and API requests)
+		self._sweepLock = threading.Lock()
+		self._lastPiPowerValues = None
 
 		if sys.platform == "linux2":
 			self._powerHat = PiPowerHat();
@@ -45,12 +75,42 @@ class PipowerPlugin(octoprint.plugin.StartupPlugin,
 		timerInterval = self._settings.get(["timerInterval"])
 		eventTimerInterval = self._settings.get(["eventTimerInterval"])
 		self.start_timer(timerInterval, eventTimerInterval)
+		self.start_safety_watchdog()
+		self.start_undervoltage_monitor()
+
+	def on_shutdown(self):
+		self.stop_safety_watchdog()
+		self.stop_undervoltage_monitor()
+		if self._sampleRecorder:
+			self._sampleRecorder.close()
+
+	##~~ EventHandlerPlugin mixin
+
+	def on_event(self, event, payload):
+		if not self._statistics:
+			return
+
+		if event == Events.PRINT_STARTED:
+			self._statistics.start_print()
+		elif event in [Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED]:
+			self._statistics.stop_print()
 
 	def initialize(self):
 		self._logger.setLevel(logging.DEBUG)
 
 		# Do we have settings at this time.
-		self._powerHat.initialize(self._settings);
+		self._acquisitionPlan = build_acquisition_plan(self._settings)
+		self._powerHat.initialize(self._settings, self._acquisitionPlan);
+		self._statistics = StatisticsEngine(self._settings.get_float(["statisticsEwmaTimeConstant"]))
+		self._powerStream = PowerStream(
+			self._powerHat.read_power_sample,
+			self.get_power_stream_interval(),
+			self._settings.get_int(["powerStream", "maxClients"]))
+		self._sampleRecorder = SampleRecorder(
+			os.path.join(self.get_plugin_data_folder(), "samples"),
+			self._settings.get_boolean(["sampleRecorder", "enabled"]),
+			self._settings.get_float(["sampleRecorder", "interval"]),
+			self._settings.get_int(["sampleRecorder", "retentionDays"]))
 		self._logger.info("Pi Power Plugin [%s] initialized..."%self._identifier)
 
 	##~~ SettingsPlugin mixin
@@ -85,6 +145,8 @@ class PipowerPlugin(octoprint.plugin.StartupPlugin,
 			],
 			pwmFrequency=200,
 			lightSensorCaption = "Light Level",
+			# TSL2561 integration time (ms): 13, 101, 402 or auto to adapt to the light level.
+			lightSensorIntegrationTime = "auto",
 			gpioOptions = [
 				dict(
 					pin=16,  #BCM Number
@@ -117,8 +179,53 @@ class PipowerPlugin(octoprint.plugin.StartupPlugin,
 					mode=4,
 				),
 			],
+			# INA219 measurement profile: fast, precise or auto (see ina219Profiles.py)
+			powerMeasurementProfile="auto",
 			timerInterval = 2.0,
+			# Log a warning when a sweep takes longer than this (seconds)
+			slowSweepThreshold = 1.5,
+			# Heartbeat: PiPowerMeasured is published at least this often (seconds)
 			eventTimerInterval=30.0,
+			# PiPowerMeasured/PiPowerTemperatureChanged are published when a value
+			# changes by at least this much since it was last published.
+			eventThresholds = dict(
+				temperature=0.5,
+				voltage=0.2,
+				currentMilliAmps=100.0,
+				powerWatts=1.0,
+				lightLevel=10.0,
+			),
+			# Each event is limited to this many per second, with bursts of up to eventBurst.
+			eventRateLimit=1.0,
+			eventBurst=5,
+			# Time constant (seconds) of the exponentially weighted average in the statistics.
+			statisticsEwmaTimeConstant=60.0,
+			# Values calculated from the measured channels (see derivedChannels.py).
+			# {...} references voltage, currentMilliAmps, powerWatts, lightLevel, energyWattHours,
+			# a temperature sensor caption or another derived channel's name.
+			derivedChannels = [
+				dict(enabled=False, name="airDelta", caption="Internal - External Air", unit="C", expression="{Internal Air} - {External Air}", eventThreshold=0.5),
+				dict(enabled=False, name="psuPcbCalibrated", caption="PSU PCB (calibrated)", unit="C", expression="{PSU PCB} - 1.5", eventThreshold=None),
+				dict(enabled=False, name="energyCost", caption="Energy Cost", unit="GBP", expression="{energyWattHours} / 1000 * 0.15", eventThreshold=None),
+			],
+			# Independent of the timer, checks the current every interval (seconds)
+			# and the temperatures from each sweep. Trips once until reset.
+			safetyWatchdog = dict(
+				enabled=False,
+				interval=0.1,
+				maxCurrentMilliAmps=2500.0,
+				# Degrees C per minute over the window (seconds)
+				maxTemperatureRise=5.0,
+				temperatureRiseWindow=60.0,
+				# Seconds without a reading from a sensor in use (or the INA219)
+				sensorLostTimeout=10.0,
+				# BCM pin for a relay to switch off the printer (-1 for none) and the value to set it to.
+				relayPin=-1,
+				relayTripValue=0,
+				maxFans=True,
+				# none, pause or emergencyStop (M112)
+				printerAction="pause",
+			),
 			automationOptions = [
 				# Fan speed will go to default speed, then be increased to the maximum fanSpeed
 				# from the matching automation options
@@ -130,6 +237,8 @@ class PipowerPlugin(octoprint.plugin.StartupPlugin,
 				# Custom event from Pi Power Plugin (ohh, that's us!)
 				dict(enabled=True, name="Above Temperature", eventName="AboveTemperature", action="Set Fan Speed", device="Fan 0", setValue=60, timer=3600, value=50),
 				dict(enabled=True, name="Above LightLevel", eventName="AboveLightLevel", action="Set Fan Speed", device="Fan 1", setValue=60, timer=60, value=50),
+				# Printer command is "pause" or G-code
+				dict(enabled=False, name="Undervoltage", eventName="Undervoltage", action="Send Printer Command", device="Printer", setValue="pause", timer=0),
 			],
 			fanSpeedOptions=[0, 20, 40, 60, 80, 100],
 			# Fan: Set speed (0==off, 20-100=on)
@@ -137,13 +246,94 @@ class PipowerPlugin(octoprint.plugin.StartupPlugin,
 			# Printer options: Pause (e.g. filament change)
 			# OctoPrint option: Fire an event (PrintStarted, PrintDone" etc.
 			actionOptions=["Set Fan Speed", "Set GPIO Pin", "Send Printer Command", "Raise OctoPrint Event"],
-			automationEventOptions = ["OctoPrint: Print Started Event", "PrintDone", "PrintFailed", "AboveTemperature", "AboveLightLevel", "BelowLightLevel"]
+			automationEventOptions = ["OctoPrint: Print Started Event", "PrintDone", "PrintFailed", "AboveTemperature", "AboveLightLevel", "BelowLightLevel", "Undervoltage"],
+			# Samples the bus voltage every sampleInterval (seconds), independently of the timer.
+			# Fires PiPowerUndervoltage and runs the Undervoltage automation when the
+			# voltage stays below the threshold for holdTime (seconds).
+			undervoltage = dict(
+				enabled=False,
+				threshold=11.0,
+				holdTime=0.05,
+				sampleInterval=0.01,
+			),
+			# INA219 voltage/current streamed to /plugin/pipower/stream (Server-Sent Events).
+			# Only sampled while a client is connected.
+			powerStream = dict(
+				sampleInterval=0.005,
+				maxClients=4,
+			),
+			# Sweep values recorded to the plugin's data folder for /plugin/pipower/export,
+			# at most one row every interval (seconds), kept for retentionDays.
+			sampleRecorder = dict(
+				enabled=True,
+				interval=10.0,
+				retentionDays=30,
+			),
 			)
 
+	def get_settings_version(self):
+		return 1
+
+	def on_settings_migrate(self, target, current):
+		if current is None or current < 1:
+			# Saved automation options replace the defaults, add the Undervoltage automation.
+			automationOptions = self._settings.get(["automationOptions"])
+			if not [option for option in automationOptions if option["eventName"] == AUTOMATION_EVENT_UNDERVOLTAGE]:
+				defaults = self.get_settings_defaults()["automationOptions"]
+				automationOptions.extend([option for option in defaults if option["eventName"] == AUTOMATION_EVENT_UNDERVOLTAGE])
+				self._settings.set(["automationOptions"], automationOptions)
+
+	def on_settings_save(self, data):
+		octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+
+		previousPlan = self._acquisitionPlan
+		plan = build_acquisition_plan(self._settings)
+
+		# Wait for any sweep in progress before reconfiguring the hardware.
+		with self._sweepLock:
+			self._acquisitionPlan = plan
+			self._powerHat.setup_gpio_pins(plan)
+
+			if plan.powerProfile is not self._powerHat.get_power_profile():
+				self._powerHat.configure_power_monitor(plan.powerProfile)
+				self.check_power_profile()
+
+			if plan.lightSensorMode != previousPlan.lightSensorMode:
+				self._powerHat.set_light_sensor_mode(plan.lightSensorMode)
+
+		if self._eventPublisher:
+			self._eventPublisher.configure(
+				self._settings.get(["eventThresholds"]),
+				self._settings.get_float(["eventTimerInterval"]),
+				self._settings.get_float(["eventRateLimit"]),
+				self._settings.get_int(["eventBurst"]))
+
+		if self._statistics:
+			self._statistics.configure(self._settings.get_float(["statisticsEwmaTimeConstant"]))
+
+		self._powerStream.configure(
+			self.get_power_stream_interval(),
+			self._settings.get_int(["powerStream", "maxClients"]))
+
+		self._sampleRecorder.configure(
+			self._settings.get_boolean(["sampleRecorder", "enabled"]),
+			self._settings.get_float(["sampleRecorder", "interval"]),
+			self._settings.get_int(["sampleRecorder", "retentionDays"]))
+
+		if self._readPiPowerValuesTimer:
+			# The new watchdog keeps a trip (and the relay state), only a reset clears it.
+			previousWatchdog = self._safetyWatchdog
+			self.stop_safety_watchdog()
+			self.start_safety_watchdog(previousWatchdog)
+			self.stop_undervoltage_monitor()
+			self.start_undervoltage_monitor()
+
+		self._logger.info("Settings saved. Acquisition plan rebuilt.")
+
 	def get_template_configs(self):
 		return [
 			#dict(type="navbar", custom_bindings=False),
-			dict(type="settings", custom_bindings=False),
+			dict(type="settings", custom_bindings=True),
 			dict(type="tab", name="Pi Power")
 		]
 
@@ -156,6 +346,29 @@ class PipowerPlugin(octoprint.plugin.StartupPlugin,
 			less=["less/PiPower.less"]
 		)
 
+	##~~ Routes hook
+
+	# Streaming endpoints need a Tornado handler, Flask responses are buffered.
+	# Imported here so the plugin still loads on older OctoPrint (before 1.4,
+	# no permissions) or Tornado versions, without the endpoints.
+	def get_routes(self, server_routes, *args, **kwargs):
+		try:
+			from octoprint.server import app
+			from octoprint.server.util.flask import permission_validator
+			from octoprint.server.util.tornado import access_validation_factory
+			from octoprint.access.permissions import Permissions
+			from .streamHandlers import PowerStreamHandler, SampleExportHandler
+		except ImportError as e:
+			self._logger.warn("Power stream and export not available: {0}".format(e))
+			return []
+
+		access_validation = access_validation_factory(app, permission_validator, Permissions.STATUS)
+
+		return [
+			(r"/stream", PowerStreamHandler, dict(stream=self._powerStream, access_validation=access_validation)),
+			(r"/export", SampleExportHandler, dict(recorder=self._sampleRecorder, access_validation=access_validation)),
+		]
+
 	##~~ Softwareupdate hook
 
 	def get_update_information(self):
@@ -185,6 +398,8 @@ class PipowerPlugin(octoprint.plugin.StartupPlugin,
 			setFanState=["fanId", "state"], # On/Off
 			setFanSpeed=["fanId", "speed"],
 			setDisplayBacklight=["state"],
+			resetSafetyWatchdog=[],
+			safetySelfTest=[],
 		)
 
 	# API POST command
@@ -207,6 +422,13 @@ class PipowerPlugin(octoprint.plugin.StartupPlugin,
 			self._powerHat.set_fan_speed(data['fanId'], data['speed'])
 		elif command == "setDisplayBacklight":
 			self._logger.info("setDisplayBacklight called. Options: {Options}".format(**data))
+		elif command == "resetSafetyWatchdog":
+			self._logger.info("resetSafetyWatchdog called.")
+			if self._safetyWatchdog:
+				self._safetyWatchdog.reset()
+		elif command == "safetySelfTest":
+			self._logger.info("safetySelfTest called.")
+			return flask.jsonify(results=self.run_safety_self_test())
 
 		# Update the power values measured after the change.
 		self.getPiPowerValues()
@@ -217,39 +439,298 @@ class PipowerPlugin(octoprint.plugin.StartupPlugin,
 	def on_api_get(self, request):
 		self._logger.info("API Request: {}".format(request))
 		sensorData = self.getPiPowerValues()
+		if not sensorData:
+			return flask.make_response("Failed to read the Pi Power values.", 503)
 		return flask.jsonify(sensorData)
 
 	def start_timer(self, interval, event_timer_interval):
-		self._readPiPowerValuesTimer = RepeatedTimer(interval, self.getPiPowerValues, None, None, True)
+		slowSweepThreshold = self._settings.get_float(["slowSweepThreshold"])
+		self._sweepMonitor = SweepMonitor(interval, slowSweepThreshold)
+
+		# Use the monitor for the interval so sweeps run to a fixed schedule
+		# and skip ticks if they overrun.
+		self._readPiPowerValuesTimer = RepeatedTimer(self._sweepMonitor.next_interval, self.on_sweep_timer, None, None, True)
 		self._readPiPowerValuesTimer.start()
 		self._logger.info("Started timer. Interval: {0}s".format(interval))
+		self.check_power_profile()
+
+		self._eventPublisher = self.create_event_publisher()
+		self._logger.info("Started event publisher. Heartbeat: {0}s".format(event_timer_interval))
+
+	# Warn if the INA219 can't produce a new reading every sweep with the profile selected.
+	def check_power_profile(self):
+		profile = self._acquisitionPlan.powerProfile
+		interval = self._settings.get_float(["timerInterval"])
+		if profile.conversionTime > interval:
+			self._logger.warn("INA219 profile {0} takes {1:.0f}ms per reading, longer than the {2}s timer interval.".format(
+				profile.name, profile.conversionTime * 1000, interval))
+
+	def create_event_publisher(self):
+		return EventPublisher(
+			self._event_bus.fire,
+			self._settings.get(["eventThresholds"]),
+			self._settings.get_float(["eventTimerInterval"]),
+			self._settings.get_float(["eventRateLimit"]),
+			self._settings.get_int(["eventBurst"]))
+
+
+	def get_power_stream_interval(self):
+		# Sampling faster than the INA219 converts would just repeat readings.
+		interval = self._settings.get_float(["powerStream", "sampleInterval"])
+		return max(interval, self._acquisitionPlan.powerProfile.conversionTime)
+
+	def get_safety_watchdog_interval(self):
+		# No point checking faster than the INA219 produces new readings.
+		interval = self._settings.get_float(["safetyWatchdog", "interval"])
+		return max(interval, self._acquisitionPlan.powerProfile.conversionTime)
+
+	# previous: the watchdog being replaced (settings saved), it's trip and temperature
+	# history are kept so only the reset command clears a trip.
+	def start_safety_watchdog(self, previous=None):
+		config = self._settings.get(["safetyWatchdog"])
+		if not config["enabled"]:
+			self._logger.info("Safety watchdog disabled.")
+			return
+
+		relayPin = int(config["relayPin"])
+		tripped = previous is not None and previous.is_tripped()
+		# Once tripped the relay pin is already set up (and switched).
+		if relayPin >= 0 and not tripped and not self.setup_safety_relay(relayPin, int(config["relayTripValue"])):
+			self._logger.error("Safety watchdog NOT started. Relay pin {0} can't be used.".format(relayPin))
+			return
+
+		actions = SafetyActions(
+			self._powerHat,
+			self._printer,
+			[fan.fanId for fan in self._acquisitionPlan.fans],
+			relayPin if relayPin >= 0 else None,
+			int(config["relayTripValue"]),
+			config["maxFans"],
+			config["printerAction"])
+
+		self._safetyWatchdog = SafetyWatchdog(
+			self._powerHat,
+			create_rules(config),
+			actions,
+			self.get_safety_watchdog_interval(),
+			self._acquisitionPlan.captions,
+			self._event_bus.fire)
+		if previous is not None:
+			self._safetyWatchdog.inherit(previous)
+		self._safetyWatchdog.start()
+
+	# The relay pin must be an output. Unless it's an output in the GPIO options it's set
+	# up here, in the not tripped state. Returns False if the pin can't be used.
+	def setup_safety_relay(self, pin, trip_value):
+		if pin in FAN_PWM_PINS:
+			self._logger.error("Safety relay pin {0} is a fan PWM pin.".format(pin))
+			return False
+		if pin not in GPIO_PINS:
+			self._logger.error("Safety relay pin {0} is not a usable GPIO pin.".format(pin))
+			return False
+
+		for gpio_pin in self._acquisitionPlan.gpioPins:
+			if gpio_pin.pin != pin or gpio_pin.mode == GPIO_MODE_DISABLED:
+				continue
+			if gpio_pin.mode == GPIO_MODE_OUTPUT:
+				return True
+			self._logger.error("Safety relay pin {0} is configured as an input ({1}).".format(pin, gpio_pin.caption))
+			return False
 
-		self._publishPiPowerValuesTimer = RepeatedTimer(event_timer_interval, self.publish_pi_power_event, None, None, True)
-		self._publishPiPowerValuesTimer .start()
-		self._logger.info("Started event publisher timer. Interval: {0}s".format(event_timer_interval))
+		try:
+			self._powerHat.setup_output_pin(pin, 0 if trip_value else 1)
+		except Exception as e:
+			self._logger.error("Failed to set up safety relay pin {0}: {1}".format(pin, e))
+			return False
+		return True
+
+	def stop_safety_watchdog(self):
+		if self._safetyWatchdog:
+			self._safetyWatchdog.stop()
+			self._safetyWatchdog = None
+
+	# Check the rules trip against the mock hat, no actions are performed.
+	def run_safety_self_test(self):
+		results = run_self_test(MockPiPowerHat(), self._settings.get(["safetyWatchdog"]), self.get_safety_watchdog_interval())
+		for result in results:
+			self._logger.info("Safety self test {fault}: {passed}. Reaction: {reactionMs}ms".format(**result))
+		return results
+
+	def start_undervoltage_monitor(self):
+		config = self._settings.get(["undervoltage"])
+		if not config["enabled"]:
+			self._logger.info("Undervoltage monitor disabled.")
+			return
+
+		# No point sampling faster than the INA219 converts.
+		interval = max(float(config["sampleInterval"]), self._acquisitionPlan.powerProfile.conversionTime)
+
+		self._undervoltageMonitor = UndervoltageMonitor(
+			self._powerHat.read_bus_voltage,
+			config["threshold"],
+			config["holdTime"],
+			interval,
+			self.on_undervoltage)
+		self._undervoltageMonitor.start()
+
+	def stop_undervoltage_monitor(self):
+		if self._undervoltageMonitor:
+			self._undervoltageMonitor.stop()
+			self._undervoltageMonitor = None
+
+	# Called from the monitor's thread when a sag has lasted for the hold time.
+	def on_undervoltage(self, sag):
+		self.run_automations(AUTOMATION_EVENT_UNDERVOLTAGE)
+
+		payload = sag.to_dict()
+		payload["threshold"] = self._settings.get_float(["undervoltage", "threshold"])
+		self._event_bus.fire(EVENT_UNDERVOLTAGE, payload)
+
+	def run_automations(self, event_name):
+		for option in self._settings.get(["automationOptions"]):
+			if option["enabled"] and option["eventName"] == event_name:
+				self.run_automation_action(option)
+
+	def run_automation_action(self, option):
+		if option["action"] == "Send Printer Command":
+			command = str(option["setValue"]).strip()
+			self._logger.warn("Automation {0}: sending {1}".format(option["name"], command))
+			if command.lower() == "pause":
+				self._printer.pause_print()
+			else:
+				self._printer.commands(command)
+		else:
+			self._logger.warn("Automation action {0} ({1}) is not supported.".format(option["action"], option["name"]))
 
+	def on_sweep_timer(self):
+		self._sweepMonitor.tick_started()
+		self.getPiPowerValues()
 
 	def getPiPowerValues(self):
 		#self._logger.debug("Getting values from PiPower...")
 
+		# If a sweep is already running (e.g. an API request during a timer sweep)
+		# don't queue another one behind it, use the values it's about to publish.
+		if not self._sweepLock.acquire(False):
+			if self._lastPiPowerValues is not None:
+				self._logger.debug("Sweep already in progress. Using last values.")
+				return self._lastPiPowerValues
+
+			# No values yet (e.g. the first sweep), wait for the sweep in progress.
+			self._logger.debug("Sweep already in progress. Waiting for the first values.")
+			self._sweepLock.acquire()
+			if self._lastPiPowerValues is not None:
+				self._sweepLock.release()
+				return self._lastPiPowerValues
+
 		try:
-			pluginData = self._powerHat.getPiPowerValues(self._settings)
+			sweepStarted = clock()
+			pluginData = self._powerHat.getPiPowerValues(self._acquisitionPlan)
+
+			if self._sweepMonitor:
+				self._sweepMonitor.record_sweep(clock() - sweepStarted, self._powerHat.get_stage_timings())
+				if pluginData:
+					pluginData["sweepStatistics"] = self._sweepMonitor.get_statistics()
+
+			if pluginData:
+				self.evaluate_derived_channels(pluginData)
+
+			if self._statistics and pluginData:
+				pluginData["statistics"] = self.update_statistics(pluginData)
+
+			if self._safetyWatchdog and pluginData:
+				self._safetyWatchdog.update_temperatures(pluginData["temperatures"])
+				pluginData["safety"] = self._safetyWatchdog.get_state()
+
+			if self._undervoltageMonitor and pluginData:
+				pluginData["undervoltage"] = self._undervoltageMonitor.get_state()
+
+			if self._sampleRecorder and pluginData:
+				self.record_samples(pluginData)
+
+			self._lastPiPowerValues = pluginData
 
 			#self._logger.info("Publishing PiPower values")
 			self._plugin_manager.send_plugin_message(self._identifier, pluginData)
 
+			if pluginData:
+				self.publish_pi_power_event(pluginData)
+
 			return pluginData
 		except Exception as e:
 			self._logger.warn("Errir getting the power value: {0}".format(e))
+		finally:
+			self._sweepLock.release()
+
+
+	# Add energyWattHours and the derived channels to the payload.
+	def evaluate_derived_channels(self, pluginData):
+		plan = self._acquisitionPlan
+
+		values = dict((name, pluginData.get(name)) for name in ["voltage", "currentMilliAmps", "powerWatts", "lightLevel"])
+		if values["lightLevel"] is not None and values["lightLevel"] < 0:
+			# No light sensor
+			values["lightLevel"] = None
+
+		values["energyWattHours"] = self._energyMeter.add(pluginData.get("powerWatts"), clock())
+		pluginData["energyWattHours"] = round(values["energyWattHours"], 4)
+
+		for temperature in pluginData["temperatures"]:
+			values[plan.captions[temperature["sensorId"]]] = temperature["value"]
+
+		pluginData["derivedChannels"] = plan.derivedChannels.evaluate(values)
+
+	# Record the sweep's values for export, by channel name as used by the derived channels.
+	def record_samples(self, pluginData):
+		plan = self._acquisitionPlan
+
+		values = dict((name, pluginData.get(name)) for name in ["voltage", "currentMilliAmps", "powerWatts", "lightLevel", "energyWattHours"])
+		if values["lightLevel"] is not None and values["lightLevel"] < 0:
+			values["lightLevel"] = None
 
+		for temperature in pluginData["temperatures"]:
+			values[plan.captions[temperature["sensorId"]]] = temperature["value"]
 
-	# A less frequent pi measurements publisher
-	# for other plugins (e.g. Tinamous) to use
-	def publish_pi_power_event(self):
-		pluginData = self._powerHat.getPiPowerValues(self._settings)
+		# Same order as the plan (the hat's fanId in the payload is 1 based).
+		for fan, details in zip(plan.fans, pluginData["fans"]):
+			values[fan.caption] = details["speed"]
 
-		# Publish the measurements on the event bus for others.
-		self._event_bus.fire("PiPowerMeasured", pluginData)
+		for channel in pluginData.get("derivedChannels") or []:
+			values[channel["name"]] = channel["value"]
+
+		self._sampleRecorder.record(values)
+
+	# Add the sweep's values to the statistics, returns the updated statistics.
+	def update_statistics(self, pluginData):
+		now = clock()
+
+		for name in STATISTICS_METRICS:
+			value = pluginData.get(name)
+			# Light level is -1 without a sensor.
+			if name == "lightLevel" and value is not None and value < 0:
+				continue
+			self._statistics.add(name, value, now)
+
+		for temperature in pluginData["temperatures"]:
+			self._statistics.add(temperature["sensorId"], temperature["value"], now)
+
+		for channel in pluginData.get("derivedChannels") or []:
+			self._statistics.add(channel["name"], channel["value"], now)
+
+		return self._statistics.get_statistics(now)
+
+	# Publish the measurements on the event bus for others
+	# (e.g. Tinamous) when they change or on the heartbeat.
+	def publish_pi_power_event(self, pluginData):
+		if not self._eventPublisher:
+			return
+
+		plan = self._acquisitionPlan
+
+		try:
+			self._eventPublisher.publish(pluginData, plan.captions, plan.gpioCaptions, plan.derivedChannels.thresholds)
+		except Exception as e:
+			self._logger.exception("Failed to publish PiPower events: {0}".format(e))
 
 # If you want your plugin to be registered within OctoPrint under a different name than what you defined in setup.py
 # ("OctoPrint-PluginSkeleton"), you may define that here. Same goes for the other metadata derived from setup.py that
@@ -262,6 +743,7 @@ def __plugin_load__():
 
 	global __plugin_hooks__
 	__plugin_hooks__ = {
-		"octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information
+		"octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
+		"octoprint.server.http.routes": __plugin_implementation__.get_routes
 	}
 
@@ -0,0 +1,144 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import logging
+
+from .ina219Profiles import get_profile
+from .lightSensor import LIGHT_SENSOR_MODES, DEFAULT_LIGHT_SENSOR_MODE
+from .derivedChannels import RAW_CHANNELS, compile_derived_channels
+
+# GPIO Mode: Disabled = 0, Input = 1, Input pull down = 2, Input pull up = 3, Output = 4
+GPIO_MODE_DISABLED = 0
+GPIO_MODE_INPUT = 1
+GPIO_MODE_INPUT_PULL_DOWN = 2
+GPIO_MODE_INPUT_PULL_UP = 3
+GPIO_MODE_OUTPUT = 4
+
+GPIO_MODES = [GPIO_MODE_DISABLED, GPIO_MODE_INPUT, GPIO_MODE_INPUT_PULL_DOWN, GPIO_MODE_INPUT_PULL_UP, GPIO_MODE_OUTPUT]
+
+# BCM GPIO numbers of the fan PWM outputs: FAN 0, FAN 1.
+FAN_PWM_PINS = [18, 13]
+
+# Usable BCM GPIO numbers on the Pi header. 2 and 3 are the I2C bus
+# (SDA/SCL) used by the INA219 and TSL2561, the fan PWM pins are driven by the hat.
+GPIO_PINS = [pin for pin in range(4, 28) if pin not in FAN_PWM_PINS]
+
+# The hat's fans (settings fanId): FAN 0 and FAN 1.
+FAN_IDS = range(2)
+
+_logger = logging.getLogger(__name__)
+
+
+class TemperatureSensor(object):
+	__slots__ = ("sensorId", "caption")
+
+	def __init__(self, sensor_id, caption):
+		self.sensorId = sensor_id
+		self.caption = caption
+
+
+class GpioPin(object):
+	__slots__ = ("pin", "caption", "mode")
+
+	def __init__(self, pin, caption, mode):
+		self.pin = pin
+		self.caption = caption
+		self.mode = mode
+
+
+class Fan(object):
+	__slots__ = ("fanId", "caption")
+
+	def __init__(self, fan_id, caption):
+		self.fanId = fan_id
+		self.caption = caption
+
+
+# What to read on each sweep, built from the settings when they are loaded/saved
+# so the sweep doesn't need to look up and convert the settings every time.
+class AcquisitionPlan(object):
+	__slots__ = ("temperatureSensors", "gpioPins", "fans", "powerProfile", "lightSensorMode", "derivedChannels", "captions", "gpioCaptions")
+
+	def __init__(self, temperature_sensors, gpio_pins, fans, power_profile, light_sensor_mode, derived_channels):
+		self.temperatureSensors = tuple(temperature_sensors)
+		self.gpioPins = tuple(gpio_pins)
+		self.fans = tuple(fans)
+		# INA219 MeasurementProfile
+		self.powerProfile = power_profile
+		# TSL2561 integration time mode (see lightSensor.py)
+		self.lightSensorMode = light_sensor_mode
+		# Compiled DerivedChannels (see derivedChannels.py)
+		self.derivedChannels = derived_channels
+
+		# sensorId -> caption and pin -> caption for events.
+		self.captions = dict((sensor.sensorId, sensor.caption) for sensor in self.temperatureSensors)
+		self.gpioCaptions = dict((gpio.pin, gpio.caption) for gpio in self.gpioPins)
+
+
+# Build and validate the plan from the plugin settings.
+# Invalid entries are logged and left out (or disabled) rather than failing every sweep.
+def build_acquisition_plan(settings):
+	temperature_sensors = []
+	for sensor in settings.get(['temperatureSensors']):
+		sensorId = sensor['sensorId']
+		if not sensorId:
+			continue
+
+		if sensorId in [existing.sensorId for existing in temperature_sensors]:
+			_logger.warn("Temperature sensor {0} is assigned more than once.".format(sensorId))
+			continue
+
+		temperature_sensors.append(TemperatureSensor(sensorId, sensor['caption']))
+
+	gpio_pins = []
+	for gpio_option in settings.get(["gpioOptions"]):
+		try:
+			pin = int(gpio_option['pin'])
+			mode = int(gpio_option['mode'])
+		except (TypeError, ValueError):
+			_logger.warn("Invalid GPIO option: {0}".format(gpio_option))
+			continue
+
+		if pin not in GPIO_PINS:
+			_logger.warn("Invalid GPIO pin: {0}".format(pin))
+			continue
+
+		if mode not in GPIO_MODES:
+			_logger.warn("Unknown mode {0} for GPIO pin {1}. Disabled.".format(mode, pin))
+			mode = GPIO_MODE_DISABLED
+
+		gpio_pins.append(GpioPin(pin, gpio_option['caption'], mode))
+
+	fans = []
+	for fan in settings.get(["fans"]):
+		try:
+			fan_id = int(fan['fanId'])
+		except (TypeError, ValueError):
+			_logger.warn("Invalid fan option: {0}".format(fan))
+			continue
+
+		if fan_id not in FAN_IDS:
+			_logger.warn("Invalid fan: {0}".format(fan_id))
+			continue
+
+		fans.append(Fan(fan_id, fan['caption']))
+
+	profile_name = settings.get(["powerMeasurementProfile"])
+	power_profile = get_profile(profile_name)
+	if power_profile.name != profile_name:
+		_logger.warn("Unknown power measurement profile {0}. Using {1}.".format(profile_name, power_profile.name))
+
+	light_sensor_mode = str(settings.get(["lightSensorIntegrationTime"]))
+	if light_sensor_mode not in LIGHT_SENSOR_MODES:
+		_logger.warn("Unknown light sensor integration time {0}. Using {1}.".format(light_sensor_mode, DEFAULT_LIGHT_SENSOR_MODE))
+		light_sensor_mode = DEFAULT_LIGHT_SENSOR_MODE
+
+	# Expressions can reference any temperature caption, unassigned sensors have no value.
+	known_channels = RAW_CHANNELS + [sensor['caption'] for sensor in settings.get(['temperatureSensors'])]
+	derived_channels = compile_derived_channels(settings.get(["derivedChannels"]), known_channels)
+
+	return AcquisitionPlan(temperature_sensors, gpio_pins, fans, power_profile, light_sensor_mode, derived_channels)
@@ -0,0 +1,263 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import re
+import sys
+import ast
+import logging
+
+# Derived (virtual) channels calculated from the measured values, e.g.
+#
+#   dict(name="airDelta", caption="Air Delta", unit="C", expression="{Internal Air} - {External Air}")
+#
+# {...} references a channel: one of RAW_CHANNELS, a temperature sensor caption
+# or the name of another derived channel. Expressions may use numbers, + - * / % **,
+# comparisons, "a if condition else b" and the functions in FUNCTIONS.
+#
+# The expressions are checked and compiled once when the settings are loaded/saved
+# (see build_acquisition_plan) into a plan ordered so each channel is evaluated
+# after the channels it references.
+
+# Measured channels available to expressions (as well as the temperature captions).
+RAW_CHANNELS = ["voltage", "currentMilliAmps", "powerWatts", "lightLevel", "energyWattHours"]
+
+FUNCTIONS = dict(abs=abs, min=min, max=max, round=round)
+
+NAME_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+REFERENCE_PATTERN = re.compile(r"\{([^{}]+)\}")
+
+# Number nodes. Python 3.8+ parses numbers as ast.Constant (ast.Num is deprecated),
+# earlier versions as ast.Num even where ast.Constant exists (3.6/3.7).
+if sys.version_info >= (3, 8):
+	_CONSTANT = (ast.Constant,)
+else:
+	_CONSTANT = tuple(getattr(ast, name) for name in ["Num", "Constant"] if hasattr(ast, name))
+
+_ALLOWED_NODES = (
+	ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.IfExp, ast.Call, ast.Name, ast.Load,
+	ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow, ast.USub, ast.UAdd,
+	ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq,
+) + _CONSTANT
+
+# Largest constant exponent allowed for ** (avoids huge integer powers).
+MAX_EXPONENT = 10
+
+_logger = logging.getLogger(__name__)
+
+
+def _number(node):
+	return getattr(node, "value", getattr(node, "n", None))
+
+
+def _contains_pow(node):
+	return any(isinstance(child, ast.BinOp) and isinstance(child.op, ast.Pow) for child in ast.walk(node))
+
+
+class DerivedChannelError(Exception):
+	pass
+
+
+class DerivedChannel(object):
+	__slots__ = ("name", "caption", "unit", "expression", "eventThreshold", "inputs", "code")
+
+	def __init__(self, name, caption, unit, expression, event_threshold, inputs, code):
+		self.name = name
+		self.caption = caption
+		self.unit = unit
+		self.expression = expression
+		# PiPowerMeasured is published when the value changes by this much (None to never trigger)
+		self.eventThreshold = event_threshold
+		# Referenced channel names, in the order of the compiled code's arguments.
+		self.inputs = inputs
+		self.code = code
+
+
+# The compiled channels in evaluation order.
+#
+# evaluate() keeps the inputs each channel was last evaluated with and only
+# re-evaluates a channel when one of them changes.
+class DerivedChannels(object):
+	def __init__(self, channels):
+		self.channels = tuple(channels)
+		self.thresholds = dict((channel.name, channel.eventThreshold) for channel in self.channels)
+		# name -> (inputs, value)
+		self._cache = dict()
+		self.evaluations = 0
+
+	# values: channel name -> value for the raw channels (and temperature captions).
+	# Adds each derived channel to values and returns them for the payload.
+	def evaluate(self, values):
+		results = []
+
+		for channel in self.channels:
+			inputs = tuple(values.get(name) for name in channel.inputs)
+			cached = self._cache.get(channel.name)
+
+			if cached is not None and cached[0] == inputs:
+				value = cached[1]
+			else:
+				value = self._evaluate(channel, inputs)
+				self._cache[channel.name] = (inputs, value)
+
+			values[channel.name] = value
+			results.append(dict(name=channel.name, caption=channel.caption, unit=channel.unit, value=value))
+
+		return results
+
+	def _evaluate(self, channel, inputs):
+		if None in inputs:
+			# A sensor wasn't read.
+			return None
+
+		self.evaluations += 1
+		arguments = dict(FUNCTIONS)
+		for index, value in enumerate(inputs):
+			arguments["_c{0}".format(index)] = value
+
+		try:
+			return round(float(eval(channel.code, {"__builtins__": {}}, arguments)), 3)
+		except (ArithmeticError, ValueError, TypeError) as e:
+			_logger.debug("Derived channel {0} failed: {1}".format(channel.name, e))
+			return None
+
+
+# Accumulates the energy used (Wh) from the power measured each sweep.
+class EnergyMeter(object):
+	def __init__(self):
+		self.wattHours = 0.0
+		self._lastPower = None
+		self._lastTime = None
+
+	def add(self, power_watts, now):
+		if power_watts is None:
+			return self.wattHours
+
+		if self._lastTime is not None:
+			# Trapezoidal
+			self.wattHours += (self._lastPower + power_watts) / 2.0 * (now - self._lastTime) / 3600.0
+
+		self._lastPower = power_watts
+		self._lastTime = now
+		return self.wattHours
+
+
+# Compile a single expression. Returns (inputs, code).
+def compile_expression(expression):
+	inputs = []
+
+	def replace(match):
+		name = match.group(1).strip()
+		if name not in inputs:
+			inputs.append(name)
+		return "_c{0}".format(inputs.index(name))
+
+	source = REFERENCE_PATTERN.sub(replace, expression)
+
+	try:
+		tree = ast.parse(source.strip(), mode="eval")
+	except SyntaxError as e:
+		raise DerivedChannelError("Invalid expression: {0}".format(e.msg))
+
+	for node in ast.walk(tree):
+		if not isinstance(node, _ALLOWED_NODES):
+			raise DerivedChannelError("{0} is not allowed".format(type(node).__name__))
+
+		if isinstance(node, _CONSTANT) and (isinstance(_number(node), bool) or not isinstance(_number(node), (int, float))):
+			raise DerivedChannelError("Only numbers are allowed")
+
+		if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+			if not isinstance(node.right, _CONSTANT) or abs(_number(node.right)) > MAX_EXPONENT:
+				raise DerivedChannelError("Only numbers up to {0} are allowed as powers".format(MAX_EXPONENT))
+			# A power of a power, e.g. ((9**10)**10)**10, grows without bound.
+			if _contains_pow(node.left):
+				raise DerivedChannelError("A power of a power is not allowed")
+
+		if isinstance(node, ast.Name) and node.id not in FUNCTIONS and not re.match(r"^_c\d+$", node.id):
+			raise DerivedChannelError("Unknown name {0}, use {{...}} to reference a channel".format(node.id))
+
+		if isinstance(node, ast.Call):
+			if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+				raise DerivedChannelError("Only {0} can be called".format(", ".join(sorted(FUNCTIONS))))
+			if node.keywords or getattr(node, "starargs", None) or getattr(node, "kwargs", None):
+				raise DerivedChannelError("Keyword arguments are not allowed")
+
+	return inputs, compile(tree, "<derived channel>", "eval")
+
+
+# Build the evaluation plan from the derivedChannels settings.
+# Invalid channels (and those referencing them) are logged and left out.
+def compile_derived_channels(definitions, known_channels):
+	known_channels = set(known_channels)
+	compiled = dict()
+	order = []
+
+	for definition in definitions:
+		if not definition.get("enabled", True):
+			continue
+
+		name = definition.get("name") or ""
+		try:
+			if not NAME_PATTERN.match(name):
+				raise DerivedChannelError("Invalid name, use letters, digits and _")
+			if name in known_channels or name in compiled:
+				raise DerivedChannelError("Name is already used")
+
+			inputs, code = compile_expression(definition.get("expression") or "")
+
+			threshold = definition.get("eventThreshold")
+			threshold = float(threshold) if threshold not in [None, ""] else None
+		except (DerivedChannelError, TypeError, ValueError) as e:
+			_logger.warn("Derived channel {0} ignored. {1}".format(name, e))
+			continue
+
+		compiled[name] = DerivedChannel(name, definition.get("caption") or name, definition.get("unit") or "",
+										definition["expression"], threshold, inputs, code)
+		order.append(name)
+
+	# Depth first topological sort. Each channel after the derived channels it references.
+	ordered = []
+	# name -> True once placed, False while visiting (a cycle if seen again)
+	state = dict()
+	invalid = set()
+
+	def visit(name, path):
+		if state.get(name) is True:
+			return name not in invalid
+		if state.get(name) is False:
+			raise DerivedChannelError("Circular reference: {0}".format(" -> ".join(path + [name])))
+
+		state[name] = False
+		channel = compiled[name]
+		valid = True
+		for input_name in channel.inputs:
+			if input_name in compiled:
+				if not visit(input_name, path + [name]):
+					_logger.warn("Derived channel {0} ignored. It references {1} which is invalid.".format(name, input_name))
+					valid = False
+			elif input_name not in known_channels:
+				_logger.warn("Derived channel {0} ignored. Unknown channel {{{1}}}.".format(name, input_name))
+				valid = False
+
+		state[name] = True
+		if valid:
+			ordered.append(channel)
+		else:
+			invalid.add(name)
+		return valid
+
+	for name in order:
+		try:
+			visit(name, [])
+		except DerivedChannelError as e:
+			_logger.warn("Derived channel {0} ignored. {1}".format(name, e))
+			# Leave every channel in the cycle out.
+			for cycle_name in order:
+				if state.get(cycle_name) is False:
+					state[cycle_name] = True
+					invalid.add(cycle_name)
+
+	return DerivedChannels(ordered)
@@ -0,0 +1,159 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import time
+import threading
+import logging
+
+from .sweepMonitor import clock
+
+DEVICE_OFFLINE = "offline"
+DEVICE_RECOVERING = "recovering"
+DEVICE_ONLINE = "online"
+
+# Re-probe backoff (seconds), doubled after each failed probe.
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+# Bugs in the calling code rather than the device failing, raised without taking
+# the device offline.
+PROGRAMMING_ERRORS = (AttributeError, TypeError, NameError, AssertionError)
+
+
+class DeviceOfflineError(Exception):
+	pass
+
+
+# The device is working but the value is out of it's range (e.g. the INA219
+# shunt overflowing). Raised to the caller without taking the device offline.
+class MeasurementRangeError(Exception):
+	pass
+
+
+# Tracks whether a device (e.g. the INA219) is usable and brings it back when it fails.
+#
+# Reads go through call(). If the device isn't online DeviceOfflineError is raised
+# straight away (rather than waiting on the I2C bus) and, if the backoff has passed,
+# probe() is run on a background thread to re-initialize it. A read that throws
+# (other than MeasurementRangeError or a programming error) takes the device offline.
+#
+# Reads and probes of the device are serialized (the sweep, safety watchdog,
+# undervoltage monitor and power stream all read the INA219), so a read never sees
+# the device part way through being re-created or reconfigured.
+class DeviceSupervisor(object):
+	def __init__(self, name, probe, min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF):
+		self._logger = logging.getLogger(__name__)
+		self.name = name
+		self._probe = probe
+		self._minBackoff = float(min_backoff)
+		self._maxBackoff = float(max_backoff)
+		self._lock = threading.Lock()
+		# Held while the device is used, reentrant so a probe can read it.
+		self._deviceLock = threading.RLock()
+
+		self._state = DEVICE_OFFLINE
+		self._since = time.time()
+		self._lastError = None
+		self._failures = 0
+		self._backoff = self._minBackoff
+		self._nextProbe = clock()
+
+	def is_online(self):
+		return self._state == DEVICE_ONLINE
+
+	# Probe now on the calling thread (startup and reconfiguration).
+	# Returns True if the device is online.
+	def probe_now(self):
+		with self._lock:
+			self._set_state(DEVICE_RECOVERING)
+		return self._run_probe()
+
+	def call(self, function, *args):
+		if self._state != DEVICE_ONLINE:
+			self._probe_if_due()
+			raise DeviceOfflineError("{0} is {1}".format(self.name, self._state))
+
+		with self._deviceLock:
+			# Re-probed while waiting for the lock.
+			if self._state != DEVICE_ONLINE:
+				raise DeviceOfflineError("{0} is {1}".format(self.name, self._state))
+
+			try:
+				return function(*args)
+			except MeasurementRangeError:
+				raise
+			except PROGRAMMING_ERRORS as e:
+				self._logger.exception("Error reading {0}: {1}".format(self.name, e))
+				raise
+			except Exception as e:
+				self._failed(e)
+				raise
+
+	def get_state(self):
+		with self._lock:
+			retry = None
+			if self._state == DEVICE_OFFLINE:
+				retry = round(max(self._nextProbe - clock(), 0), 1)
+
+			return dict(
+				name=self.name,
+				state=self._state,
+				since=self._since,
+				failures=self._failures,
+				lastError=self._lastError,
+				retryInSeconds=retry,
+			)
+
+	def _probe_if_due(self):
+		with self._lock:
+			if self._state != DEVICE_OFFLINE or clock() < self._nextProbe:
+				return
+			self._set_state(DEVICE_RECOVERING)
+
+		thread = threading.Thread(target=self._run_probe, name="PiPowerProbe-" + self.name)
+		thread.daemon = True
+		thread.start()
+
+	def _run_probe(self):
+		with self._deviceLock:
+			try:
+				self._probe()
+			except Exception as e:
+				self._failed(e)
+				return False
+
+			with self._lock:
+				if self._failures:
+					self._logger.info("{0} recovered after {1} failures.".format(self.name, self._failures))
+				self._failures = 0
+				self._backoff = self._minBackoff
+				self._lastError = None
+				self._set_state(DEVICE_ONLINE)
+			return True
+
+	def _failed(self, error):
+		with self._lock:
+			self._failures += 1
+			self._lastError = str(error) or type(error).__name__
+
+			if self._state == DEVICE_ONLINE:
+				# Retry quickly in case it was a glitch.
+				self._backoff = self._minBackoff
+				self._logger.warn("{0} failed, now offline. Error: {1}".format(self.name, self._lastError))
+			elif self._failures == 1:
+				self._logger.warn("Initializing {0} FAILED. Error: {1}".format(self.name, self._lastError))
+			else:
+				self._logger.debug("{0} probe failed ({1}). Retry in {2}s".format(self.name, self._lastError, self._backoff))
+
+			self._nextProbe = clock() + self._backoff
+			self._backoff = min(self._backoff * 2, self._maxBackoff)
+			self._set_state(DEVICE_OFFLINE)
+
+	def _set_state(self, state):
+		if state != self._state:
+			self._state = state
+			self._since = time.time()
@@ -0,0 +1,198 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import logging
+
+from .sweepMonitor import clock
+
+# Full snapshot of the measured values.
+EVENT_MEASURED = "PiPowerMeasured"
+# A single temperature sensor changed by more than the threshold.
+EVENT_TEMPERATURE_CHANGED = "PiPowerTemperatureChanged"
+# A GPIO pin changed level.
+EVENT_GPIO_EDGE = "PiPowerGpioEdge"
+
+# Metrics from the plugin data checked against the thresholds.
+# Temperatures are checked per sensor with the "temperature" threshold.
+SNAPSHOT_METRICS = ["voltage", "currentMilliAmps", "powerWatts", "lightLevel"]
+
+
+# Simple token bucket. rate tokens are added per second up to burst.
+class TokenBucket(object):
+	def __init__(self, rate, burst):
+		self._rate = float(rate)
+		self._burst = float(burst)
+		self._tokens = self._burst
+		self._updated = clock()
+
+	# Keeps the tokens already in the bucket (up to the new burst).
+	def configure(self, rate, burst):
+		self._rate = float(rate)
+		self._burst = float(burst)
+		self._tokens = min(self._tokens, self._burst)
+
+	def take(self):
+		now = clock()
+		self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+		self._updated = now
+
+		if self._tokens >= 1:
+			self._tokens -= 1
+			return True
+		return False
+
+
+# Publishes the measured values on OctoPrint's event bus for other plugins (e.g. Tinamous).
+#
+# Rather than a fixed timer PiPowerMeasured is fired when a value changes by more than
+# it's threshold since it was last published, or on a heartbeat if nothing has changed.
+# Narrower PiPowerTemperatureChanged and PiPowerGpioEdge events are fired for
+# consumers that are only interested in those.
+#
+# Each event is rate limited by a token bucket. Each event type has its own sequence
+# number which also advances when an event is suppressed, so a gap tells consumers
+# they missed some (suppressed is how many since the last one published).
+class EventPublisher(object):
+	def __init__(self, fire, thresholds, heartbeat_interval, rate, burst):
+		self._logger = logging.getLogger(__name__)
+		self._fire = fire
+		self._thresholds = thresholds
+		self._heartbeatInterval = float(heartbeat_interval)
+		# One bucket per event so busy narrow events don't starve PiPowerMeasured.
+		self._buckets = dict()
+		self._sequences = dict()
+		self._suppressed = dict()
+		for event in [EVENT_MEASURED, EVENT_TEMPERATURE_CHANGED, EVENT_GPIO_EDGE]:
+			self._buckets[event] = TokenBucket(rate, burst)
+			self._sequences[event] = 0
+			self._suppressed[event] = 0
+
+		self._lastPublished = None
+		# Values last published in PiPowerMeasured to compare against.
+		self._publishedValues = dict()
+		# Temperatures last published in PiPowerTemperatureChanged.
+		self._publishedTemperatures = dict()
+		# GPIO levels from the last sweep for edge detection.
+		self._gpioLevels = dict()
+
+	# Applied when the settings are saved. The sequences and published values are
+	# kept so consumers don't see the sequence restart.
+	def configure(self, thresholds, heartbeat_interval, rate, burst):
+		self._thresholds = thresholds
+		self._heartbeatInterval = float(heartbeat_interval)
+		for bucket in self._buckets.values():
+			bucket.configure(rate, burst)
+
+	# Called with the plugin data after each sweep.
+	# captions maps temperature sensorId -> caption, gpio_captions maps pin -> caption
+	# and derived_thresholds maps derived channel name -> threshold (or None).
+	def publish(self, plugin_data, captions, gpio_captions, derived_thresholds=None):
+		self._publish_gpio_edges(plugin_data.get("gpioValues") or [], gpio_captions)
+
+		changed = []
+
+		for metric in SNAPSHOT_METRICS:
+			if self._has_changed(self._publishedValues, metric, self._thresholds.get(metric), plugin_data.get(metric)):
+				changed.append(metric)
+
+		for channel in plugin_data.get("derivedChannels") or []:
+			key = "derivedChannels." + channel["name"]
+			threshold = (derived_thresholds or {}).get(channel["name"])
+			if self._has_changed(self._publishedValues, key, threshold, channel["value"]):
+				changed.append(key)
+
+		for temperature in plugin_data.get("temperatures") or []:
+			sensorId = temperature["sensorId"]
+			value = temperature["value"]
+			key = "temperatures." + sensorId
+
+			if self._has_changed(self._publishedValues, key, self._thresholds.get("temperature"), value):
+				changed.append(key)
+
+			if self._has_changed(self._publishedTemperatures, sensorId, self._thresholds.get("temperature"), value):
+				published = self._fire_event(EVENT_TEMPERATURE_CHANGED, dict(
+					sensorId=sensorId,
+					caption=captions.get(sensorId),
+					value=value,
+					previousValue=self._publishedTemperatures.get(sensorId)))
+				if published:
+					self._publishedTemperatures[sensorId] = value
+
+		heartbeat_due = self._lastPublished is None or clock() - self._lastPublished >= self._heartbeatInterval
+
+		if not changed and not heartbeat_due:
+			return
+
+		payload = dict(plugin_data)
+		payload["changed"] = changed
+		payload["reason"] = "change" if changed else "heartbeat"
+
+		if self._fire_event(EVENT_MEASURED, payload):
+			self._lastPublished = clock()
+			self._update_published_values(plugin_data)
+
+	def _has_changed(self, published_values, key, threshold, value):
+		if value is None:
+			return False
+
+		previous = published_values.get(key)
+		if previous is None:
+			return True
+
+		if threshold is None:
+			return False
+
+		return abs(value - previous) >= float(threshold)
+
+	def _update_published_values(self, plugin_data):
+		for metric in SNAPSHOT_METRICS:
+			if plugin_data.get(metric) is not None:
+				self._publishedValues[metric] = plugin_data[metric]
+
+		for temperature in plugin_data.get("temperatures") or []:
+			if temperature["value"] is not None:
+				self._publishedValues["temperatures." + temperature["sensorId"]] = temperature["value"]
+
+		for channel in plugin_data.get("derivedChannels") or []:
+			if channel["value"] is not None:
+				self._publishedValues["derivedChannels." + channel["name"]] = channel["value"]
+
+	def _publish_gpio_edges(self, gpio_values, gpio_captions):
+		for gpio in gpio_values:
+			pin = gpio["pin"]
+			value = gpio["value"]
+			previous = self._gpioLevels.get(pin)
+
+			if previous is None or value is None:
+				self._gpioLevels[pin] = value
+				continue
+			if previous == value:
+				continue
+
+			published = self._fire_event(EVENT_GPIO_EDGE, dict(
+				pin=pin,
+				caption=gpio_captions.get(pin),
+				value=value,
+				previousValue=previous,
+				edge="rising" if value > previous else "falling"))
+			# If suppressed the edge is published by a later sweep (unless the pin changes back).
+			if published:
+				self._gpioLevels[pin] = value
+
+	def _fire_event(self, event, payload):
+		self._sequences[event] += 1
+
+		if not self._buckets[event].take():
+			self._suppressed[event] += 1
+			self._logger.debug("Rate limit reached. {0} not published".format(event))
+			return False
+
+		payload["sequence"] = self._sequences[event]
+		payload["suppressed"] = self._suppressed[event]
+		self._suppressed[event] = 0
+		self._fire(event, payload)
+		return True
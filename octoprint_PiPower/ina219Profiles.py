@@ -0,0 +1,91 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+# INA219 measurement profiles.
+# See https://github.com/chrisb2/pi_ina219/blob/master/README.md
+#
+# The INA219 converts the shunt and then the bus voltage continuously, a new
+# reading is available every (shunt + bus) conversion time. More bits/samples
+# averaged gives a less noisy reading but takes longer to update.
+
+# Expect a 0R1 resistor on the PCB
+SHUNT_OHMS = 0.1
+MAX_EXPECTED_AMPS = 3.0
+
+# INA219 gain constants and their full scale shunt voltage (V), lowest first.
+GAINS = [
+	("GAIN_1_40MV", 0.04),
+	("GAIN_2_80MV", 0.08),
+	("GAIN_4_160MV", 0.16),
+	("GAIN_8_320MV", 0.32),
+]
+
+GAIN_AUTO = "GAIN_AUTO"
+
+
+# The most sensitive gain that can measure MAX_EXPECTED_AMPS through the shunt.
+def fixed_gain():
+	shunt_volts = SHUNT_OHMS * MAX_EXPECTED_AMPS
+	for gain, full_scale in GAINS:
+		if shunt_volts <= full_scale:
+			return gain
+	return GAINS[-1][0]
+
+
+# Conversion time (seconds) for each ADC setting (INA219 datasheet, table 5)
+ADC_CONVERSION_TIMES = dict(
+	ADC_9BIT=0.000084,
+	ADC_10BIT=0.000148,
+	ADC_11BIT=0.000276,
+	ADC_12BIT=0.000532,
+	ADC_2SAMP=0.00106,
+	ADC_4SAMP=0.00213,
+	ADC_8SAMP=0.00426,
+	ADC_16SAMP=0.00851,
+	ADC_32SAMP=0.01702,
+	ADC_64SAMP=0.03405,
+	ADC_128SAMP=0.0681,
+)
+
+
+class MeasurementProfile(object):
+	__slots__ = ("name", "caption", "adc", "gain", "autoGain", "conversionTime")
+
+	def __init__(self, name, caption, adc, gain):
+		self.name = name
+		self.caption = caption
+		# Name of the INA219 ADC constant (used for both bus and shunt)
+		self.adc = adc
+		# Name of the INA219 gain constant. GAIN_AUTO increases the gain when the
+		# shunt voltage overflows (reconfiguring the chip and losing a conversion).
+		self.gain = gain
+		self.autoGain = gain == GAIN_AUTO
+		# Time for a new (shunt + bus) reading.
+		self.conversionTime = ADC_CONVERSION_TIMES[adc] * 2
+
+	def to_dict(self):
+		return dict(name=self.name, conversionTimeMs=round(self.conversionTime * 1000, 3))
+
+
+PROFILES = [
+	# Single 9 bit sample, a new reading every ~0.2ms. Noisy.
+	MeasurementProfile("fast", "Fast (9-bit, single sample)", "ADC_9BIT", fixed_gain()),
+	# 128 x 12 bit samples averaged, a new reading every ~136ms.
+	MeasurementProfile("precise", "Precise (128 sample average)", "ADC_128SAMP", fixed_gain()),
+	# Single 12 bit sample with the gain increased as needed for the current.
+	MeasurementProfile("auto", "Auto ranging gain (12-bit)", "ADC_12BIT", GAIN_AUTO),
+]
+
+DEFAULT_PROFILE = "auto"
+
+
+def get_profile(name):
+	for profile in PROFILES:
+		if profile.name == name:
+			return profile
+
+	return get_profile(DEFAULT_PROFILE)
@@ -0,0 +1,163 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import logging
+
+from .sweepMonitor import clock
+
+# Integration time modes for the light sensor setting.
+# "auto" adapts the integration time (and gain) to the light level.
+LIGHT_SENSOR_MODES = ["auto", "13", "101", "402"]
+DEFAULT_LIGHT_SENSOR_MODE = "auto"
+
+# Extra time to allow past the nominal integration time before reading.
+INTEGRATION_MARGIN = 0.005
+
+
+class IntegrationTime(object):
+	__slots__ = ("name", "value", "duration", "low", "high")
+
+	def __init__(self, name, value, duration, low, high):
+		self.name = name
+		# TSL2561 timing register value
+		self.value = value
+		# Seconds
+		self.duration = duration
+		# Auto gain thresholds for the broadband channel
+		self.low = low
+		self.high = high
+
+
+# Non blocking TSL2561 reader.
+#
+# The tsl2561 library's lux() starts an integration, sleeps for it to complete
+# (402ms by default) and then reads the result, blocking the sweep. Instead poll()
+# starts an integration and collects the result on a later call once the
+# integration time has passed, returning the last lux value in the meantime.
+# As poll() is called each sweep, a change is seen within one to two sweeps
+# unless the integration time is longer than the sweep interval.
+#
+# The gain is switched between 1x and 16x for the light level, and in auto
+# mode the integration time is also shortened when the sensor saturates at 1x
+# and lengthened when it is too dark at 16x.
+#
+# Uses the library for register access and lux calculation.
+# See https://github.com/sim0nx/tsl2561/blob/master/tsl2561/tsl2561.py
+class LightSensor(object):
+	def __init__(self, tsl2561, mode):
+		from tsl2561 import constants
+
+		self._logger = logging.getLogger(__name__)
+		self._tsl2561 = tsl2561
+		self._constants = constants
+
+		# Shortest first
+		self._integrationTimes = [
+			IntegrationTime("13", constants.TSL2561_INTEGRATIONTIME_13MS, 0.0137, constants.TSL2561_AGC_TLO_13MS, constants.TSL2561_AGC_THI_13MS),
+			IntegrationTime("101", constants.TSL2561_INTEGRATIONTIME_101MS, 0.101, constants.TSL2561_AGC_TLO_101MS, constants.TSL2561_AGC_THI_101MS),
+			IntegrationTime("402", constants.TSL2561_INTEGRATIONTIME_402MS, 0.402, constants.TSL2561_AGC_TLO_402MS, constants.TSL2561_AGC_THI_402MS),
+		]
+
+		self._mode = None
+		self._integrationTime = None
+		# When the current integration was started (None if not integrating)
+		self._started = None
+		self._lux = None
+		self._saturated = False
+
+		self.set_mode(mode)
+
+	def set_mode(self, mode):
+		if mode not in LIGHT_SENSOR_MODES:
+			self._logger.warn("Unknown light sensor mode {0}. Using {1}".format(mode, DEFAULT_LIGHT_SENSOR_MODE))
+			mode = DEFAULT_LIGHT_SENSOR_MODE
+
+		self._mode = mode
+		if mode == "auto":
+			# Start in the middle and adapt from there.
+			self._set_integration_time(self._find_integration_time("101"))
+		else:
+			self._set_integration_time(self._find_integration_time(mode))
+
+	# Called each sweep. Collects the result of the integration if it's complete
+	# and starts the next one. Returns the latest lux value (None until the first
+	# integration completes).
+	def poll(self):
+		now = clock()
+
+		if self._started is None:
+			self._start(now)
+			return self._lux
+
+		if now - self._started < self._integrationTime.duration + INTEGRATION_MARGIN:
+			# Not ready yet.
+			return self._lux
+
+		constants = self._constants
+		i2c = self._tsl2561.i2c
+		broadband = i2c.readU16(constants.TSL2561_COMMAND_BIT | constants.TSL2561_WORD_BIT | constants.TSL2561_REGISTER_CHAN0_LOW)
+		ir = i2c.readU16(constants.TSL2561_COMMAND_BIT | constants.TSL2561_WORD_BIT | constants.TSL2561_REGISTER_CHAN1_LOW)
+		self._tsl2561.disable()
+		self._started = None
+
+		try:
+			self._lux = self._tsl2561._calculate_lux(broadband, ir)
+			self._saturated = False
+		except Exception:
+			# Saturated, keep the last value until the range is adjusted.
+			self._saturated = True
+			self._logger.debug("Light sensor saturated. Broadband: {0}, IR: {1}".format(broadband, ir))
+
+		self._adapt(broadband)
+		self._logger.debug("Lux measured: {0}".format(self._lux))
+
+		self._start(clock())
+		return self._lux
+
+	def get_state(self):
+		return dict(
+			mode=self._mode,
+			integrationTimeMs=round(self._integrationTime.duration * 1000, 1),
+			gain=16 if self._tsl2561.gain == self._constants.TSL2561_GAIN_16X else 1,
+			saturated=self._saturated,
+		)
+
+	def _start(self, now):
+		# Powering on the sensor starts an integration.
+		self._tsl2561.enable()
+		self._started = now
+
+	def _adapt(self, broadband):
+		constants = self._constants
+		gain = self._tsl2561.gain
+		integrationTime = self._integrationTime
+		index = self._integrationTimes.index(integrationTime)
+
+		if broadband < integrationTime.low:
+			if gain == constants.TSL2561_GAIN_1X:
+				self._tsl2561.set_gain(constants.TSL2561_GAIN_16X)
+			elif self._mode == "auto" and index < len(self._integrationTimes) - 1:
+				self._set_integration_time(self._integrationTimes[index + 1])
+		elif broadband > integrationTime.high:
+			if gain == constants.TSL2561_GAIN_16X:
+				self._tsl2561.set_gain(constants.TSL2561_GAIN_1X)
+			elif self._mode == "auto" and index > 0:
+				self._set_integration_time(self._integrationTimes[index - 1])
+
+	def _set_integration_time(self, integration_time):
+		if self._integrationTime is not integration_time:
+			self._logger.debug("Light sensor integration time: {0}ms".format(integration_time.name))
+
+		self._integrationTime = integration_time
+		# This powers the sensor down which abandons any integration in progress.
+		self._tsl2561.set_integration_time(integration_time.value)
+		self._started = None
+
+	def _find_integration_time(self, name):
+		for integration_time in self._integrationTimes:
+			if integration_time.name == name:
+				return integration_time
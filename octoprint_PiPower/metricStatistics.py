@@ -0,0 +1,234 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import math
+import threading
+from collections import deque
+
+# Rolling windows (name -> seconds)
+WINDOWS = [("minute", 60.0), ("hour", 3600.0)]
+
+# The rolling mean is kept in this many buckets per window.
+WINDOW_BUCKETS = 60
+
+
+def _round(value):
+	if value is None:
+		return None
+	return round(value, 3)
+
+
+# Count, mean and variance (Welford) plus min/max, all O(1) per sample.
+class RunningStatistics(object):
+	__slots__ = ("count", "mean", "_m2", "min", "max")
+
+	def __init__(self):
+		self.count = 0
+		self.mean = 0.0
+		self._m2 = 0.0
+		self.min = None
+		self.max = None
+
+	def add(self, value):
+		self.count += 1
+		delta = value - self.mean
+		self.mean += delta / self.count
+		self._m2 += delta * (value - self.mean)
+
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+
+	def stddev(self):
+		if self.count < 2:
+			return None
+		return math.sqrt(self._m2 / (self.count - 1))
+
+	def to_dict(self):
+		return dict(
+			count=self.count,
+			mean=_round(self.mean) if self.count else None,
+			stddev=_round(self.stddev()),
+			min=_round(self.min),
+			max=_round(self.max),
+		)
+
+
+# Exponentially weighted moving average with a time constant (seconds) so
+# irregular sample intervals (skipped ticks, API sweeps) are weighted correctly.
+class Ewma(object):
+	__slots__ = ("timeConstant", "value", "_lastTime")
+
+	def __init__(self, time_constant):
+		self.timeConstant = float(time_constant)
+		self.value = None
+		self._lastTime = None
+
+	def add(self, value, now):
+		if self.value is None:
+			self.value = value
+		else:
+			alpha = 1.0 - math.exp(-max(now - self._lastTime, 0.0) / self.timeConstant)
+			self.value += alpha * (value - self.value)
+		self._lastTime = now
+
+
+# Min/max/mean over the last window seconds.
+#
+# Min and max use monotonic deques: each holds the samples that could still be
+# the min (or max) of the window, in time order, so the answer is always at the
+# front. Each sample is appended and removed at most once (amortised O(1)).
+#
+# The mean uses a running sum and count over buckets of window / WINDOW_BUCKETS
+# seconds rather than keeping every sample (an hour of sweeps), so samples
+# leave the mean a bucket at a time.
+class RollingWindow(object):
+	__slots__ = ("window", "_bucketSize", "_buckets", "_sum", "_count", "_min", "_max")
+
+	def __init__(self, window):
+		self.window = window
+		self._bucketSize = window / WINDOW_BUCKETS
+		# [start, sum, count]
+		self._buckets = deque()
+		self._sum = 0.0
+		self._count = 0
+		self._min = deque()
+		self._max = deque()
+
+	def add(self, value, now):
+		if self._buckets and now < self._buckets[-1][0] + self._bucketSize:
+			bucket = self._buckets[-1]
+			bucket[1] += value
+			bucket[2] += 1
+		else:
+			self._buckets.append([now, value, 1])
+		self._sum += value
+		self._count += 1
+
+		while self._min and self._min[-1][1] >= value:
+			self._min.pop()
+		self._min.append((now, value))
+
+		while self._max and self._max[-1][1] <= value:
+			self._max.pop()
+		self._max.append((now, value))
+
+		self.expire(now)
+
+	def expire(self, now):
+		oldest = now - self.window
+
+		# A bucket leaves once all of it is older than the window.
+		while self._buckets and self._buckets[0][0] + self._bucketSize <= oldest:
+			start, total, count = self._buckets.popleft()
+			self._sum -= total
+			self._count -= count
+		while self._min and self._min[0][0] < oldest:
+			self._min.popleft()
+		while self._max and self._max[0][0] < oldest:
+			self._max.popleft()
+
+		if not self._buckets:
+			# Don't let rounding errors accumulate.
+			self._sum = 0.0
+
+	def to_dict(self):
+		count = self._count
+		return dict(
+			count=count,
+			mean=_round(self._sum / count) if count else None,
+			min=_round(self._min[0][1]) if self._min else None,
+			max=_round(self._max[0][1]) if self._max else None,
+		)
+
+
+class MetricStatistics(object):
+	def __init__(self, ewma_time_constant):
+		self.value = None
+		self.overall = RunningStatistics()
+		self.ewma = Ewma(ewma_time_constant)
+		self.windows = [(name, RollingWindow(seconds)) for name, seconds in WINDOWS]
+		# Since the print started (None if there hasn't been a print)
+		self.printStatistics = None
+
+	def add(self, value, now, printing):
+		self.value = value
+		self.overall.add(value)
+		self.ewma.add(value, now)
+		for name, window in self.windows:
+			window.add(value, now)
+
+		if printing:
+			if self.printStatistics is None:
+				self.printStatistics = RunningStatistics()
+			self.printStatistics.add(value)
+
+	def to_dict(self, now):
+		statistics = self.overall.to_dict()
+		statistics["value"] = _round(self.value)
+		statistics["ewma"] = _round(self.ewma.value)
+
+		for name, window in self.windows:
+			# Drop old samples even if the metric has stopped updating.
+			window.expire(now)
+			statistics[name] = window.to_dict()
+
+		statistics["print"] = self.printStatistics.to_dict() if self.printStatistics else None
+		return statistics
+
+
+# Statistics for each metric, updated each sweep.
+#
+# Metrics are keyed by name (e.g. voltage, or the sensorId for temperatures) and
+# created on their first sample. None values (sensor not read) are ignored.
+#
+# Updated from the sweep, print start/stop comes from OctoPrint's event thread.
+class StatisticsEngine(object):
+	def __init__(self, ewma_time_constant):
+		self._ewmaTimeConstant = ewma_time_constant
+		self._metrics = dict()
+		self._printing = False
+		self._lock = threading.Lock()
+
+	def add(self, name, value, now):
+		if value is None:
+			return
+
+		with self._lock:
+			metric = self._metrics.get(name)
+			if metric is None:
+				metric = MetricStatistics(self._ewmaTimeConstant)
+				self._metrics[name] = metric
+
+			metric.add(float(value), now, self._printing)
+
+	# Applied to the existing metrics as well, their averages are kept.
+	def configure(self, ewma_time_constant):
+		with self._lock:
+			self._ewmaTimeConstant = ewma_time_constant
+			for metric in self._metrics.values():
+				metric.ewma.timeConstant = float(ewma_time_constant)
+
+	# Reset the since print start statistics.
+	def start_print(self):
+		with self._lock:
+			self._printing = True
+			for metric in self._metrics.values():
+				metric.printStatistics = None
+
+	# Keep the print statistics until the next print starts.
+	def stop_print(self):
+		with self._lock:
+			self._printing = False
+
+	def get_statistics(self, now):
+		with self._lock:
+			return dict(
+				printing=self._printing,
+				metrics=dict((name, metric.to_dict(now)) for name, metric in self._metrics.items()),
+			)
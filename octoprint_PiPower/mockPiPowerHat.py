@@ -14,6 +14,10 @@ import random
 import logging
 import logging.handlers
 
+from .sweepMonitor import StageTimer
+from .acquisitionPlan import GPIO_MODE_DISABLED, GPIO_MODE_OUTPUT
+from .deviceSupervisor import DeviceSupervisor, MeasurementRangeError
+
 # Mocked hardware for development
 class MockPiPowerHat:
 	def __init__(self):
@@ -30,30 +34,53 @@ class MockPiPowerHat:
 		for pin in range(4, 40):
 			self._gpioPinSetValue.append(0)
 
-	def initialize(self, settings):
+		# How long each stage of the last sweep took (seconds)
+		self._stageTimings = dict()
+
+		self._powerProfile = None
+
+		# Simulated faults (name -> value) for the safety watchdog self test.
+		# "i2cFailure" makes the mock INA219 fail (and re-probing it fail) until cleared.
+		self._faults = dict()
+
+		self._powerMonitor = DeviceSupervisor("INA219", self._probe_power_monitor)
+		self._lightSensorDevice = DeviceSupervisor("TSL2561", lambda: None)
+
+	def initialize(self, settings, plan):
 		self._logger.setLevel(logging.DEBUG)
 		self._logger.warn("MockPiPowerHat. GPIO not initialized")
 		self._settings = settings
+		self.configure_power_monitor(plan.powerProfile)
+		self._lightSensorDevice.probe_now()
 
 	# ===========================================
 	# Power
 	# ===========================================
-	def getPiPowerValues(self, settings):
+	def getPiPowerValues(self, plan):
 		#self._logger.debug("Making up values for debug")
 
 		#settingsKey = "pcbTemperatureSensorId";
 		#sensor = settings.get([settingsKey])
 		#self._logger.warn(settingsKey + " == " + sensor)
 
-		measured_temperatures = self.read_temperatures(settings)
+		timings = dict()
+		self._stageTimings = timings
+
+		with StageTimer(timings, "temperature"):
+			measured_temperatures = self.read_temperatures(plan)
 
 		# make some values up.
-		voltage = self.randrange_float(11, 13, 0.01)
-		currentMilliAmps = self.randrange_float(900, 1200, 0.1)
+		with StageTimer(timings, "power"):
+			try:
+				power = self.read_power()
+			except Exception:
+				power = None
 
-		lightLevel = self.read_light_level(settings)
+		with StageTimer(timings, "light"):
+			lightLevel = self.read_light_level()
 
-		gpio_pin_values = self.read_gpio_values(settings)
+		with StageTimer(timings, "gpio"):
+			gpio_pin_values = self.read_gpio_values(plan)
 		#gpio_pin_values = []
 		#gpio_pin_values.append(dict(pin="16", value=))
 		#gpio_pin_values.append(dict(pin="26", value=self.randrange_float(0, 1, 1)))
@@ -62,33 +89,75 @@ class MockPiPowerHat:
 
 		return dict(
 			temperatures=measured_temperatures,
-			voltage=round(voltage,1),
-			currentMilliAmps=round(currentMilliAmps,1),
-			powerWatts=round(voltage * (currentMilliAmps/1000),0),
+			voltage=round(power["voltage"],1) if power else None,
+			currentMilliAmps=round(power["currentMilliAmps"],1) if power else None,
+			powerWatts=round(power["power"],0) if power else None,
+			powerProfile=self._powerProfile.to_dict(),
 			lightLevel=lightLevel,
-			fans = [
-				self.get_fan_details(0),
-				self.get_fan_details(1),
-			],
-			gpioValues = gpio_pin_values
+			fans = [self.get_fan_details(fan.fanId) for fan in plan.fans],
+			gpioValues = gpio_pin_values,
+			devices = self.get_device_states(),
 			)
 
+	def get_device_states(self):
+		return [self._powerMonitor.get_state(), self._lightSensorDevice.get_state()]
+
+	def read_power(self):
+		return self._powerMonitor.call(self._read_power)
+
+	def _read_power(self):
+		if "overRange" in self._faults:
+			raise MeasurementRangeError("Current out of range (overflow)")
+		voltage = self._read_bus_voltage()
+		currentMilliAmps = self._faults.get("overcurrent", self.randrange_float(900, 1200, 0.1))
+
+		return dict(
+			voltage=voltage,
+			currentMilliAmps=currentMilliAmps,
+			power=voltage * currentMilliAmps / 1000
+		)
+
+	def read_bus_voltage(self):
+		return self._powerMonitor.call(self._read_bus_voltage)
+
+	def read_power_sample(self):
+		power = self.read_power()
+		return power["voltage"], power["currentMilliAmps"]
+
+	def _read_bus_voltage(self):
+		self._check_i2c()
+		return self._faults.get("undervoltage", self.randrange_float(11, 13, 0.01))
+
+	def configure_power_monitor(self, profile):
+		self._logger.info("Mock INA219 profile: {0}".format(profile.name))
+		self._powerProfile = profile
+		self._powerMonitor.probe_now()
+
+	def _probe_power_monitor(self):
+		self._check_i2c()
+
+	def _check_i2c(self):
+		if "i2cFailure" in self._faults:
+			raise IOError("[Errno 121] Remote I/O error")
+
+	def get_power_profile(self):
+		return self._powerProfile
+
+	def set_light_sensor_mode(self, mode):
+		self._logger.info("Mock TSL2561 integration time: {0}".format(mode))
+
+	# Stage durations (seconds) from the last sweep.
+	def get_stage_timings(self):
+		return self._stageTimings
+
 	# ===========================================
 	# Temperature
 	# ===========================================
 	def getTemperatureSensors(self):
 		return ['', '28-000007538f5b', '28-0000070e4078', '28-0000070e3270', '28-000007538a2b']
 
-	def read_temperatures(self, settings):
-		temperatures = []
-		for sensor in settings.get(['temperatureSensors']):
-			sensorId = sensor['sensorId']
-			if sensorId:
-				value = self.read_temperature(sensorId)
-				temperature = dict(sensorId=sensorId, value=value)
-				temperatures.append(temperature)
-
-		return temperatures
+	def read_temperatures(self, plan):
+		return [dict(sensorId=sensor.sensorId, value=self.read_temperature(sensor.sensorId)) for sensor in plan.temperatureSensors]
 
 	def read_temperature(self, sensor):
 		temperature = random.randint(0, 1000) * 0.1 + 20
@@ -132,44 +201,39 @@ class MockPiPowerHat:
 	# ===========================================
 	# Light Sensor
 	# ===========================================
-	def read_light_level(self, settings):
+	def read_light_level(self):
 		return self.randrange_float(0, 255, 1)
 
 	# ===========================================
 	# GPIO Pins
 	# ===========================================
-	def read_gpio_values(self, settings):
+	def read_gpio_values(self, plan):
 		gpio_pin_values = []
 
 		try:
-			# import RPi.GPIO as GPIO
-			for gpio_option in settings.get(["gpioOptions"]):
-				#self._logger.debug("Getting GPIO for: {0}.".format(gpio_option))
-				pin = gpio_option["pin"]
-				value = self.get_gpio_pin_value(gpio_option)
-				gpio_pin_values.append(dict(pin=pin, value=value))
+			for gpio_pin in plan.gpioPins:
+				gpio_pin_values.append(dict(pin=gpio_pin.pin, value=self.get_gpio_pin_value(gpio_pin)))
 		except Exception as e:
 			self._logger.exception("Failed to read GPIO pins. Exception: {0}".format(e))
 
 		return gpio_pin_values
 
-	def get_gpio_pin_value(self, gpio_pin_options):
-		# Disabled = 0, Input = 1, Input pull down = 2, Input pull up = 3, Output = 4
+	def get_gpio_pin_value(self, gpio_pin):
+		mode = gpio_pin.mode
 
-		mode = int(gpio_pin_options["mode"])
-		pin = int(gpio_pin_options["pin"])
-
-		if mode == 0:
-			# Disabled
+		if mode == GPIO_MODE_DISABLED:
 			return None
-		elif mode == 4:
-			# Output
-			return self._gpioPinSetValue[pin]
+		elif mode == GPIO_MODE_OUTPUT:
+			return self._gpioPinSetValue[gpio_pin.pin]
 		else:
 			# Using BCM pin nuimber
 			return self.randrange_float(0, 1, 1)
 
 
+	def setup_output_pin(self, pin, value):
+		self._logger.info("Mock GPIO pin: {0} as an output. Value: {1}".format(pin, value))
+		self._gpioPinSetValue[pin] = value
+
 	def set_gpio(self, pin, state):
 		self._logger.info("Setting GPIO Pin: {0}, State: {1}".format(pin, state))
 
@@ -183,6 +247,16 @@ class MockPiPowerHat:
 		# record the value set to display in the UI.
 		self._gpioPinSetValue[pin] = value
 
+	# ===========================================
+	# Simulated faults
+	# ===========================================
+	def simulate_fault(self, fault, value):
+		self._logger.info("Simulating fault: {0} ({1})".format(fault, value))
+		self._faults[fault] = value
+
+	def clear_faults(self):
+		self._faults.clear()
+
 	# ===========================================
 	# Helpers
 	# ===========================================
@@ -13,11 +13,17 @@ import flask
 import sys
 import os
 import time
-import subprocess
-import glob
 import logging
 import logging.handlers
 
+from .sweepMonitor import StageTimer, clock
+from .acquisitionPlan import FAN_PWM_PINS, GPIO_MODE_DISABLED, GPIO_MODE_INPUT, GPIO_MODE_INPUT_PULL_DOWN, GPIO_MODE_INPUT_PULL_UP, GPIO_MODE_OUTPUT
+from .w1Sensors import W1_DEVICES_DIR
+from .lightSensor import LightSensor
+from .deviceSupervisor import DeviceSupervisor, DeviceOfflineError, MeasurementRangeError
+from .ina219Profiles import SHUNT_OHMS, MAX_EXPECTED_AMPS
+from . import w1Sensors
+
 os.system('modprobe w1-gpio')
 os.system('modprobe w1-therm')
 
@@ -34,14 +40,19 @@ os.system('modprobe w1-therm')
 # Current monitor/
 # See https://github.com/chrisb2/pi_ina219/blob/master/README.md
 # and https://www.hackster.io/chrisb2/raspberry-pi-ina219-voltage-current-sensor-library-f3bb54
-SHUNT_OHMS = 0.1
-MAX_EXPECTED_AMPS = 3.0
+# (SHUNT_OHMS, MAX_EXPECTED_AMPS and the gain per profile are in ina219Profiles.py)
 
 # Interface for real hardware.
 class PiPowerHat:
-	def __init__(self):
+	def __init__(self, w1_devices_dir=W1_DEVICES_DIR):
 		self._logger = logging.getLogger(__name__)
 		self._settings = None
+		self._w1DevicesDir = w1_devices_dir
+		# sensorId -> w1_slave path
+		self._w1Paths = dict()
+
+		# RPi.GPIO, imported in initialize.
+		self._GPIO = None
 
 		# PWM Fan control
 		# The requested speed of the fan
@@ -49,15 +60,20 @@ class PiPowerHat:
 		self._fanSpeeds = [100,100]
 		# If the fan is on or off
 		self._fanStates = [False,False]
-		self._fan_pwm_pins = [18, 13]
+		self._fan_pwm_pins = FAN_PWM_PINS
 		self._fan_pwm = []
 
 		# Current monitoring with INA219
 		self._ina = None
+		self._powerProfile = None
+		# When the INA219 was last configured
+		self._powerConfigured = None
+		self._powerMonitor = DeviceSupervisor("INA219", self._probe_power_monitor)
 
-		# TODO: figure out if we have one.
-		self._tsl2561  = None
-		self._has_light_sensor = False
+		# V1.2 PCB only and may not be fitted
+		self._lightSensor = None
+		self._lightSensorMode = None
+		self._lightSensorDevice = DeviceSupervisor("TSL2561", self._probe_light_sensor)
 
 		# Initialzie a 40 pin array for IO set values
 		# ignore 0 as their is no pin 0
@@ -65,11 +81,15 @@ class PiPowerHat:
 		for pin in range(4, 40):
 			self._gpioPinSetValue.append(0)
 
-	def initialize(self, settings):
+		# How long each stage of the last sweep took (seconds)
+		self._stageTimings = dict()
+
+	def initialize(self, settings, plan):
 		self._logger.setLevel(logging.INFO)
 		self._logger.info("PiPowerHat initializing")
 		self._settings = settings
 		import RPi.GPIO as GPIO
+		self._GPIO = GPIO
 
 		self._logger.info("Running RPi.GPIO version '{0}'...".format(GPIO.VERSION))
 
@@ -100,128 +120,183 @@ class PiPowerHat:
 
 
 		# Setup the INA219 Power monitor
+		self.configure_power_monitor(plan.powerProfile)
+
+		self.setup_lightsensor(plan.lightSensorMode)
+
+		self.setup_gpio_pins(plan)
+
+		self._logger.info("PiPowerHat. GPIO initialized")
 
-		self._logger.info("Initializing INA219")
+	# (Re)configure the INA219 for the measurement profile.
+	# If it fails the supervisor keeps retrying in the background.
+	def configure_power_monitor(self, profile):
+		self._logger.info("Initializing INA219. Profile: {0}".format(profile.name))
+		self._powerProfile = profile
+		self._powerMonitor.probe_now()
+
+	def _probe_power_monitor(self):
 		from ina219 import INA219
-		from ina219 import DeviceRangeError
 
-		try:
-			# Expect a 0R1 resistor on the PCB
-			self._ina = INA219(SHUNT_OHMS)
-			# Default to 32V max range. (device supports 26V max)
-			self._ina.configure()
-			self._logger.info("INA219 Configured. Reading values.")
-
-			self._logger.info("Bus Voltage: %.3f V" % self._ina.voltage())
-			self._logger.info("Bus Current: %.3f mA" % self._ina.current())
-			self._logger.info("Power: %.3f mW" % self._ina.power())
-			self._logger.info("Shunt voltage: %.3f mV" % self._ina.shunt_voltage())
-		except:
-			self._logger.warn("Initializing INA219 FAILED")
+		profile = self._powerProfile
+		self._ina = None
 
-		self.setup_lightsensor()
+		if profile.autoGain:
+			# Without the max expected current the library starts at the lowest
+			# gain and increases it when the shunt voltage overflows.
+			ina = INA219(SHUNT_OHMS)
+		else:
+			# Gain fixed for the max expected current
+			ina = INA219(SHUNT_OHMS, MAX_EXPECTED_AMPS)
 
-		# Setup GPIO Pins
-		self._logger.info("Initializing GPIO Pins")
-		for gpio_option in settings.get(['gpioOptions']):
-			self.setup_gpio(gpio_option)
+		adc = getattr(INA219, profile.adc)
+		# Default to 32V max range. (device supports 26V max)
+		ina.configure(INA219.RANGE_32V, getattr(INA219, profile.gain), adc, adc)
+		self._logger.info("INA219 Configured. Bus Voltage: %.3f V" % ina.voltage())
 
-		self._logger.info("PiPowerHat. GPIO initialized")
+		self._powerConfigured = clock()
+		self._ina = ina
 
-	def setup_lightsensor(self):
+	def get_power_profile(self):
+		return self._powerProfile
 
-		from tsl2561 import TSL2561
-		from tsl2561.constants import *  # pylint: disable=unused-wildcard-import
-		try:
-			self._has_light_sensor = False
-			self._logger.info("Initializing TSL2561 Light Sensor")
-			# See https://github.com/sim0nx/tsl2561/blob/master/tsl2561/tsl2561.py
-			# address=None, busnum=None, integration_time=TSL2561_INTEGRATIONTIME_402MS, gain=TSL2561_GAIN_1X, autogain=False, debug=False
-			# TODO: Allow config of gain and integration time and maybe address?
-			self._tsl2561 = TSL2561(address=TSL2561_ADDR_LOW)
-			self._logger.info("TSL2561 Light Sensor configured")
-			self._has_light_sensor = True
-		except Exception as e:
-			self._logger.warn("Initialzing TSL2561 FAILED. Error: {0}".format(e))
+	def setup_lightsensor(self, mode):
+		self._logger.info("Initializing TSL2561 Light Sensor")
+		self._lightSensorMode = mode
+		self._lightSensorDevice.probe_now()
 
+	def _probe_light_sensor(self):
+		from tsl2561 import TSL2561
+		from tsl2561.constants import TSL2561_ADDR_LOW
+
+		self._lightSensor = None
+		# See https://github.com/sim0nx/tsl2561/blob/master/tsl2561/tsl2561.py
+		# address=None, busnum=None, integration_time=TSL2561_INTEGRATIONTIME_402MS, gain=TSL2561_GAIN_1X, autogain=False, debug=False
+		# Integration time and gain are managed by LightSensor.
+		# TODO: Allow config of address?
+		tsl2561 = TSL2561(address=TSL2561_ADDR_LOW)
+		self._lightSensor = LightSensor(tsl2561, self._lightSensorMode)
+		self._logger.info("TSL2561 Light Sensor configured. Integration time: {0}".format(self._lightSensorMode))
+
+	def set_light_sensor_mode(self, mode):
+		self._lightSensorMode = mode
+		if self._lightSensorDevice.is_online():
+			try:
+				self._lightSensorDevice.call(self._lightSensor.set_mode, mode)
+			except Exception as e:
+				self._logger.warn("Failed to set the light sensor mode: {0}".format(e))
+
+
+	# Setup (or re-setup after the settings are saved) the GPIO pins
+	def setup_gpio_pins(self, plan):
+		self._logger.info("Initializing GPIO Pins")
+		for gpio_pin in plan.gpioPins:
+			self.setup_gpio(gpio_pin)
 
-	def setup_gpio(self, gpio_option):
-		self._logger.info("Initialize GPIO pin: {0}, assigned as: {1}".format(gpio_option['pin'], gpio_option['caption']))
-		import RPi.GPIO as GPIO
+	def setup_gpio(self, gpio_pin):
+		self._logger.info("Initialize GPIO pin: {0}, assigned as: {1}".format(gpio_pin.pin, gpio_pin.caption))
+		GPIO = self._GPIO
 
-		# Mode: Disabled = 0, Input = 1, Input pull down = 2, Input pull up = 3, Output = 4
-		mode = int(gpio_option['mode'])
-		pin = gpio_option['pin']
+		mode = gpio_pin.mode
+		pin = gpio_pin.pin
 
-		if mode == 0:
+		if mode == GPIO_MODE_DISABLED:
 			self._logger.warn("GPIO Pin {0} Disabled".format(pin))
-			# Disabled
 			return;
 
 		self._logger.debug("Setting pin {0} mode: {1}".format(pin, mode))
 
-		if mode == 1:
-			# Input
+		if mode == GPIO_MODE_INPUT:
 			GPIO.setup(pin, GPIO.IN)
-		elif mode == 2:
+		elif mode == GPIO_MODE_INPUT_PULL_DOWN:
 			GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-		elif mode == 3:
+		elif mode == GPIO_MODE_INPUT_PULL_UP:
 			GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-		elif mode == 4:
-			# Output
+		elif mode == GPIO_MODE_OUTPUT:
 			GPIO.setup(pin, GPIO.OUT)
-		else:
-			self._logger.warn("Unknown pin mode")
 
 
+	# Set up a pin not in the GPIO options as an output (e.g. the safety relay).
+	def setup_output_pin(self, pin, value):
+		self._logger.info("Initialize GPIO pin: {0} as an output. Value: {1}".format(pin, value))
+		GPIO = self._GPIO
+		GPIO.setup(pin, GPIO.OUT, initial=value)
+		self._gpioPinSetValue[pin] = value
+
 	# Read the parameters from the Pi Power Hat
-	def getPiPowerValues(self, settings):
+	def getPiPowerValues(self, plan):
 		self._logger.debug("Getting values from PiPower")
 
-		try:
-			self._logger.debug("Reading Temperatures.")
-			measured_temperatures = self.read_temperatures(settings)
+		timings = dict()
+		self._stageTimings = timings
 
-			self._logger.debug("Reading Power.")
-			power = self.read_power(settings)
-
-			# V1.2 PCB only and may not be fitted
-			self._logger.debug("Reading Light Level.")
-			lightLevel = self.read_light_level(settings)
+		# Each stage is read independently so a failing device only loses it's own values.
+		try:
+			measured_temperatures = self._read_stage(timings, "temperature", self.read_temperatures, plan)
+			if measured_temperatures is None:
+				measured_temperatures = [dict(sensorId=sensor.sensorId, value=None) for sensor in plan.temperatureSensors]
 
-			self._logger.debug("Reading GPIOs.")
-			gpio_pin_values = self.read_gpio_values(settings)
+			power = self._read_stage(timings, "power", self.read_power)
+			lightLevel = self._read_stage(timings, "light", self.read_light_level)
+			gpio_pin_values = self._read_stage(timings, "gpio", self.read_gpio_values, plan) or []
 
 			return dict(
 				temperatures= measured_temperatures,
-				voltage = round(power['voltage'],2),
-				currentMilliAmps = round(power['currentMilliAmps'],2),
-				powerWatts = round(power['power'],2),
+				voltage = round(power['voltage'],2) if power else None,
+				currentMilliAmps = round(power['currentMilliAmps'],2) if power else None,
+				powerWatts = round(power['power'],2) if power else None,
+				powerProfile = self._powerProfile.to_dict(),
 				lightLevel = lightLevel,
-				fans = [
-					self.get_fan_details(0),
-					self.get_fan_details(1),
-				],
-				gpioValues = gpio_pin_values
+				lightSensor = self._lightSensor.get_state() if self._lightSensorDevice.is_online() else None,
+				fans = [self.get_fan_details(fan.fanId) for fan in plan.fans],
+				gpioValues = gpio_pin_values,
+				devices = self.get_device_states(),
 				)
 		except Exception as e:
 			self._logger.exception("Exception reading PowerHat values. Exception: {0}".format(e))
 
+	# Read a stage of the sweep. Returns None if it fails.
+	def _read_stage(self, timings, stage, read, *args):
+		self._logger.debug("Reading {0}.".format(stage))
+		with StageTimer(timings, stage):
+			try:
+				return read(*args)
+			except DeviceOfflineError:
+				return None
+			except Exception as e:
+				self._logger.debug("Failed to read {0}: {1}".format(stage, e))
+				return None
+
+	def get_device_states(self):
+		return [self._powerMonitor.get_state(), self._lightSensorDevice.get_state()]
+
+	# Stage durations (seconds) from the last sweep.
+	def get_stage_timings(self):
+		return self._stageTimings
+
 	# ===========================================
 	# Power
 	# ===========================================
-	def read_power(self, settings):
-		from ina219 import INA219
+	# Raises DeviceOfflineError if the INA219 isn't available.
+	def read_power(self):
+		return self._powerMonitor.call(self._read_power)
+
+	def _read_power(self):
 		from ina219 import DeviceRangeError
 
-		# TODO: Ensure self._ina is not null.
+		# After (re)configuring wait for the first conversion with the new settings.
+		wait = self._powerConfigured + self._powerProfile.conversionTime - clock()
+		if wait > 0:
+			time.sleep(wait)
 
-		# make some values up.
-		# extraTemperature = null
-		voltage = self._ina.voltage()
-		currentMilliAmps = self._ina.current()
-		# Power is in mW, convert it to Watts
-		power = (self._ina.power() / 1000);
+		try:
+			voltage = self._ina.voltage()
+			currentMilliAmps = self._ina.current()
+			# Power is in mW, convert it to Watts
+			power = (self._ina.power() / 1000);
+		except DeviceRangeError as e:
+			# Shunt overflow (e.g. a short), the INA219 itself is fine.
+			raise MeasurementRangeError("INA219 current over range: {0}".format(e))
 
 		return dict(
 			voltage=voltage,
@@ -229,6 +304,22 @@ class PiPowerHat:
 			power=power
 		)
 
+	# Just the bus voltage (one register read) for the undervoltage monitor.
+	def read_bus_voltage(self):
+		return self._powerMonitor.call(lambda: self._ina.voltage())
+
+	# Bus voltage and current (mA) for the power stream, power is calculated by the client.
+	def read_power_sample(self):
+		return self._powerMonitor.call(self._read_power_sample)
+
+	def _read_power_sample(self):
+		from ina219 import DeviceRangeError
+
+		try:
+			return self._ina.voltage(), self._ina.current()
+		except DeviceRangeError as e:
+			raise MeasurementRangeError("INA219 current over range: {0}".format(e))
+
 	# ===========================================
 	# Temperature
 	# ===========================================
@@ -240,61 +331,23 @@ class PiPowerHat:
 		# return ['','28-000007538f5b','28-0000070e4078','28-0000070e3270','28-000007538a2b' ]
 
 		try:
-			base_dir = '/sys/bus/w1/devices/'
-			folders = glob.glob(base_dir + '28*')
-			# self._logger.info("Got folders: {0}.".format(folders))
-
-			sensors = ['']
-
-			for folder in folders:
-				# self._logger.info("Sensor: {0}.".format(folder))
-				# Need to remove the start /sys/bus/w1/devices/ from the folder.
-				folder = folder.replace("/sys/bus/w1/devices/", "")
-				sensors.append(folder)
-
-			return sensors
-
+			return [''] + w1Sensors.discover_sensors(self._w1DevicesDir)
 		except Exception as e:
 			# self._logger.exception("Failed to get list of sensors. Exception: {0}".format(e))
 			return ['']
 
-	# Read the temperatures for each of the sensors defined in the settings
-	def read_temperatures(self, settings):
-		temperatures = []
-		for sensor in settings.get(['temperatureSensors']):
-			sensorId = sensor['sensorId']
-			if sensorId:
-				value = self.read_temperature(sensorId)
-				temperature = dict(sensorId=sensorId, value=value)
-				temperatures.append(temperature)
-
-		return temperatures
+	# Read the temperatures for each of the sensors in the plan
+	def read_temperatures(self, plan):
+		return [dict(sensorId=sensor.sensorId, value=self.read_temperature(sensor.sensorId)) for sensor in plan.temperatureSensors]
 
 	# Read the temperature from the sensor.
 	def read_temperature(self, sensor_id):
-		lines = self.read_temp_raw(sensor_id)
-
-		while lines[0].strip()[-3:] != 'YES':
-			time.sleep(0.2)
-			lines = self.read_temp_raw(sensor_id)
-
-		# TypeError
-		temp_output = lines[1].find('t=')
-
-		if temp_output != -1:
-			temp_string = lines[1].strip()[temp_output+2:]
-			temp_c = float(temp_string) / 1000.0
-			return round(temp_c,1)
-
-	# Read temperature raw output from sensor	
-	# From Adafruit: https://cdn-learn.adafruit.com/downloads/pdf/adafruits-raspberry-pi-lesson-11-ds18b20-temperature-sensing.pdf
-	def read_temp_raw(self, sensor_id):
-		sensorPath = "/sys/bus/w1/devices/{}/w1_slave".format(sensor_id)
-		catdata = subprocess.Popen(['cat', sensorPath], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		out,err = catdata.communicate()
-		out_decode = out.decode('utf-8')
-		lines = out_decode.split('\n')
-		return lines
+		path = self._w1Paths.get(sensor_id)
+		if not path:
+			path = w1Sensors.sensor_path(self._w1DevicesDir, sensor_id)
+			self._w1Paths[sensor_id] = path
+
+		return w1Sensors.read_temperature(path)
 
 	# ===========================================
 	# Fans
@@ -306,8 +359,6 @@ class PiPowerHat:
 		self._fanStates[fan_id] = state
 
 		try:
-			import RPi.GPIO as GPIO
-
 			# GPIO Library PWM controller for the fan
 			pwm = self._fan_pwm[fan_id]
 
@@ -358,55 +409,39 @@ class PiPowerHat:
 	# ===========================================
 	# Light Sensor
 	# ===========================================
-	def read_light_level(self, settings):
-
-		if not self._has_light_sensor:
-			return -1
-
-		from tsl2561 import TSL2561
-		lux = self._tsl2561.lux()
-		self._logger.info("Lux measured: {0}".format(lux))
-		return lux
+	# Raises DeviceOfflineError if the TSL2561 isn't available.
+	def read_light_level(self):
+		# Doesn't wait for the integration, returns the last complete reading.
+		return self._lightSensorDevice.call(lambda: self._lightSensor.poll())
 
 	# ===========================================
 	# GPIO Pins
 	# ===========================================
-	def read_gpio_values(self, settings):
+	def read_gpio_values(self, plan):
 		gpio_pin_values = []
 
 		try:
-			# import RPi.GPIO as GPIO
-			for gpio_option in settings.get(["gpioOptions"]):
-				#self._logger.debug("Getting GPIO for: {0}.".format(gpio_option))
-				pin = gpio_option["pin"]
-				value = self.get_gpio_pin_value(gpio_option)
-				gpio_pin_values.append(dict(pin=pin, value=value))
+			for gpio_pin in plan.gpioPins:
+				gpio_pin_values.append(dict(pin=gpio_pin.pin, value=self.get_gpio_pin_value(gpio_pin)))
 		except Exception as e:
 			self._logger.exception("Failed to read GPIO pins. Exception: {0}".format(e))
 
 		return gpio_pin_values
 
-	def get_gpio_pin_value(self, gpio_pin_options):
-		# TODO: Store set value and return that for output options
-		# Disabled = 0, Input = 1, Input pull down = 2, Input pull up = 3, Output = 4
-
-		mode = int(gpio_pin_options["mode"])
-		pin = int(gpio_pin_options["pin"])
+	def get_gpio_pin_value(self, gpio_pin):
+		mode = gpio_pin.mode
 
-		if mode == 0:
-			# Disabled
+		if mode == GPIO_MODE_DISABLED:
 			return None
-		elif mode == 4:
-			# Output
-			return self._gpioPinSetValue[pin]
+		elif mode == GPIO_MODE_OUTPUT:
+			return self._gpioPinSetValue[gpio_pin.pin]
 		else:
 			# Using BCM pin nuimber
-			import RPi.GPIO as GPIO
-			return GPIO.input(pin)
+			return self._GPIO.input(gpio_pin.pin)
 
 	def set_gpio(self, pin, state):
 		self._logger.info("Setting GPIO Pin: {0}, State: {1}".format(pin, state))
-		import RPi.GPIO as GPIO
+		GPIO = self._GPIO
 
 		# TODO: Ensure the pin is defined as output.
 
@@ -0,0 +1,225 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import json
+import time
+import threading
+import logging
+from collections import deque
+
+from .sweepMonitor import clock
+
+# Samples are sent in frames of this long (seconds).
+FRAME_INTERVAL = 0.1
+
+# Frames queued for a client before the oldest are dropped (2s at 0.1s frames)
+MAX_QUEUED_FRAMES = 20
+
+# Halve the rate sent to a client once this many frames are waiting for it.
+DECIMATE_QUEUED_FRAMES = 5
+
+# Send at most every 16th sample to the slowest clients.
+MAX_DECIMATION = 16
+
+# Comment sent when there's nothing else so proxies keep the connection open (seconds)
+KEEPALIVE_INTERVAL = 15
+
+# SSE event name for the frames.
+STREAM_EVENT = "power"
+
+
+# A frame of samples packed as columns, e.g.
+#
+#   {"seq":12,"t0":1508400000123,"t":[0,5,10],"v":[12.01,12.0,12.01],"i":[1010.2,1024.6,998.1],"intervalMs":5.0,"decimation":1,"dropped":0}
+#
+# t0 is the time of the first sample (ms since the epoch), t the offset of
+# each sample from it (ms), v the bus voltage (V), i the current (mA) and
+# intervalMs the sample interval used.
+class StreamFrame(object):
+	__slots__ = ("t0", "interval", "offsets", "voltages", "currents")
+
+	def __init__(self, t0, interval):
+		self.t0 = t0
+		self.interval = interval
+		self.offsets = []
+		self.voltages = []
+		self.currents = []
+
+	# offset: seconds since the first sample.
+	def add(self, offset, voltage, current):
+		self.offsets.append(int(round(offset * 1000)))
+		self.voltages.append(round(voltage, 3))
+		self.currents.append(round(current, 1))
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def decimate(self, decimation):
+		if decimation == 1:
+			return self
+		frame = StreamFrame(self.t0, self.interval)
+		frame.offsets = self.offsets[::decimation]
+		frame.voltages = self.voltages[::decimation]
+		frame.currents = self.currents[::decimation]
+		return frame
+
+
+# A client's queue of frames.
+#
+# put() is called from the sampler thread, notify() then tells the client
+# (on the IOLoop) there is something to send. A client that can't keep up first
+# gets fewer samples (decimation doubles while frames are waiting) and then, if
+# the queue is full, loses the oldest frames. dropped counts the samples lost.
+class StreamSubscription(object):
+	def __init__(self, notify):
+		self._notify = notify
+		self._lock = threading.Lock()
+		self._frames = deque()
+		self._sequence = 0
+		self.decimation = 1
+		self.dropped = 0
+
+	def put(self, frame):
+		with self._lock:
+			if len(self._frames) >= DECIMATE_QUEUED_FRAMES:
+				self.decimation = min(self.decimation * 2, MAX_DECIMATION)
+
+			if len(self._frames) >= MAX_QUEUED_FRAMES:
+				sequence, dropped_frame, decimation, dropped = self._frames.popleft()
+				self.dropped += len(dropped_frame) * decimation
+
+			self._sequence += 1
+			self._frames.append((self._sequence, frame.decimate(self.decimation), self.decimation, self.dropped))
+
+		self._notify()
+
+	# Frames waiting to be sent as SSE messages.
+	def take(self):
+		with self._lock:
+			frames = list(self._frames)
+			self._frames.clear()
+
+			# Caught up, send more samples again.
+			if len(frames) <= 1 and self.decimation > 1:
+				self.decimation //= 2
+
+		return [format_event(*frame) for frame in frames]
+
+
+def format_event(sequence, frame, decimation, dropped):
+	data = json.dumps(dict(
+		seq=sequence,
+		t0=int(round(frame.t0 * 1000)),
+		t=frame.offsets,
+		v=frame.voltages,
+		i=frame.currents,
+		intervalMs=round(frame.interval * 1000, 1),
+		decimation=decimation,
+		dropped=dropped,
+	), separators=(",", ":"))
+	return "id: {0}\nevent: {1}\ndata: {2}\n\n".format(sequence, STREAM_EVENT, data)
+
+
+# Samples the INA219 voltage and current at a high rate for the streaming
+# endpoint (PowerStreamHandler in streamHandlers.py), e.g. to watch the heater
+# or stepper current while tuning.
+#
+# The sampler thread only runs while at least one client is subscribed.
+class PowerStream(object):
+	def __init__(self, read_sample, interval, max_clients):
+		self._logger = logging.getLogger(__name__)
+		self._readSample = read_sample
+		self._interval = float(interval)
+		self._maxClients = max_clients
+
+		self._lock = threading.Lock()
+		self._subscriptions = []
+		self._thread = None
+		self._stop = None
+
+		self._samples = 0
+		self._errors = 0
+
+	# Applied when the sampler next starts.
+	def configure(self, interval, max_clients):
+		self._interval = float(interval)
+		self._maxClients = max_clients
+
+	# Returns None if there are already max_clients.
+	def subscribe(self, notify):
+		with self._lock:
+			if len(self._subscriptions) >= self._maxClients:
+				return None
+
+			subscription = StreamSubscription(notify)
+			self._subscriptions.append(subscription)
+
+			if self._thread is None:
+				self._stop = threading.Event()
+				self._thread = threading.Thread(target=self._run, args=(self._stop,), name="PiPowerStream")
+				self._thread.daemon = True
+				self._thread.start()
+				self._logger.info("Power stream started. Sampling every {0:.0f}ms".format(self._interval * 1000))
+
+			return subscription
+
+	def unsubscribe(self, subscription):
+		with self._lock:
+			if subscription in self._subscriptions:
+				self._subscriptions.remove(subscription)
+
+			if not self._subscriptions and self._thread is not None:
+				self._stop.set()
+				self._thread = None
+				self._logger.info("Power stream stopped. No clients.")
+
+	def get_state(self):
+		with self._lock:
+			return dict(
+				clients=len(self._subscriptions),
+				running=self._thread is not None,
+				sampleIntervalMs=round(self._interval * 1000, 1),
+				samples=self._samples,
+				errors=self._errors,
+			)
+
+	def _run(self, stop):
+		interval = self._interval
+		frame = None
+		frame_started = None
+		next_sample = clock()
+
+		while not stop.is_set():
+			try:
+				voltage, current = self._readSample()
+			except Exception as e:
+				voltage = None
+				self._errors += 1
+				self._logger.debug("Power stream failed to read the INA219: {0}".format(e))
+
+			now = clock()
+			if voltage is not None:
+				self._samples += 1
+				if frame is None:
+					frame = StreamFrame(time.time(), interval)
+					frame_started = now
+				frame.add(now - frame_started, voltage, current)
+
+			if frame is not None and now - frame_started >= FRAME_INTERVAL:
+				with self._lock:
+					subscriptions = list(self._subscriptions)
+				for subscription in subscriptions:
+					subscription.put(frame)
+				frame = None
+
+			next_sample += interval
+			wait = next_sample - clock()
+			if wait < 0:
+				next_sample = clock()
+				wait = 0
+			stop.wait(wait)
+
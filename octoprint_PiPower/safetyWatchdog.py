@@ -0,0 +1,448 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import os
+import threading
+import logging
+from collections import deque
+
+from .sweepMonitor import clock, to_milliseconds
+from .deviceSupervisor import MeasurementRangeError
+
+# Event fired when the watchdog trips.
+EVENT_SAFETY_TRIPPED = "PiPowerSafetyTripped"
+
+# Printer actions when tripped.
+PRINTER_ACTION_NONE = "none"
+PRINTER_ACTION_PAUSE = "pause"
+PRINTER_ACTION_EMERGENCY_STOP = "emergencyStop"
+
+# Try to run the watchdog ahead of OctoPrint's other threads (needs root to raise priority).
+WATCHDOG_NICE = -10
+
+# Don't judge the rate of rise on less than this much history (seconds),
+# or half the window if that's shorter.
+MIN_RISE_SPAN = 10.0
+
+
+# ===========================================
+# Rules
+# ===========================================
+
+# Current (mA) above the maximum, or beyond what the INA219 can measure (e.g. a short).
+class OvercurrentRule(object):
+	name = "overcurrent"
+
+	def __init__(self, max_current):
+		self._maxCurrent = float(max_current)
+
+	def check(self, watchdog, now):
+		if watchdog.currentOverRange:
+			return "Current over range (INA219 shunt overflow)"
+
+		current = watchdog.current
+		if current is not None and current > self._maxCurrent:
+			return "Current {0:.0f}mA above {1:.0f}mA".format(current, self._maxCurrent)
+
+
+# Temperature rising faster than the maximum (C per minute), e.g. a heater stuck on.
+class TemperatureRiseRule(object):
+	name = "temperatureRise"
+
+	def __init__(self, max_rise, window):
+		self._maxRise = float(max_rise)
+		self._window = float(window)
+		self._minSpan = min(MIN_RISE_SPAN, self._window / 2)
+		# Temperature history kept for the rule (seconds).
+		self.historyWindow = self._window
+
+	def check(self, watchdog, now):
+		for sensorId, history in watchdog.temperatureHistory.items():
+			# Drop readings older than the window
+			while len(history) > 1 and now - history[0][0] > self._window:
+				history.popleft()
+
+			if len(history) < 2:
+				continue
+
+			oldest_time, oldest = history[0]
+			latest_time, latest = history[-1]
+			span = latest_time - oldest_time
+			if span < self._minSpan:
+				continue
+
+			rise = (latest - oldest) * 60.0 / span
+			if rise > self._maxRise:
+				return "Temperature {0} rising at {1:.1f}C/min (max {2:.1f}C/min)".format(
+					watchdog.captions.get(sensorId, sensorId), rise, self._maxRise)
+
+
+# No valid reading from a temperature sensor or the INA219 for too long.
+# Also trips if the sweep stops delivering temperatures.
+class SensorLostRule(object):
+	name = "sensorLost"
+
+	def __init__(self, timeout):
+		self._timeout = float(timeout)
+
+	def check(self, watchdog, now):
+		for sensorId in watchdog.captions:
+			last_seen = watchdog.temperatureSeen.get(sensorId, watchdog.started)
+			if now - last_seen > self._timeout:
+				return "No reading from temperature sensor {0} for {1:.0f}s".format(watchdog.captions[sensorId], now - last_seen)
+
+		if now - watchdog.currentSeen > self._timeout:
+			return "No reading from the INA219 for {0:.0f}s".format(now - watchdog.currentSeen)
+
+
+# ===========================================
+# Actions
+# ===========================================
+
+# What to do when the watchdog trips.
+class SafetyActions(object):
+	dryRun = False
+
+	def __init__(self, hat, printer, fan_ids, relay_pin, relay_trip_value, max_fans, printer_action):
+		self._logger = logging.getLogger(__name__)
+		self._hat = hat
+		self._printer = printer
+		self._fanIds = fan_ids
+		self._relayPin = relay_pin
+		self._relayTripValue = relay_trip_value
+		self._maxFans = max_fans
+		self._printerAction = printer_action
+
+	def perform(self, reason):
+		# Each action is attempted even if an earlier one fails.
+		if self._relayPin is not None:
+			self._attempt("relay", self.cut_relay)
+
+		if self._maxFans:
+			self._attempt("fans", self.max_fans)
+
+		if self._printerAction == PRINTER_ACTION_PAUSE:
+			self._attempt("pause", self.pause_printer)
+		elif self._printerAction == PRINTER_ACTION_EMERGENCY_STOP:
+			self._attempt("emergency stop", self.emergency_stop)
+
+	def cut_relay(self):
+		self._hat.set_gpio(self._relayPin, self._relayTripValue)
+
+	def max_fans(self):
+		for fan_id in self._fanIds:
+			self._hat.set_fan(fan_id, True, 100)
+
+	def pause_printer(self):
+		self._printer.pause_print()
+
+	def emergency_stop(self):
+		self._printer.commands("M112")
+
+	def _attempt(self, name, action):
+		try:
+			action()
+		except Exception as e:
+			self._logger.exception("Safety action {0} failed: {1}".format(name, e))
+
+
+# Records the actions rather than performing them (self test).
+class DryRunActions(object):
+	dryRun = True
+
+	def __init__(self):
+		self.performed = threading.Event()
+		self.performedAt = None
+		self.reason = None
+
+	def perform(self, reason):
+		self.performedAt = clock()
+		self.reason = reason
+		self.performed.set()
+
+
+# ===========================================
+# Watchdog
+# ===========================================
+
+# Independent safety watchdog.
+#
+# Runs on it's own thread (rather than the 2s sweep timer) reading the INA219 current
+# every interval and checking the rules against it and the latest temperatures
+# from the sweep. When a rule trips the actions are performed once and the
+# watchdog stays tripped until reset.
+#
+# The worst case reaction time is bounded by the interval plus how late the thread
+# wakes up, the time taken to read and check (both measured each loop) and the
+# time taken by the actions (measured when tripped).
+class SafetyWatchdog(object):
+	def __init__(self, hat, rules, actions, interval, captions, fire_event=None):
+		self._logger = logging.getLogger(__name__)
+		self._hat = hat
+		self._rules = rules
+		self._actions = actions
+		self._interval = float(interval)
+		self._fireEvent = fire_event
+
+		self._thread = None
+		self._stop = threading.Event()
+		self._lock = threading.Lock()
+
+		# State used by the rules.
+		self.captions = captions
+		self.started = clock()
+		self.current = None
+		self.currentOverRange = False
+		self.currentSeen = self.started
+		self.temperatureHistory = dict()
+		self.temperatureSeen = dict()
+		# Longest history a rule needs, older readings are dropped as they're added.
+		self._historyWindow = max([getattr(rule, "historyWindow", 0.0) for rule in rules] + [0.0])
+
+		self._tripped = None
+		self._loops = 0
+		self._lastLoop = None
+		self._maxLoop = 0.0
+		self._maxLate = 0.0
+		self._lastReaction = None
+		self._maxReaction = 0.0
+		self._maxActions = 0.0
+
+	def start(self):
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._run, name="PiPowerSafetyWatchdog")
+		self._thread.daemon = True
+		self._thread.start()
+		self._logger.info("Safety watchdog started. Interval: {0:.0f}ms".format(self._interval * 1000))
+
+	def stop(self):
+		self._stop.set()
+		if self._thread:
+			self._thread.join(self._interval * 10 + 1)
+			self._thread = None
+
+	def is_tripped(self):
+		return self._tripped is not None
+
+	# Carry the trip and temperature history over from the watchdog this replaces
+	# (e.g. settings saved). Call before start().
+	def inherit(self, previous):
+		with previous._lock:
+			tripped = previous._tripped
+			history = previous.temperatureHistory
+			seen = dict(previous.temperatureSeen)
+
+		with self._lock:
+			self._tripped = tripped
+			self.temperatureHistory = history
+			self.temperatureSeen = seen
+			self.started = previous.started
+
+	def reset(self):
+		with self._lock:
+			if self._tripped:
+				self._logger.warn("Safety watchdog reset.")
+			self._tripped = None
+
+	# Called after each sweep with the measured temperatures.
+	def update_temperatures(self, temperatures, timestamp=None):
+		if timestamp is None:
+			timestamp = clock()
+
+		with self._lock:
+			for temperature in temperatures:
+				if temperature["value"] is None:
+					continue
+
+				sensorId = temperature["sensorId"]
+				history = self.temperatureHistory.get(sensorId)
+				if history is None:
+					history = deque()
+					self.temperatureHistory[sensorId] = history
+				history.append((timestamp, temperature["value"]))
+				self.temperatureSeen[sensorId] = timestamp
+
+				# The rules don't run while tripped, so trim here too.
+				while len(history) > 1 and timestamp - history[0][0] > self._historyWindow:
+					history.popleft()
+
+	def get_state(self):
+		with self._lock:
+			return dict(
+				tripped=self._tripped is not None,
+				rule=self._tripped["rule"] if self._tripped else None,
+				reason=self._tripped["reason"] if self._tripped else None,
+				loops=self._loops,
+				intervalMs=to_milliseconds(self._interval),
+				lastLoopMs=to_milliseconds(self._lastLoop),
+				maxLoopMs=to_milliseconds(self._maxLoop),
+				maxLateMs=to_milliseconds(self._maxLate),
+				lastReactionMs=to_milliseconds(self._lastReaction),
+				maxReactionMs=to_milliseconds(self._maxReaction),
+				worstCaseReactionMs=to_milliseconds(self.worst_case_reaction()),
+			)
+
+	# Sample -> action bound from the measured loop and action times.
+	def worst_case_reaction(self):
+		return self._interval + self._maxLate + self._maxLoop + self._maxActions
+
+	def _run(self):
+		self._raise_priority()
+		next_check = clock()
+
+		while not self._stop.is_set():
+			# Scheduling delay (e.g. GIL contention with the sweep).
+			late = clock() - next_check
+			if late > self._maxLate:
+				self._maxLate = late
+
+			self.check()
+
+			# Fixed rate, if a check overruns run the next straight away.
+			next_check += self._interval
+			wait = next_check - clock()
+			if wait < 0:
+				next_check = clock()
+				wait = 0
+			self._stop.wait(wait)
+
+	# Read the current and run the rules. Returns the reason if tripped.
+	def check(self):
+		sampled = clock()
+
+		try:
+			power = self._hat.read_power()
+			self.current = power["currentMilliAmps"]
+			self.currentOverRange = False
+			self.currentSeen = sampled
+		except MeasurementRangeError:
+			# The INA219 answered, the current is too high to measure.
+			self.current = None
+			self.currentOverRange = True
+			self.currentSeen = sampled
+		except Exception as e:
+			self.current = None
+			self._logger.debug("Safety watchdog failed to read current: {0}".format(e))
+
+		with self._lock:
+			self._loops += 1
+			if self._tripped:
+				self._record_loop(clock() - sampled)
+				return self._tripped["reason"]
+
+			now = clock()
+			for rule in self._rules:
+				reason = rule.check(self, now)
+				if reason:
+					self._trip(rule, reason, sampled)
+					return reason
+
+			self._record_loop(clock() - sampled)
+
+	def _record_loop(self, duration):
+		self._lastLoop = duration
+		if duration > self._maxLoop:
+			self._maxLoop = duration
+
+	def _trip(self, rule, reason, sampled):
+		self._tripped = dict(rule=rule.name, reason=reason)
+
+		# Act first, log after.
+		actions_started = clock()
+		self._actions.perform(reason)
+		finished = clock()
+
+		# A self test trip is expected, not an error.
+		log = self._logger.info if self._actions.dryRun else self._logger.error
+		log("Safety watchdog tripped ({0}): {1}".format(rule.name, reason))
+		self._record_loop(actions_started - sampled)
+		self._maxActions = max(self._maxActions, finished - actions_started)
+		self._lastReaction = finished - sampled
+		self._maxReaction = max(self._maxReaction, self._lastReaction)
+		log = self._logger.info if self._actions.dryRun else self._logger.warn
+		log("Safety actions completed {0:.0f}ms after the sample.".format(self._lastReaction * 1000))
+
+		if self._fireEvent:
+			self._fireEvent(EVENT_SAFETY_TRIPPED, dict(rule=rule.name, reason=reason, reactionMs=to_milliseconds(self._lastReaction)))
+
+	def _raise_priority(self):
+		# Python 3.8+ on Linux only.
+		if not hasattr(os, "setpriority") or not hasattr(threading, "get_native_id"):
+			return
+
+		try:
+			os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), WATCHDOG_NICE)
+		except OSError as e:
+			self._logger.debug("Unable to raise safety watchdog priority: {0}".format(e))
+
+
+def create_rules(config):
+	return [
+		OvercurrentRule(config["maxCurrentMilliAmps"]),
+		TemperatureRiseRule(config["maxTemperatureRise"], config["temperatureRiseWindow"]),
+		SensorLostRule(config["sensorLostTimeout"]),
+	]
+
+
+# Check each rule trips against the simulated hat and measure the reaction time.
+# Actions are recorded rather than performed.
+def run_self_test(simulator, config, interval, timeout=5.0):
+	results = []
+	sensorId = "28-selftest"
+	captions = {sensorId: "Self Test"}
+
+	# Fault -> the rule expected to trip.
+	expected = dict(overcurrent="overcurrent", overRange="overcurrent", temperatureRise="temperatureRise", sensorLost="sensorLost")
+
+	for fault in ["overcurrent", "overRange", "temperatureRise", "sensorLost"]:
+		simulator.clear_faults()
+		actions = DryRunActions()
+		watchdog = SafetyWatchdog(simulator, create_rules(config), actions, interval, captions)
+
+		now = clock()
+		if fault == "temperatureRise":
+			# Steady readings across most of the window, then a rise above the limit.
+			span = float(config["temperatureRiseWindow"]) * 0.8
+			for step in range(5, -1, -1):
+				watchdog.update_temperatures([dict(sensorId=sensorId, value=25.0)], now - span * step / 5)
+		elif fault == "sensorLost":
+			# Last reading just over the timeout ago.
+			watchdog.update_temperatures([dict(sensorId=sensorId, value=25.0)], now - float(config["sensorLostTimeout"]) - 1)
+		else:
+			watchdog.update_temperatures([dict(sensorId=sensorId, value=25.0)], now)
+
+		# A lost sensor is already stale when the watchdog starts.
+		injected = clock()
+		watchdog.start()
+		try:
+			if fault != "sensorLost":
+				injected = clock()
+
+			if fault == "overcurrent":
+				simulator.simulate_fault("overcurrent", float(config["maxCurrentMilliAmps"]) * 2)
+			elif fault == "overRange":
+				simulator.simulate_fault("overRange", True)
+			elif fault == "temperatureRise":
+				rise = float(config["maxTemperatureRise"]) * 2 * span / 60.0
+				watchdog.update_temperatures([dict(sensorId=sensorId, value=25.0 + rise)], injected)
+
+			tripped = actions.performed.wait(timeout)
+		finally:
+			watchdog.stop()
+			simulator.clear_faults()
+
+		state = watchdog.get_state()
+		results.append(dict(
+			fault=fault,
+			passed=bool(tripped) and state["rule"] == expected[fault],
+			rule=state["rule"],
+			reason=actions.reason,
+			reactionMs=to_milliseconds(actions.performedAt - injected) if tripped else None,
+			worstCaseReactionMs=state["worstCaseReactionMs"],
+		))
+
+	return results
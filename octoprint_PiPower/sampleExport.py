@@ -0,0 +1,256 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import io
+import csv
+import json
+import math
+import time
+import zlib
+import calendar
+import datetime
+import itertools
+
+from .sampleRecorder import TIME_FIELD
+
+FORMAT_CSV = "csv"
+FORMAT_JSONL = "jsonl"
+
+CONTENT_TYPES = {
+	FORMAT_CSV: "text/csv; charset=utf-8",
+	FORMAT_JSONL: "application/x-ndjson",
+}
+
+# Rows are sent in chunks of about this many bytes.
+CHUNK_SIZE = 64 * 1024
+
+TIME_FORMATS = ["%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"]
+
+# Smallest step (seconds), the rows are timed to the ms.
+MIN_STEP = 0.001
+
+
+class ExportError(Exception):
+	pass
+
+
+# What to export, from the query string:
+#
+#   start, end  Time range, seconds since the epoch or an ISO date/time (UTC). Default: everything.
+#   after       Resume cursor, only rows after this time (the t of the last row received).
+#   channels    Comma separated channel names. Default: the channels of the first row.
+#   step        Downsample to the mean of each step seconds.
+#   format      csv or jsonl
+#   compress    gzip to gzip the response as it's sent.
+class ExportQuery(object):
+	def __init__(self, start=None, end=None, after=None, channels=None, step=None, format=FORMAT_CSV, compress=None):
+		self.start = parse_time(start) if start else 0.0
+		self.end = parse_time(end) if end else time.time()
+		self.after = parse_time(after) if after else None
+		self.channels = [channel.strip() for channel in channels.split(",") if channel.strip()] if channels else None
+		self.format = format or FORMAT_CSV
+		self.compress = compress or None
+
+		try:
+			self.step = float(step) if step else None
+		except ValueError:
+			raise ExportError("Invalid step: {0}".format(step))
+
+		if self.step is not None and not _is_finite(self.step):
+			raise ExportError("Invalid step: {0}".format(step))
+		if self.step is not None and self.step < MIN_STEP:
+			raise ExportError("step must be at least {0}".format(MIN_STEP))
+		if self.format not in CONTENT_TYPES:
+			raise ExportError("format must be {0}".format(" or ".join(sorted(CONTENT_TYPES))))
+		if self.compress not in [None, "gzip"]:
+			raise ExportError("compress must be gzip")
+		if self.end < self.start:
+			raise ExportError("end is before start")
+
+	def file_name(self):
+		name = "pipower-samples"
+		if self.start:
+			name += datetime.datetime.utcfromtimestamp(self.start).strftime("-%Y%m%d%H%M%S")
+		name += "." + self.format
+		if self.compress:
+			name += ".gz"
+		return name
+
+
+def parse_time(value):
+	try:
+		timestamp = float(value)
+	except ValueError:
+		timestamp = None
+
+	if timestamp is None:
+		for time_format in TIME_FORMATS:
+			try:
+				return float(calendar.timegm(datetime.datetime.strptime(value, time_format).timetuple()))
+			except ValueError:
+				pass
+
+		raise ExportError("Invalid time: {0}".format(value))
+
+	# nan, inf, before 1970 or past what datetime can represent.
+	if not _is_finite(timestamp) or timestamp < 0:
+		raise ExportError("Invalid time: {0}".format(value))
+	try:
+		datetime.datetime.utcfromtimestamp(timestamp)
+	except (ValueError, OverflowError, OSError):
+		raise ExportError("Invalid time: {0}".format(value))
+
+	return timestamp
+
+
+def _is_finite(value):
+	return not math.isnan(value) and not math.isinf(value)
+
+
+# The export as chunks of bytes (sent by SampleExportHandler in streamHandlers.py). Rows are read a line at a time and passed
+# through the generators below so memory use doesn't depend on the range.
+def export_samples(recorder, query):
+	start = query.start
+	after = query.after
+	if after is not None and query.step:
+		# Resume from the next whole step, the step containing after was complete.
+		start = max(start, (math.floor(after / query.step) + 1) * query.step)
+		after = None
+
+	rows = read_samples(recorder.list_files(start if after is None else max(start, after), query.end), start, query.end, after)
+
+	channels = query.channels
+	if channels is None:
+		first = next(rows, None)
+		if first is None:
+			rows = iter([])
+			channels = []
+		else:
+			rows = itertools.chain([first], rows)
+			channels = [name for name in first if name != TIME_FIELD]
+
+	if query.step:
+		rows = downsample(rows, query.step, channels, start)
+
+	if query.format == FORMAT_CSV:
+		lines = format_csv(rows, channels)
+	else:
+		lines = format_jsonl(rows, channels)
+
+	chunks = chunk_lines(lines, CHUNK_SIZE)
+	if query.compress == "gzip":
+		chunks = gzip_chunks(chunks)
+
+	return chunks
+
+
+# Rows from start to end (inclusive) and after the cursor from the sample files.
+# Rows are in the order written, which isn't always time order (e.g. NTP stepping
+# the clock back), so every row of the files is checked.
+def read_samples(paths, start, end, after=None):
+	for path in paths:
+		try:
+			samples = io.open(path, "r", encoding="utf-8")
+		except (IOError, OSError):
+			# Deleted by the retention since it was listed.
+			continue
+
+		with samples:
+			for line in samples:
+				try:
+					row = json.loads(line)
+				except ValueError:
+					# Partly written line.
+					continue
+
+				timestamp = row.get(TIME_FIELD)
+				if timestamp is None or timestamp < start or timestamp > end or (after is not None and timestamp <= after):
+					continue
+				yield row
+
+
+# The mean of each channel over each step seconds, timed at the start of the step
+# (or start if that's later, the first step can begin before the range).
+def downsample(rows, step, channels, start=0.0):
+	bucket = None
+	sums = None
+	counts = None
+
+	for row in rows:
+		row_bucket = math.floor(row[TIME_FIELD] / step) * step
+
+		if row_bucket != bucket:
+			if bucket is not None:
+				yield _mean_row(max(bucket, start), channels, sums, counts)
+			bucket = row_bucket
+			sums = [0.0] * len(channels)
+			counts = [0] * len(channels)
+
+		for index, channel in enumerate(channels):
+			value = row.get(channel)
+			if isinstance(value, (int, float)) and not isinstance(value, bool):
+				sums[index] += value
+				counts[index] += 1
+
+	if bucket is not None:
+		yield _mean_row(max(bucket, start), channels, sums, counts)
+
+
+def _mean_row(bucket, channels, sums, counts):
+	row = {TIME_FIELD: round(bucket, 3)}
+	for index, channel in enumerate(channels):
+		row[channel] = round(sums[index] / counts[index], 3) if counts[index] else None
+	return row
+
+
+def format_csv(rows, channels):
+	# csv writes bytes on Python 2.
+	buffer = io.StringIO() if str is not bytes else io.BytesIO()
+	writer = csv.writer(buffer, lineterminator="\n")
+
+	def line(values):
+		buffer.seek(0)
+		buffer.truncate()
+		writer.writerow(values)
+		return buffer.getvalue()
+
+	yield line([TIME_FIELD] + channels)
+	for row in rows:
+		yield line([row[TIME_FIELD]] + ["" if row.get(channel) is None else row[channel] for channel in channels])
+
+
+def format_jsonl(rows, channels):
+	for row in rows:
+		if channels:
+			row = dict((name, row.get(name)) for name in [TIME_FIELD] + channels)
+		yield json.dumps(row, separators=(",", ":")) + "\n"
+
+
+def chunk_lines(lines, size):
+	chunk = []
+	length = 0
+	for line in lines:
+		chunk.append(line)
+		length += len(line)
+		if length >= size:
+			yield "".join(chunk).encode("utf-8")
+			chunk = []
+			length = 0
+
+	if chunk:
+		yield "".join(chunk).encode("utf-8")
+
+
+def gzip_chunks(chunks):
+	# wbits 31: gzip header and trailer.
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+	for chunk in chunks:
+		compressed = compressor.compress(chunk)
+		if compressed:
+			yield compressed
+	yield compressor.flush()
+
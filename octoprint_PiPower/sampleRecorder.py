@@ -0,0 +1,155 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import os
+import re
+import json
+import time
+import datetime
+import threading
+import logging
+
+# Time of the sample (seconds since the epoch) in each row.
+TIME_FIELD = "t"
+
+# One file of JSON Lines per day (UTC), e.g. samples-2017-10-19.jsonl
+FILE_PATTERN = re.compile(r"^samples-(\d{4})-(\d{2})-(\d{2})\.jsonl$")
+
+
+def file_name(day):
+	return "samples-{0}.jsonl".format(day.strftime("%Y-%m-%d"))
+
+
+def utc_day(timestamp):
+	return datetime.datetime.utcfromtimestamp(timestamp).date()
+
+
+# Records the sweep values to daily files in the plugin's data folder for export
+# (see sampleExport.py). Each row is a JSON object of channel name -> value plus
+# the time, e.g.
+#
+#   {"t":1508400000.123,"voltage":12.1,"currentMilliAmps":1023.5,"PSU PCB":31.2,"Fan 1":60}
+#
+# At most one row is written every interval seconds. Files older than
+# retention_days are deleted when the day changes.
+class SampleRecorder(object):
+	def __init__(self, folder, enabled, interval, retention_days):
+		self._logger = logging.getLogger(__name__)
+		self.folder = folder
+		self._enabled = enabled
+		self._interval = float(interval)
+		self._retentionDays = int(retention_days)
+		self._lock = threading.Lock()
+
+		self._file = None
+		self._day = None
+		self._lastRecorded = None
+		self.rows = 0
+		self.errors = 0
+
+	def configure(self, enabled, interval, retention_days):
+		with self._lock:
+			self._enabled = enabled
+			if not enabled:
+				self._close()
+			self._interval = float(interval)
+			self._retentionDays = int(retention_days)
+
+	# values: channel name -> value (None if not read).
+	def record(self, values, timestamp=None):
+		if timestamp is None:
+			timestamp = time.time()
+
+		with self._lock:
+			if not self._enabled:
+				return False
+			if self._lastRecorded is not None and 0 <= timestamp - self._lastRecorded < self._interval:
+				return False
+
+			row = {TIME_FIELD: round(timestamp, 3)}
+			row.update(values)
+
+			try:
+				day = utc_day(timestamp)
+				if day != self._day:
+					self._open(day)
+
+				self._file.write(json.dumps(row, separators=(",", ":")) + "\n")
+				self._file.flush()
+			except (IOError, OSError) as e:
+				self.errors += 1
+				self._close()
+				self._logger.warn("Failed to record samples: {0}".format(e))
+				return False
+
+			self._lastRecorded = timestamp
+			self.rows += 1
+			return True
+
+	def close(self):
+		with self._lock:
+			self._close()
+
+	# Files with samples from start to end (seconds since the epoch), oldest first.
+	def list_files(self, start, end):
+		if not os.path.isdir(self.folder):
+			return []
+
+		first = utc_day(max(start, 0))
+		last = utc_day(max(end, 0))
+		files = []
+		for name in os.listdir(self.folder):
+			day = self._file_day(name)
+			if day is not None and first <= day <= last:
+				files.append((day, os.path.join(self.folder, name)))
+
+		return [path for day, path in sorted(files)]
+
+	def get_state(self):
+		return dict(
+			enabled=self._enabled,
+			rows=self.rows,
+			errors=self.errors,
+			intervalSeconds=self._interval,
+			retentionDays=self._retentionDays,
+		)
+
+	def _open(self, day):
+		self._close()
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+
+		self._file = open(os.path.join(self.folder, file_name(day)), "a")
+		self._day = day
+		self._prune(day)
+
+	def _close(self):
+		if self._file is not None:
+			try:
+				self._file.close()
+			except (IOError, OSError):
+				pass
+		self._file = None
+		self._day = None
+
+	def _prune(self, today):
+		oldest = today - datetime.timedelta(days=self._retentionDays)
+
+		for name in os.listdir(self.folder):
+			day = self._file_day(name)
+			if day is not None and day < oldest:
+				self._logger.info("Deleting old samples: {0}".format(name))
+				os.remove(os.path.join(self.folder, name))
+
+	def _file_day(self, name):
+		match = FILE_PATTERN.match(name)
+		if not match:
+			return None
+		try:
+			return datetime.date(*[int(part) for part in match.groups()])
+		except ValueError:
+			return None
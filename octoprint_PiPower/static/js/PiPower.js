@@ -5,6 +5,57 @@
  * License: CC-SA 4.0
  */
 $(function() {
+    // 30 points per minute, 24 hour history (assumes 2s refresh of data)
+    var HISTORY_LENGTH = 24 * 30;
+
+    // Live power stream history, 10 seconds at 5ms samples.
+    var LIVE_HISTORY_LENGTH = 2000;
+
+    // Fixed size history of [time, value] points. Stored in typed arrays so adding
+    // a point is O(1) and doesn't allocate, the Flot series is only built when plotted.
+    function PiPowerRingBuffer(capacity) {
+        var self = this;
+
+        self.capacity = capacity;
+        self.times = new Float64Array(capacity);
+        self.values = new Float64Array(capacity);
+        // Index the next point will be written to.
+        self.head = 0;
+        self.length = 0;
+
+        // Cache the series built for Flot until another point is added.
+        var series = null;
+
+        self.push = function(time, value) {
+            self.times[self.head] = time;
+            // Typed arrays can't hold null (a gap in the plot), use NaN for it.
+            self.values[self.head] = (value === null || value === undefined) ? NaN : value;
+            self.head = (self.head + 1) % self.capacity;
+            if (self.length < self.capacity) {
+                self.length++;
+            }
+            series = null;
+        };
+
+        // Points oldest first, as [[time, value], ...] for Flot.
+        self.toSeries = function() {
+            if (series) {
+                return series;
+            }
+
+            series = new Array(self.length);
+            var start = (self.head - self.length + self.capacity) % self.capacity;
+            for (var i = 0; i < self.length; i++) {
+                var index = (start + i) % self.capacity;
+                var value = self.values[index];
+                series[i] = [self.times[index], isNaN(value) ? null : value];
+            }
+            return series;
+        };
+
+        return self;
+    }
+
     // View model for Fan control/monitor
 	function PiPowerFanViewModel(caption, fanId) {
         var self = this;
@@ -143,35 +194,40 @@ $(function() {
 		self.value = ko.observable();
 		self.maxValue = ko.observable(null);
 		self.minValue = ko.observable(null);
-		self.valueHistory = [];
+		self.valueHistory = new PiPowerRingBuffer(HISTORY_LENGTH);
 		self.unit = ko.observable(unit);
 
+		// Server side statistics (see metricStatistics.py), when available
+		// these replace the min/max tracked here, which reset on page reload.
+		self.statistics = ko.observable();
+
 		self.setValue = function(value) {
             self.value(value);
-            self.valueHistory.push([Date.now(), value]);
-            // 30 points per minute, 24 hour history (assumes 2s refresh of data)
-            if (self.valueHistory.length > 24 * 30) {
-                self.valueHistory.shift(0, 1);
+            self.valueHistory.push(Date.now(), value);
+
+            if (self.statistics() || value === null || value === undefined) {
+                return;
             }
 
             // Ensure Min and Max get initialized on first call.
-            if (!self.maxValue()) {
+            if (self.maxValue() === null || value > self.maxValue()) {
                 self.maxValue(value);
             }
 
-            if (!self.minValue()) {
-                self.minValue(value)
+            if (self.minValue() === null || value < self.minValue()) {
+			    self.minValue(value);
             }
+		};
 
-            // Update min/max
-            if (value > self.maxValue()) {
-                self.maxValue(value);
+		self.setStatistics = function(statistics) {
+		    if (!statistics) {
+		        return;
             }
 
-            if (value<self.minValue()) {
-			    self.minValue(value);
-            }
-		};
+		    self.statistics(statistics);
+		    self.minValue(statistics.min);
+		    self.maxValue(statistics.max);
+        };
 
 		return self;
 	}
@@ -208,6 +264,41 @@ $(function() {
 		// This needs to be initialized from settings.gpioOptions
 		self.gpioOptions = ko.observableArray([]);
 
+		// Sweep timing diagnostics (shown on the settings page)
+		self.sweepStatistics = ko.observable();
+
+		// Safety watchdog state (null when disabled) and self test results.
+		self.safety = ko.observable();
+		self.safetySelfTestResults = ko.observableArray([]);
+
+		// Undervoltage monitor state (null when disabled).
+		self.undervoltage = ko.observable();
+
+		// I2C device states (INA219, TSL2561), see deviceSupervisor.py
+		self.devices = ko.observableArray([]);
+		self.offlineDevices = ko.pureComputed(function() {
+		    return ko.utils.arrayFilter(self.devices(), function(device) {
+		        return device.state !== "online";
+            });
+        });
+
+		// Derived channels from the payload, one view model per channel name.
+		self.derivedChannels = ko.observableArray([]);
+		self.energyWattHours = ko.observable();
+
+		// Only draw the charts when the tab is visible, at most once per frame.
+		self.tabVisible = false;
+		self.plotUpdatePending = false;
+		self.livePlotUpdatePending = false;
+
+		// Live power stream (see powerStream.py), only connected while switched on and the tab is visible.
+		self.liveStreaming = ko.observable(false);
+		self.liveDecimation = ko.observable(1);
+		self.liveDropped = ko.observable(0);
+		self.liveVoltage = new PiPowerRingBuffer(LIVE_HISTORY_LENGTH);
+		self.liveCurrent = new PiPowerRingBuffer(LIVE_HISTORY_LENGTH);
+		self.liveEventSource = null;
+
 		// ===================================================
         // Before Binding - settings available
         // ===================================================
@@ -241,18 +332,22 @@ $(function() {
                 return sensorViewModel;
             });
             self.temperatureSensors(temperatureSensors);
+        };
 
-            self.updatePlots();
+        self.onAfterBinding = function() {
+            self.tabVisible = $("#tab_plugin_pipower").is(":visible");
+            self.schedulePlotUpdate();
         };
 
 		// ===================================================
         // Tab selected
         // ===================================================
         self.onAfterTabChange = function(current, previous) {
-            if (current != "#tab_plugin_pipower") {
-                return;
+            self.tabVisible = current == "#tab_plugin_pipower";
+            if (!self.tabVisible) {
+                self.stopLiveStream();
             }
-            self.updatePlots();
+            self.schedulePlotUpdate();
         };
 
 		// ===================================================
@@ -273,9 +368,35 @@ $(function() {
 
             self.updateGPIO(data);
 
-            self.updatePlots();
+            if (data.sweepStatistics) {
+                self.sweepStatistics(data.sweepStatistics);
+            }
+
+            self.setDerivedChannels(data);
+
+            if (data.statistics) {
+                self.setStatistics(data.statistics.metrics);
+            }
+
+            self.safety(data.safety);
+            self.undervoltage(data.undervoltage);
+            self.devices(data.devices || []);
+
+            self.schedulePlotUpdate();
 	    };
 
+        self.resetSafetyWatchdog = function() {
+            OctoPrint.simpleApiCommand("pipower", "resetSafetyWatchdog", {}, {});
+        };
+
+        self.runSafetySelfTest = function() {
+            self.safetySelfTestResults([]);
+            OctoPrint.simpleApiCommand("pipower", "safetySelfTest", {}, {})
+                .done(function(response) {
+                    self.safetySelfTestResults(response.results);
+                });
+        };
+
         self.updateFans = function(data) {
 
             for (var fanId = 0; fanId < 2; fanId++) {
@@ -311,6 +432,118 @@ $(function() {
             }
         }
 
+        self.setDerivedChannels = function(data) {
+            self.energyWattHours(data.energyWattHours);
+
+            var channels = data.derivedChannels || [];
+            var existing = {};
+            $.each(self.derivedChannels(), function(index, viewModel) {
+                existing[viewModel.name] = viewModel;
+            });
+
+            // Keep the view models (and their history) for channels that are still there.
+            var viewModels = $.map(channels, function(channel) {
+                var viewModel = existing[channel.name];
+                if (!viewModel) {
+                    viewModel = new PiPowerMeasuredValueViewModel(channel.caption, true, channel.unit);
+                    viewModel.name = channel.name;
+                }
+                viewModel.caption(channel.caption);
+                viewModel.unit(channel.unit);
+                viewModel.setValue(channel.value);
+                return viewModel;
+            });
+
+            var names = $.map(viewModels, function(viewModel) { return viewModel.name; }).join();
+            var previousNames = $.map(self.derivedChannels(), function(viewModel) { return viewModel.name; }).join();
+            if (names != previousNames) {
+                self.derivedChannels(viewModels);
+            }
+        };
+
+        self.addDerivedChannel = function() {
+            self.settings.derivedChannels.push({
+                enabled: ko.observable(true),
+                name: ko.observable(""),
+                caption: ko.observable(""),
+                unit: ko.observable(""),
+                expression: ko.observable(""),
+                eventThreshold: ko.observable(null)
+            });
+        };
+
+        self.removeDerivedChannel = function(channel) {
+            self.settings.derivedChannels.remove(channel);
+        };
+
+        self.setStatistics = function(metrics) {
+            self.voltage.setStatistics(metrics.voltage);
+            self.current.setStatistics(metrics.currentMilliAmps);
+            self.power.setStatistics(metrics.powerWatts);
+            self.lightLevel.setStatistics(metrics.lightLevel);
+
+            $.each(self.temperatureSensors(), function(index, sensor) {
+                if (sensor.sensorId()) {
+                    sensor.setStatistics(metrics[sensor.sensorId()]);
+                }
+            });
+
+            $.each(self.derivedChannels(), function(index, channel) {
+                channel.setStatistics(metrics[channel.name]);
+            });
+        };
+
+        // =================================================
+        // Live power stream
+        // =================================================
+        self.toggleLiveStream = function() {
+            if (self.liveStreaming()) {
+                self.stopLiveStream();
+            } else {
+                self.startLiveStream();
+            }
+        };
+
+        self.startLiveStream = function() {
+            if (self.liveEventSource) {
+                return;
+            }
+
+            // EventSource reconnects by itself if the connection drops.
+            var source = new EventSource(BASEURL + "plugin/pipower/stream");
+            source.addEventListener("power", function(event) {
+                var frame = JSON.parse(event.data);
+                for (var i = 0; i < frame.t.length; i++) {
+                    var time = frame.t0 + frame.t[i];
+                    self.liveVoltage.push(time, frame.v[i]);
+                    self.liveCurrent.push(time, frame.i[i]);
+                }
+                self.liveDecimation(frame.decimation);
+                self.liveDropped(frame.dropped);
+                self.scheduleLivePlotUpdate();
+            });
+
+            self.liveEventSource = source;
+            self.liveStreaming(true);
+        };
+
+        self.stopLiveStream = function() {
+            if (self.liveEventSource) {
+                self.liveEventSource.close();
+                self.liveEventSource = null;
+            }
+            self.liveStreaming(false);
+        };
+
+        // Download of the recorded samples (see sampleExport.py), gzipped CSV or JSON Lines.
+        self.exportUrl = function(format, step) {
+            var url = BASEURL + "plugin/pipower/export?compress=gzip&format=" + format;
+            if (step) {
+                url += "&step=" + step;
+            }
+            return url;
+        };
+
         self.setTemperatures = function(data) {
 
             for (var i = 0; i < data.temperatures.length; i++) {
@@ -332,8 +565,10 @@ $(function() {
                 self.power.setValue(data.powerWatts);
 
                 // Convert the power into the equivelant current (mA) for 5 and 3v3
-                self.currentFiveVoltEquivelant.setValue(parseInt((data.powerWatts / 5.0) * 1000));
-                self.currentThreeVoltThreeEquivelant.setValue(parseInt((data.powerWatts / 3.3) * 1000));
+                // powerWatts is null while the INA219 is offline.
+                var hasPower = data.powerWatts !== null && data.powerWatts !== undefined;
+                self.currentFiveVoltEquivelant.setValue(hasPower ? parseInt((data.powerWatts / 5.0) * 1000) : null);
+                self.currentThreeVoltThreeEquivelant.setValue(hasPower ? parseInt((data.powerWatts / 3.3) * 1000) : null);
             } catch (e) {
                 console.error("Error setting the power values. Error: " + e);
             }
@@ -391,7 +626,7 @@ $(function() {
 
 					if (temperature.enabled())
 					{
-						var actuals = temperature.valueHistory;
+						var actuals = temperature.valueHistory.toSeries();
 
 						data.push({
 							label: temperature.caption(),
@@ -462,7 +697,7 @@ $(function() {
 
 					if (powerMeasurement.enabled())
 					{
-						var actuals = powerMeasurement.valueHistory;
+						var actuals = powerMeasurement.valueHistory.toSeries();
 
 						data.push({
 							label: powerMeasurement.caption(),
@@ -480,6 +715,42 @@ $(function() {
             }
         };
 
+		self.livePlotOptions = {
+			yaxes: [{
+				// Voltage
+                min: 0,
+                max: 30,
+                ticks: 10
+            },{
+				// Current
+                min: 0,
+				alignTicksWithAxis: 1,
+				position: "right",
+            }],
+            xaxis: {
+                mode: "time",
+                tickFormatter: function(val, axis) {
+                    return (Math.round((val - Date.now()) / 100) / 10) + "s";
+                }
+            },
+            legend: {
+                position: "sw",
+                noColumns: 2,
+                backgroundOpacity: 0
+            }
+        };
+
+		self.updateLivePlot = function() {
+            var graph = $("#pipower-live-graph");
+            if (graph.length && self.liveStreaming()) {
+                var data = [
+                    { label: "Voltage", data: self.liveVoltage.toSeries(), yaxis: 1 },
+                    { label: "Current", data: self.liveCurrent.toSeries(), yaxis: 2 }
+                ];
+                $.plot(graph, data, self.livePlotOptions);
+            }
+        };
+
 		self.fansPlotOptions = {
 			yaxes: [{
 				// Fan 1
@@ -531,7 +802,7 @@ $(function() {
 
 					if (fan.speed.enabled())
 					{
-						var actuals = fan.speed.valueHistory;
+						var actuals = fan.speed.valueHistory.toSeries();
 
 						data.push({
 							label: fan.caption(),
@@ -589,7 +860,7 @@ $(function() {
 
                 if (lightMeasurement.enabled())
                 {
-                    var actuals = lightMeasurement.valueHistory;
+                    var actuals = lightMeasurement.valueHistory.toSeries();
 
                     data.push({
                         label: lightMeasurement.caption(),
@@ -648,7 +919,7 @@ $(function() {
 
 					if (gpioOption.value.enabled())
 					{
-						var actuals = gpioOption.value.valueHistory;
+						var actuals = gpioOption.value.valueHistory.toSeries();
 
 						data.push({
 							label: gpioOption.caption(),
@@ -668,14 +939,48 @@ $(function() {
             self.updateFansPlot();
             self.updateLightPlot();
             self.updateGPIOPlot();
+            self.updateLivePlot();
         }
+
+        // Redraw the charts on the next animation frame. Any further updates before
+        // then are drawn in the same frame. Nothing is drawn while the tab is hidden,
+        // the charts are drawn with the latest history when it is shown.
+        self.schedulePlotUpdate = function() {
+            if (!self.tabVisible || self.plotUpdatePending) {
+                return;
+            }
+
+            self.plotUpdatePending = true;
+            window.requestAnimationFrame(function() {
+                self.plotUpdatePending = false;
+                if (self.tabVisible) {
+                    self.updatePlots();
+                }
+            });
+        };
+
+        // As schedulePlotUpdate but only the live chart, the stream sends about 10 frames
+        // a second and the other charts only change each sweep.
+        self.scheduleLivePlotUpdate = function() {
+            if (!self.tabVisible || self.livePlotUpdatePending) {
+                return;
+            }
+
+            self.livePlotUpdatePending = true;
+            window.requestAnimationFrame(function() {
+                self.livePlotUpdatePending = false;
+                if (self.tabVisible) {
+                    self.updateLivePlot();
+                }
+            });
+        };
 	};
 
     // view model class, parameters for constructor, container to bind to
     OCTOPRINT_VIEWMODELS.push([
         PiPowerViewModel,
 		["settingsViewModel", "printerStateViewModel"],
-		["#navbar_plugin_pipower", "#tab_plugin_pipower"]
+		["#navbar_plugin_pipower", "#tab_plugin_pipower", "#settings_plugin_pipower"]
     ]);
 });
 
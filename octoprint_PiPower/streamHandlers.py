@@ -0,0 +1,126 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+# Tornado handlers for the streaming endpoints (octoprint.server.http.routes).
+#
+# Kept apart from powerStream.py and sampleExport.py and only imported by
+# get_routes, so the plugin still loads where these Tornado features aren't
+# available (the routes are skipped).
+
+import datetime
+import logging
+
+import tornado.gen
+import tornado.web
+import tornado.locks
+import tornado.util
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+
+from .powerStream import KEEPALIVE_INTERVAL
+from .sampleExport import ExportQuery, ExportError, CONTENT_TYPES, export_samples
+
+# IOLoop.run_in_executor is new in Tornado 5.
+if not hasattr(IOLoop, "run_in_executor"):
+	raise ImportError("Tornado 5 or later is needed for the streaming endpoints")
+
+
+# Server-Sent Events endpoint for the power stream.
+#
+# Served by Tornado rather than the plugin's Flask blueprint as OctoPrint's
+# WSGI container buffers the whole response. Writes wait for the previous
+# frames to be flushed to the client, frames arriving meanwhile queue in the
+# subscription (which decimates/drops them).
+class PowerStreamHandler(tornado.web.RequestHandler):
+	def initialize(self, stream, access_validation=None):
+		self._stream = stream
+		self._accessValidation = access_validation
+		self._wake = None
+		self._closed = False
+
+	@tornado.gen.coroutine
+	def get(self, *args, **kwargs):
+		if self._accessValidation is not None:
+			self._accessValidation(self.request)
+
+		io_loop = IOLoop.current()
+		self._wake = tornado.locks.Event()
+		wake = self._wake
+
+		subscription = self._stream.subscribe(lambda: io_loop.add_callback(wake.set))
+		if subscription is None:
+			raise tornado.web.HTTPError(503, "Too many power stream clients")
+
+		try:
+			self.set_header("Content-Type", "text/event-stream")
+			self.set_header("Cache-Control", "no-cache")
+			# Stop nginx etc. buffering the stream.
+			self.set_header("X-Accel-Buffering", "no")
+			self.write("retry: 2000\n\n")
+			yield self.flush()
+
+			while not self._closed:
+				try:
+					yield wake.wait(timeout=datetime.timedelta(seconds=KEEPALIVE_INTERVAL))
+				except tornado.util.TimeoutError:
+					self.write(": keepalive\n\n")
+
+				wake.clear()
+				for event in subscription.take():
+					self.write(event)
+				yield self.flush()
+		except StreamClosedError:
+			pass
+		finally:
+			self._stream.unsubscribe(subscription)
+
+	def on_connection_close(self):
+		self._closed = True
+		if self._wake is not None:
+			self._wake.set()
+
+
+# GET /plugin/pipower/export
+#
+# Sent as it's generated, OctoPrint's WSGI container would buffer all of it.
+# The files are read on an executor thread to keep the IOLoop free.
+class SampleExportHandler(tornado.web.RequestHandler):
+	def initialize(self, recorder, access_validation=None):
+		self._logger = logging.getLogger(__name__)
+		self._recorder = recorder
+		self._accessValidation = access_validation
+
+	@tornado.gen.coroutine
+	def get(self, *args, **kwargs):
+		if self._accessValidation is not None:
+			self._accessValidation(self.request)
+
+		try:
+			query = ExportQuery(**dict((name, self.get_argument(name, None)) for name in
+									["start", "end", "after", "channels", "step", "format", "compress"]))
+		except ExportError as e:
+			raise tornado.web.HTTPError(400, str(e))
+
+		if query.compress:
+			self.set_header("Content-Type", "application/gzip")
+		else:
+			self.set_header("Content-Type", CONTENT_TYPES[query.format])
+		self.set_header("Content-Disposition", "attachment; filename={0}".format(query.file_name()))
+
+		chunks = export_samples(self._recorder, query)
+		io_loop = IOLoop.current()
+		try:
+			while True:
+				chunk = yield io_loop.run_in_executor(None, next, chunks, None)
+				if chunk is None:
+					break
+				self.write(chunk)
+				yield self.flush()
+		except StreamClosedError:
+			self._logger.debug("Sample export cancelled by the client.")
+		finally:
+			chunks.close()
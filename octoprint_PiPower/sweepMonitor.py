@@ -0,0 +1,203 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import time
+import threading
+import logging
+from collections import deque
+
+# Prefer a monotonic clock so NTP adjustments on the Pi
+# don't show up as sweep drift. (Python 2 has no time.monotonic)
+clock = getattr(time, "monotonic", time.time)
+
+# Stages of a sweep, in the order the hat reads them.
+SWEEP_STAGES = ["temperature", "power", "light", "gpio"]
+
+# Keep enough history for 10 minutes at the default 2s interval.
+DEFAULT_HISTORY_SIZE = 300
+
+
+# Time a block of the sweep and store the duration in the timings dict.
+#
+#   with StageTimer(timings, "power"):
+#       power = self.read_power(settings)
+class StageTimer(object):
+	def __init__(self, timings, stage):
+		self._timings = timings
+		self._stage = stage
+		self._started = None
+
+	def __enter__(self):
+		self._started = clock()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._timings[self._stage] = clock() - self._started
+		# Don't swallow exceptions.
+		return False
+
+
+# Rolling history of durations (seconds) with percentiles.
+class RollingDurations(object):
+	def __init__(self, size=DEFAULT_HISTORY_SIZE):
+		self._values = deque(maxlen=size)
+		self.last = None
+
+	def add(self, value):
+		self.last = value
+		self._values.append(value)
+
+	def percentiles(self, *percents):
+		if not self._values:
+			return [None for percent in percents]
+
+		ordered = sorted(self._values)
+		count = len(ordered)
+		results = []
+		for percent in percents:
+			# Nearest rank
+			index = int(round(percent / 100.0 * (count - 1)))
+			results.append(ordered[index])
+		return results
+
+
+# Monitors the sample sweep timer.
+#
+# Provides the interval for the RepeatedTimer so sweeps run on a fixed schedule
+# (rather than interval + sweep duration), skipping any ticks that were missed
+# because a sweep overran rather than running them back to back.
+#
+# Also records sweep and per-stage durations, overruns and drift from the schedule.
+class SweepMonitor(object):
+	def __init__(self, interval, slow_sweep_threshold, history_size=DEFAULT_HISTORY_SIZE):
+		self._logger = logging.getLogger(__name__)
+		self._lock = threading.Lock()
+
+		self._interval = float(interval)
+		self._slowSweepThreshold = float(slow_sweep_threshold)
+
+		# When the next timer tick is due (clock() time)
+		self._nextDue = None
+		# When the tick currently being swept was due.
+		self._currentDue = None
+
+		self._sweeps = 0
+		self._overruns = 0
+		self._skippedTicks = 0
+		self._slowSweeps = 0
+		self._isSlow = False
+
+		self._lastDrift = None
+		self._maxDrift = 0.0
+
+		self._sweepDurations = RollingDurations(history_size)
+		self._stageDurations = dict()
+		for stage in SWEEP_STAGES:
+			self._stageDurations[stage] = RollingDurations(history_size)
+
+	# Interval callable for RepeatedTimer. Called after each sweep
+	# to find how long to wait until the next scheduled tick.
+	def next_interval(self):
+		with self._lock:
+			now = clock()
+
+			if self._nextDue is None:
+				self._nextDue = now + self._interval
+				return self._interval
+
+			self._nextDue += self._interval
+
+			if self._nextDue <= now:
+				# The last sweep overran one or more ticks. Drop those
+				# rather than piling sweeps up behind each other.
+				missed = int((now - self._nextDue) / self._interval) + 1
+				self._skippedTicks += missed
+				self._nextDue += missed * self._interval
+				self._logger.debug("Sweep overran, skipped {0} tick(s)".format(missed))
+
+			return self._nextDue - now
+
+	# Called by the timer at the start of a scheduled sweep.
+	def tick_started(self):
+		with self._lock:
+			if self._nextDue is None:
+				# First (run first) tick.
+				return
+
+			drift = clock() - self._nextDue
+			self._lastDrift = drift
+			if abs(drift) > abs(self._maxDrift):
+				self._maxDrift = drift
+
+	# Record a completed sweep and it's stage timings (dict of stage -> seconds)
+	def record_sweep(self, duration, stage_timings):
+		with self._lock:
+			self._sweeps += 1
+			self._sweepDurations.add(duration)
+
+			for stage, stage_duration in stage_timings.items():
+				if stage in self._stageDurations:
+					self._stageDurations[stage].add(stage_duration)
+
+			if duration > self._interval:
+				self._overruns += 1
+
+			if duration > self._slowSweepThreshold:
+				self._slowSweeps += 1
+				if not self._isSlow:
+					self._isSlow = True
+					self._logger.warn("Slow sweep. Took {0:.0f}ms (threshold: {1:.0f}ms). Stages: {2}".format(
+						duration * 1000,
+						self._slowSweepThreshold * 1000,
+						self.format_stage_timings(stage_timings)))
+			elif self._isSlow:
+				self._isSlow = False
+				self._logger.info("Sweep time back below threshold. Took {0:.0f}ms".format(duration * 1000))
+
+	def format_stage_timings(self, stage_timings):
+		parts = []
+		for stage in SWEEP_STAGES:
+			if stage in stage_timings:
+				parts.append("{0}={1:.0f}ms".format(stage, stage_timings[stage] * 1000))
+		return ", ".join(parts)
+
+	# Statistics for the plugin message/settings page.
+	# Durations are in milliseconds.
+	def get_statistics(self):
+		with self._lock:
+			stages = []
+			for stage in SWEEP_STAGES:
+				stages.append(self._get_duration_statistics(stage, self._stageDurations[stage]))
+
+			return dict(
+				interval=self._interval * 1000,
+				slowSweepThreshold=self._slowSweepThreshold * 1000,
+				sweeps=self._sweeps,
+				overruns=self._overruns,
+				skippedTicks=self._skippedTicks,
+				slowSweeps=self._slowSweeps,
+				lastDrift=to_milliseconds(self._lastDrift),
+				maxDrift=to_milliseconds(self._maxDrift),
+				total=self._get_duration_statistics("total", self._sweepDurations),
+				stages=stages,
+			)
+
+	def _get_duration_statistics(self, name, durations):
+		p50, p95, p99 = durations.percentiles(50, 95, 99)
+		return dict(
+			name=name,
+			last=to_milliseconds(durations.last),
+			p50=to_milliseconds(p50),
+			p95=to_milliseconds(p95),
+			p99=to_milliseconds(p99),
+		)
+
+
+def to_milliseconds(seconds):
+	if seconds is None:
+		return None
+	return round(seconds * 1000, 1)
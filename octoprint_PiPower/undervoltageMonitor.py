@@ -0,0 +1,162 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+import time
+import threading
+import logging
+from collections import deque
+
+from .sweepMonitor import clock, to_milliseconds
+
+# Event fired when the supply stays below the threshold for the hold time.
+EVENT_UNDERVOLTAGE = "PiPowerUndervoltage"
+
+# Name in automationEventOptions.
+AUTOMATION_EVENT_UNDERVOLTAGE = "Undervoltage"
+
+# How many recent sags to keep.
+MAX_SAGS = 50
+
+# Voltage must rise this much above the threshold to end a sag (volts)
+HYSTERESIS = 0.1
+
+
+class Sag(object):
+	__slots__ = ("started", "startedAt", "minVoltage", "duration", "confirmed")
+
+	def __init__(self, started, voltage):
+		# Monotonic clock for the duration, wall clock for reporting.
+		self.started = started
+		self.startedAt = time.time()
+		self.minVoltage = voltage
+		self.duration = 0.0
+		# Held below the threshold for the hold time.
+		self.confirmed = False
+
+	def to_dict(self):
+		return dict(
+			startedAt=self.startedAt,
+			minVoltage=round(self.minVoltage, 3),
+			durationMs=to_milliseconds(self.duration),
+		)
+
+
+# Samples the INA219 bus voltage on it's own thread, much faster than the
+# 2s sweep, to catch short supply sags (brown-outs).
+#
+# A sag starts when the voltage drops below the threshold and ends when it
+# recovers above the threshold + HYSTERESIS. When a sag lasts for the hold time
+# on_undervoltage(sag) is called (once per sag). Sags shorter than the hold
+# time are only counted as glitches.
+class UndervoltageMonitor(object):
+	def __init__(self, read_voltage, threshold, hold_time, interval, on_undervoltage):
+		self._logger = logging.getLogger(__name__)
+		self._readVoltage = read_voltage
+		self._threshold = float(threshold)
+		self._holdTime = float(hold_time)
+		self._interval = float(interval)
+		self._onUndervoltage = on_undervoltage
+
+		self._thread = None
+		self._stop = threading.Event()
+		self._lock = threading.Lock()
+
+		self._samples = 0
+		self._errors = 0
+		self._lastVoltage = None
+		self._minVoltage = None
+		self._glitches = 0
+		self._sag = None
+		self._sags = deque(maxlen=MAX_SAGS)
+
+	def start(self):
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._run, name="PiPowerUndervoltageMonitor")
+		self._thread.daemon = True
+		self._thread.start()
+		self._logger.info("Undervoltage monitor started. Threshold: {0}V for {1:.0f}ms, sampling every {2:.0f}ms".format(
+			self._threshold, self._holdTime * 1000, self._interval * 1000))
+
+	def stop(self):
+		self._stop.set()
+		if self._thread:
+			self._thread.join(self._interval * 10 + 1)
+			self._thread = None
+
+	def get_state(self):
+		with self._lock:
+			return dict(
+				threshold=self._threshold,
+				holdTimeMs=to_milliseconds(self._holdTime),
+				sampleIntervalMs=to_milliseconds(self._interval),
+				samples=self._samples,
+				errors=self._errors,
+				lastVoltage=round(self._lastVoltage, 3) if self._lastVoltage is not None else None,
+				minVoltage=round(self._minVoltage, 3) if self._minVoltage is not None else None,
+				inSag=self._sag is not None and self._sag.confirmed,
+				glitches=self._glitches,
+				sags=[sag.to_dict() for sag in self._sags],
+			)
+
+	def _run(self):
+		next_sample = clock()
+
+		while not self._stop.is_set():
+			try:
+				voltage = self._readVoltage()
+			except Exception as e:
+				voltage = None
+				self._errors += 1
+				self._logger.debug("Failed to read the bus voltage: {0}".format(e))
+
+			if voltage is not None:
+				self.sample(voltage, clock())
+
+			next_sample += self._interval
+			wait = next_sample - clock()
+			if wait < 0:
+				next_sample = clock()
+				wait = 0
+			self._stop.wait(wait)
+
+	def sample(self, voltage, now):
+		confirmed = None
+
+		with self._lock:
+			self._samples += 1
+			self._lastVoltage = voltage
+			if self._minVoltage is None or voltage < self._minVoltage:
+				self._minVoltage = voltage
+
+			sag = self._sag
+			if sag is None:
+				if voltage < self._threshold:
+					self._sag = Sag(now, voltage)
+				return
+
+			sag.duration = now - sag.started
+			if voltage < sag.minVoltage:
+				sag.minVoltage = voltage
+
+			if voltage >= self._threshold + HYSTERESIS:
+				self._sag = None
+				if sag.confirmed:
+					self._sags.append(sag)
+					self._logger.warn("Undervoltage ended. Min: {0:.2f}V, Duration: {1:.0f}ms".format(sag.minVoltage, sag.duration * 1000))
+				else:
+					self._glitches += 1
+			elif not sag.confirmed and sag.duration >= self._holdTime:
+				sag.confirmed = True
+				confirmed = sag
+
+		# Outside the lock as it may pause the printer etc.
+		if confirmed:
+			self._logger.warn("Undervoltage: {0:.2f}V below {1}V for {2:.0f}ms".format(confirmed.minVoltage, self._threshold, confirmed.duration * 1000))
+			try:
+				self._onUndervoltage(confirmed)
+			except Exception as e:
+				self._logger.exception("Undervoltage handler failed: {0}".format(e))
@@ -0,0 +1,52 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+# 1-Wire (DS18B20) temperature sensors.
+# From Adafruit: https://cdn-learn.adafruit.com/downloads/pdf/adafruits-raspberry-pi-lesson-11-ds18b20-temperature-sensing.pdf
+
+import glob
+import os
+import time
+
+# Where the 1-Wire temperature sensors are listed.
+W1_DEVICES_DIR = "/sys/bus/w1/devices/"
+
+# How many times to re-read a sensor if the CRC check fails.
+CRC_RETRIES = 3
+
+
+# Ids of the DS18B20 (28-...) sensors on the bus.
+def discover_sensors(devices_dir=W1_DEVICES_DIR):
+	folders = glob.glob(os.path.join(devices_dir, '28*'))
+	return sorted(os.path.basename(folder) for folder in folders)
+
+
+def sensor_path(devices_dir, sensor_id):
+	return os.path.join(devices_dir, sensor_id, "w1_slave")
+
+
+# Read the temperature (C) from a sensor's w1_slave file.
+# Returns None if the sensor is missing or keeps failing the CRC check.
+def read_temperature(path):
+	for attempt in range(CRC_RETRIES):
+		try:
+			with open(path, 'r') as f:
+				lines = f.readlines()
+		except (IOError, OSError):
+			# Sensor removed or bus fault.
+			return None
+
+		if len(lines) < 2 or lines[0].strip()[-3:] != 'YES':
+			time.sleep(0.2)
+			continue
+
+		temp_output = lines[1].find('t=')
+		if temp_output != -1:
+			temp_string = lines[1].strip()[temp_output+2:]
+			return round(float(temp_string) / 1000.0, 1)
+
+	return None
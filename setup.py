@@ -57,7 +57,13 @@ plugin_ignored_packages = []
 # Example:
 #     plugin_requires = ["someDependency==dev"]
 #     additional_setup_parameters = {"dependency_links": ["https://github.com/someUser/someRepo/archive/master.zip#egg=someDependency-dev"]}
-additional_setup_parameters = {}
+additional_setup_parameters = {
+	"entry_points": {
+		"console_scripts": [
+			"pipower-logger = octoprint_PiPower.ReadTemperaturesConsole:main"
+		]
+	}
+}
 
 ########################################################################################################################
 
@@ -0,0 +1,58 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+# The plugin against the fake hardware used by the benchmarks.
+
+import threading
+import time
+import unittest
+
+from benchmarks import fakeHardware
+from benchmarks.runBenchmarks import create_plugin
+
+
+class SweepTest(unittest.TestCase):
+	def setUp(self):
+		self.tree = fakeHardware.FakeW1Tree(2)
+		self.plugin = create_plugin(self.tree)
+
+	def tearDown(self):
+		self.tree.remove()
+
+	def test_sweep_in_progress_before_first_sample_waits_for_it(self):
+		read = self.plugin._powerHat.getPiPowerValues
+		started = threading.Event()
+
+		def slow_read(plan):
+			started.set()
+			time.sleep(0.2)
+			return read(plan)
+
+		self.plugin._powerHat.getPiPowerValues = slow_read
+		sweep = threading.Thread(target=self.plugin.getPiPowerValues)
+		sweep.start()
+		try:
+			self.assertTrue(started.wait(5))
+			values = self.plugin.getPiPowerValues()
+		finally:
+			sweep.join()
+
+		self.assertIsInstance(values, dict)
+		self.assertEqual(2, len(values["temperatures"]))
+
+	def test_sweep_in_progress_uses_last_values(self):
+		last = self.plugin.getPiPowerValues()
+
+		self.plugin._sweepLock.acquire()
+		try:
+			self.assertIs(last, self.plugin.getPiPowerValues())
+		finally:
+			self.plugin._sweepLock.release()
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,60 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Stephen Harrison <Stephen.Harrison@AnalysisUK.com>"
+__license__ = 'Creative Commons Share Alike 4.0'
+__copyright__ = "Copyright (C) 2017 Analysis UK Ltd - Released under terms of the CC-SA-4.0 License"
+
+# Run from the repository root with: python -m unittest discover -s tests
+
+import unittest
+
+from octoprint_PiPower.sampleExport import ExportQuery, ExportError, downsample, parse_time
+from octoprint_PiPower.sampleRecorder import TIME_FIELD
+
+
+class ExportQueryTest(unittest.TestCase):
+	def test_rejects_nan_step(self):
+		self.assertRaises(ExportError, ExportQuery, step="nan")
+
+	def test_rejects_inf_step(self):
+		self.assertRaises(ExportError, ExportQuery, step="inf")
+		self.assertRaises(ExportError, ExportQuery, step="-inf")
+
+	def test_rejects_zero_step(self):
+		self.assertRaises(ExportError, ExportQuery, step="0")
+
+	def test_rejects_negative_step(self):
+		self.assertRaises(ExportError, ExportQuery, step="-10")
+
+	def test_accepts_step(self):
+		self.assertEqual(60.0, ExportQuery(step="60").step)
+
+	def test_rejects_non_finite_times(self):
+		for value in ["nan", "inf", "-inf"]:
+			self.assertRaises(ExportError, ExportQuery, start=value)
+			self.assertRaises(ExportError, ExportQuery, end=value)
+			self.assertRaises(ExportError, ExportQuery, after=value)
+
+	def test_rejects_out_of_range_times(self):
+		self.assertRaises(ExportError, parse_time, "-1")
+		self.assertRaises(ExportError, parse_time, "1e20")
+
+	def test_parses_times(self):
+		self.assertEqual(1508400000.5, parse_time("1508400000.5"))
+		self.assertEqual(1508371200.0, parse_time("2017-10-19"))
+		self.assertEqual(1508414400.0, parse_time("2017-10-19T12:00:00Z"))
+
+
+class DownsampleTest(unittest.TestCase):
+	def test_first_bucket_starts_at_start(self):
+		rows = [{TIME_FIELD: 105.0, "v": 1.0}, {TIME_FIELD: 115.0, "v": 3.0}, {TIME_FIELD: 125.0, "v": 5.0}]
+
+		result = list(downsample(iter(rows), 20, ["v"], 105.0))
+
+		self.assertEqual([105.0, 120.0], [row[TIME_FIELD] for row in result])
+		self.assertEqual([2.0, 5.0], [row["v"] for row in result])
+
+
+if __name__ == "__main__":
+	unittest.main()